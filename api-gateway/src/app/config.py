@@ -0,0 +1,39 @@
+import os
+import json
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+class Settings(BaseSettings):
+    model_config = SettingsConfigDict(
+        env_file="../.env",
+        env_file_encoding="utf-8",
+        extra="ignore",
+    )
+
+    PAYMENTS_BASE: str                  = os.getenv("PAYMENTS_BASE", "http://payments-service:8000")
+    ORDERS_BASE: str                    = os.getenv("ORDERS_BASE", "http://orders-service:8000")
+
+    # Пул соединений к апстримам (один клиент на сервис)
+    UPSTREAM_MAX_CONNECTIONS: int       = int(os.getenv("UPSTREAM_MAX_CONNECTIONS", "100"))
+    UPSTREAM_MAX_KEEPALIVE: int         = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "20"))
+    UPSTREAM_KEEPALIVE_EXPIRY: float    = float(os.getenv("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+    UPSTREAM_HTTP2: bool                = os.getenv("UPSTREAM_HTTP2", "false").lower() == "true"
+    UPSTREAM_CONNECT_TIMEOUT: float     = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "2"))
+    UPSTREAM_TIMEOUT: float             = float(os.getenv("UPSTREAM_TIMEOUT", "10"))
+    UPSTREAM_POOL_TIMEOUT: float        = float(os.getenv("UPSTREAM_POOL_TIMEOUT", "5"))
+    # JSON вида {"create_order": 15, "get_account": 2} - таймаут по имени маршрута
+    UPSTREAM_ROUTE_TIMEOUTS: dict[str, float] = json.loads(os.getenv("UPSTREAM_ROUTE_TIMEOUTS", "{}"))
+
+    # логи пишутся в stdout из фонового потока через очередь на LOG_QUEUE_SIZE записей
+    LOG_LEVEL: str                  = os.getenv("LOG_LEVEL", "INFO")
+    # JSON вида {"gateway.upstream": "DEBUG", "uvicorn.access": "WARNING"} - уровни отдельных логгеров
+    LOG_LEVELS: dict[str, str]      = json.loads(os.getenv("LOG_LEVELS", "{}"))
+    LOG_FORMAT: str                 = os.getenv("LOG_FORMAT", "text")
+    LOG_QUEUE_SIZE: int             = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+    # трассировка: none, memory (GET /traces/{trace_id}), file (NDJSON в TRACE_FILE) или "module:Class"
+    TRACE_EXPORTER: str             = os.getenv("TRACE_EXPORTER", "none")
+    TRACE_SAMPLE_RATE: float        = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+    TRACE_FILE: str                 = os.getenv("TRACE_FILE", "traces.ndjson")
+    TRACE_MEMORY_SPANS: int         = int(os.getenv("TRACE_MEMORY_SPANS", "10000"))
+
+settings = Settings()
@@ -0,0 +1,116 @@
+import atexit
+import copy
+import json
+import logging
+import queue
+import sys
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from app.config import settings
+
+# стандартные атрибуты LogRecord (и color_message от uvicorn); всё остальное пришло через extra= и выводится полями
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "taskName", "color_message"}
+
+_listener: QueueListener | None = None
+
+
+class StructuredFormatter(logging.Formatter):
+    def __init__(self, fmt: str):
+        super().__init__()
+        self.json = fmt == "json"
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = {key: value for key, value in vars(record).items() if key not in _RESERVED}
+        if self.json:
+            line = {
+                "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+                "level": record.levelname,
+                "logger": record.name,
+                "msg": record.getMessage(),
+                **fields,
+            }
+            if record.exc_info and not record.exc_text:
+                record.exc_text = self.formatException(record.exc_info)
+            if record.exc_text:
+                line["exc"] = record.exc_text
+            return json.dumps(line, default=str, ensure_ascii=False)
+
+        line = f"{self.formatTime(record)} {record.levelname} {record.name} {record.getMessage()}"
+        if fields:
+            line += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            line += "\n" + record.exc_text
+        return line
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Кладёт запись в ограниченную очередь и сразу возвращается; в stdout пишет
+    фоновый поток QueueListener. Форматирование тоже уходит в поток, здесь
+    только подставляются аргументы. При переполнении запись отбрасывается,
+    а не блокирует event loop.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup_logging() -> None:
+    global _listener
+    if _listener is not None:
+        return
+
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(StructuredFormatter(settings.LOG_FORMAT))
+    log_queue: queue.Queue = queue.Queue(settings.LOG_QUEUE_SIZE)
+    _listener = QueueListener(log_queue, stream, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(DroppingQueueHandler(log_queue))
+    root.setLevel(settings.LOG_LEVEL.upper())
+
+    # uvicorn ставит свои синхронные хендлеры; его access-лог тоже пускаем через очередь
+    for name in ("uvicorn", "uvicorn.access"):
+        logger = logging.getLogger(name)
+        for handler in logger.handlers[:]:
+            logger.removeHandler(handler)
+        logger.propagate = True
+
+    for name, level in settings.LOG_LEVELS.items():
+        logging.getLogger(name).setLevel(level.upper())
+
+def stop_logging() -> None:
+    global _listener
+    if _listener is not None:
+        # дописывает то, что ещё лежит в очереди
+        _listener.stop()
+        _listener = None
+
+def log_stats() -> dict:
+    handlers = [h for h in logging.getLogger().handlers if isinstance(h, DroppingQueueHandler)]
+    return {
+        "queued": sum(h.queue.qsize() for h in handlers),
+        "dropped": sum(h.dropped for h in handlers),
+    }
@@ -1,50 +1,155 @@
 import logging
-from fastapi import FastAPI, HTTPException, Query, Body, Response
+from fastapi import FastAPI, HTTPException, Header, Query, Body, Response
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 import httpx
 from uuid import UUID
+from datetime import datetime
 from pydantic import BaseModel, Field
+from app import upstream
+from app.config import settings
+from app.logs import log_stats, setup_logging
+from app.metrics import MetricsMiddleware, CONTENT_TYPE, render, log_queue_collector
+from app.tracing import TracingMiddleware, MemoryExporter, close_exporter, exporter
 
+setup_logging()
 logger = logging.getLogger(__name__)
 app = FastAPI(title="API Gateway")
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
+log_queue_collector(log_stats)
 
-PAYMENTS_BASE = "http://payments-service:8000"
-ORDERS_BASE   = "http://orders-service:8000"
+@app.on_event("startup")
+async def startup_event():
+    await upstream.start_upstreams()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await upstream.close_upstreams()
+    close_exporter()
 
 # Для сваггера
 class DepositRequest(BaseModel):
     amount: float = Field(..., gt=0, description="Сумма для пополнения (положительное число)")
 
+class StripeCountRequest(BaseModel):
+    stripe_count: int = Field(..., ge=1, le=64, description="Число полос баланса (1 - обычный счёт)")
+
 class OrderCreateRequest(BaseModel):
     amount: float = Field(..., gt=0, description="Сумма заказа (положительное число)")
     description: str | None = Field(None, description="Описание заказа")
 
+class OrderBatchRequest(BaseModel):
+    orders: list[OrderCreateRequest] = Field(..., min_length=1, max_length=1000, description="Заказы одного пользователя")
 
-@app.post("/accounts/{user_id}")
-async def proxy_create_account(user_id: UUID):
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(f"{PAYMENTS_BASE}/accounts/{user_id}")
+
+# заголовки апстрима, которые отдаются клиенту как есть
+RELAYED_HEADERS = ("x-next-cursor", "content-disposition", "cache-control", "idempotent-replayed")
+
+def _relay(resp: httpx.Response) -> Response:
     if resp.status_code >= 400:
         raise HTTPException(status_code=resp.status_code, detail=resp.text)
-    return Response(content=resp.content, status_code=resp.status_code, media_type=resp.headers.get("content-type"))
+    headers = {name: resp.headers[name] for name in RELAYED_HEADERS if name in resp.headers}
+    return Response(content=resp.content, status_code=resp.status_code,
+                    media_type=resp.headers.get("content-type"), headers=headers)
 
-@app.post("/accounts/{user_id}/deposit")
-async def proxy_deposit(user_id: UUID, deposit: DepositRequest):
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(
-            f"{PAYMENTS_BASE}/accounts/{user_id}/deposit",
-            json=deposit.dict()
-        )
+
+def _idempotency_headers(idempotency_key: str | None) -> dict[str, str] | None:
+    return {"Idempotency-Key": idempotency_key} if idempotency_key else None
+
+async def _relay_stream(resp: httpx.Response) -> StreamingResponse:
+    # тело идёт клиенту чанками по мере прихода от апстрима, без буферизации
     if resp.status_code >= 400:
+        await resp.aread()
+        await resp.aclose()
         raise HTTPException(status_code=resp.status_code, detail=resp.text)
-    return Response(content=resp.content, status_code=resp.status_code, media_type=resp.headers.get("content-type"))
+    headers = {name: resp.headers[name] for name in RELAYED_HEADERS if name in resp.headers}
+    return StreamingResponse(
+        resp.aiter_raw(),
+        status_code=resp.status_code,
+        media_type=resp.headers.get("content-type"),
+        headers=headers,
+        background=BackgroundTask(resp.aclose),
+    )
+
+
+@app.get("/upstreams/stats", description="Состояние пулов соединений к сервисам")
+async def get_upstream_stats():
+    return upstream.upstream_stats()
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return Response(await render(), media_type=CONTENT_TYPE)
+
+@app.get("/traces/{trace_id}", description="Спаны trace'а из памяти gateway (TRACE_EXPORTER=memory)")
+async def get_trace(trace_id: str):
+    if not isinstance(exporter, MemoryExporter):
+        raise HTTPException(404, "In-memory trace exporter is not enabled (TRACE_EXPORTER=memory)")
+    return exporter.find(trace_id)
+
+@app.get("/accounts/export", description="Потоковая выгрузка счетов (NDJSON или CSV)")
+async def proxy_export_accounts(format: str = Query("ndjson", description="ndjson или csv")):
+    resp = await upstream.payments.stream(
+        "GET", "/accounts/export",
+        route="export_accounts",
+        params={"format": format}
+    )
+    return await _relay_stream(resp)
+
+@app.get("/holds/export", description="Потоковая выгрузка резервов (NDJSON или CSV)")
+async def proxy_export_holds(
+    user_id: UUID | None = Query(None, description="ID пользователя; без него - все резервы"),
+    format: str = Query("ndjson", description="ndjson или csv"),
+    created_from: datetime | None = Query(None, description="Создан не раньше"),
+    created_to: datetime | None = Query(None, description="Создан раньше"),
+    active_only: bool = Query(False, description="Только не отпущенные и не списанные"),
+):
+    params = {
+        "user_id": str(user_id) if user_id else None,
+        "format": format,
+        "created_from": created_from.isoformat() if created_from else None,
+        "created_to": created_to.isoformat() if created_to else None,
+        "active_only": str(active_only).lower(),
+    }
+    resp = await upstream.payments.stream(
+        "GET", "/holds/export",
+        route="export_holds",
+        params={k: v for k, v in params.items() if v is not None}
+    )
+    return await _relay_stream(resp)
+
+@app.post("/accounts/{user_id}")
+async def proxy_create_account(user_id: UUID):
+    resp = await upstream.payments.request("POST", f"/accounts/{user_id}", route="create_account")
+    return _relay(resp)
+
+@app.post("/accounts/{user_id}/deposit")
+async def proxy_deposit(
+    user_id: UUID,
+    deposit: DepositRequest,
+    idempotency_key: str | None = Header(None, alias="Idempotency-Key", description="Ретрай с тем же ключом не пополнит счёт повторно")
+):
+    resp = await upstream.payments.request(
+        "POST", f"/accounts/{user_id}/deposit",
+        route="deposit",
+        json=deposit.dict(),
+        headers=_idempotency_headers(idempotency_key)
+    )
+    return _relay(resp)
 
 @app.get("/accounts/{user_id}")
 async def proxy_get_account(user_id: UUID):
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(f"{PAYMENTS_BASE}/accounts/{user_id}")
-    if resp.status_code >= 400:
-        raise HTTPException(status_code=resp.status_code, detail=resp.text)
-    return Response(content=resp.content, status_code=resp.status_code, media_type=resp.headers.get("content-type"))
+    resp = await upstream.payments.request("GET", f"/accounts/{user_id}", route="get_account")
+    return _relay(resp)
+
+@app.put("/accounts/{user_id}/stripes")
+async def proxy_set_stripes(user_id: UUID, req: StripeCountRequest):
+    resp = await upstream.payments.request(
+        "PUT", f"/accounts/{user_id}/stripes",
+        route="set_stripes",
+        json=req.dict()
+    )
+    return _relay(resp)
 
 
 @app.post(
@@ -53,27 +158,120 @@ async def proxy_get_account(user_id: UUID):
 )
 async def proxy_create_order(
     user_id: UUID = Query(..., description="ID пользователя, делающего заказ"),
-    order: OrderCreateRequest = Body(...)
+    order: OrderCreateRequest = Body(...),
+    idempotency_key: str | None = Header(None, alias="Idempotency-Key", description="Ретрай с тем же ключом вернёт уже созданный заказ")
 ):
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(
-            f"{ORDERS_BASE}/orders?user_id={user_id}",
-            json=order.dict()
-        )
-    if resp.status_code >= 400:
-        raise HTTPException(status_code=resp.status_code, detail=resp.text)
-    return Response(content=resp.content, status_code=resp.status_code, media_type=resp.headers.get("content-type"))
+    resp = await upstream.orders.request(
+        "POST", f"/orders?user_id={user_id}",
+        route="create_order",
+        json=order.dict(),
+        headers=_idempotency_headers(idempotency_key)
+    )
+    return _relay(resp)
+
+@app.post(
+    "/orders:batch",
+    description="Создание пачки заказов одним запросом. Ответ - результат по каждому заказу: created или rejected (например, insufficient_funds)"
+)
+async def proxy_create_orders_batch(
+    user_id: UUID = Query(..., description="ID пользователя, делающего заказы"),
+    batch: OrderBatchRequest = Body(...),
+    idempotency_key: str | None = Header(None, alias="Idempotency-Key", description="Ретрай с тем же ключом вернёт тот же результат")
+):
+    resp = await upstream.orders.request(
+        "POST", f"/orders:batch?user_id={user_id}",
+        route="create_orders_batch",
+        json=batch.dict(),
+        headers=_idempotency_headers(idempotency_key)
+    )
+    return _relay(resp)
 
 @app.get(
     "/orders",
     description="Получение списка заказов пользователя"
 )
-async def proxy_list_orders(user_id: UUID = Query(..., description="ID пользователя")):
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(f"{ORDERS_BASE}/orders?user_id={user_id}")
-    if resp.status_code >= 400:
-        raise HTTPException(status_code=resp.status_code, detail=resp.text)
-    return Response(content=resp.content, status_code=resp.status_code, media_type=resp.headers.get("content-type"))
+async def proxy_list_orders(
+    user_id: UUID = Query(..., description="ID пользователя"),
+    limit: int | None = Query(None, ge=1, description="Размер страницы"),
+    cursor: str | None = Query(None, description="Курсор следующей страницы (заголовок X-Next-Cursor)"),
+    status: list[str] | None = Query(None, description="Фильтр по статусу, можно несколько"),
+    created_from: datetime | None = Query(None, description="Создан не раньше"),
+    created_to: datetime | None = Query(None, description="Создан раньше"),
+):
+    params = {
+        "user_id": str(user_id),
+        "limit": limit,
+        "cursor": cursor,
+        "status": status,
+        "created_from": created_from.isoformat() if created_from else None,
+        "created_to": created_to.isoformat() if created_to else None,
+    }
+    resp = await upstream.orders.request(
+        "GET", "/orders",
+        route="list_orders",
+        params={k: v for k, v in params.items() if v is not None}
+    )
+    return _relay(resp)
+
+@app.get(
+    "/orders/export",
+    description="Потоковая выгрузка заказов (NDJSON или CSV)"
+)
+async def proxy_export_orders(
+    user_id: UUID | None = Query(None, description="ID пользователя; без него - все заказы"),
+    format: str = Query("ndjson", description="ndjson или csv"),
+    status: list[str] | None = Query(None, description="Фильтр по статусу, можно несколько"),
+    created_from: datetime | None = Query(None, description="Создан не раньше"),
+    created_to: datetime | None = Query(None, description="Создан раньше"),
+):
+    params = {
+        "user_id": str(user_id) if user_id else None,
+        "format": format,
+        "status": status,
+        "created_from": created_from.isoformat() if created_from else None,
+        "created_to": created_to.isoformat() if created_to else None,
+    }
+    resp = await upstream.orders.stream(
+        "GET", "/orders/export",
+        route="export_orders",
+        params={k: v for k, v in params.items() if v is not None}
+    )
+    return await _relay_stream(resp)
+
+@app.get(
+    "/orders/{order_id}/events",
+    description="Подписка на статус заказа (server-sent events) вместо опроса GET /orders/{order_id}"
+)
+async def proxy_order_events(
+    order_id: UUID,
+    user_id: UUID = Query(..., description="ID пользователя")
+):
+    # поток живёт, пока Orders Service его не закроет, поэтому без read-таймаута
+    resp = await upstream.orders.stream(
+        "GET", f"/orders/{order_id}/events?user_id={user_id}",
+        route="order_events",
+        timeout=httpx.Timeout(settings.UPSTREAM_TIMEOUT, read=None)
+    )
+    return await _relay_stream(resp)
+
+@app.get(
+    "/orders/{order_id}/wait",
+    description="Long-poll: ждёт смены статуса заказа относительно known_status не дольше timeout секунд"
+)
+async def proxy_wait_order_status(
+    order_id: UUID,
+    user_id: UUID = Query(..., description="ID пользователя"),
+    known_status: str | None = Query(None, description="Статус, который клиент уже видел"),
+    timeout: float = Query(30, gt=0, description="Сколько ждать, секунд")
+):
+    params = {"user_id": str(user_id), "known_status": known_status, "timeout": timeout}
+    resp = await upstream.orders.request(
+        "GET", f"/orders/{order_id}/wait",
+        route="wait_order",
+        params={k: v for k, v in params.items() if v is not None},
+        timeout=httpx.Timeout(settings.UPSTREAM_TIMEOUT, read=timeout + settings.UPSTREAM_TIMEOUT)
+    )
+    return _relay(resp)
 
 @app.get(
     "/orders/{order_id}",
@@ -83,14 +281,11 @@ async def proxy_get_order(
     order_id: UUID,
     user_id: UUID = Query(..., description="ID пользователя")
 ):
-    async with httpx.AsyncClient() as client:
-        resp = await client.get(
-            f"{ORDERS_BASE}/orders/{order_id}?user_id={user_id}"
-        )
-    if resp.status_code >= 400:
-        raise HTTPException(status_code=resp.status_code, detail=resp.text)
-    return Response(content=resp.content, status_code=resp.status_code, media_type=resp.headers.get("content-type"))
+    resp = await upstream.orders.request(
+        "GET", f"/orders/{order_id}?user_id={user_id}",
+        route="get_order"
+    )
+    return _relay(resp)
 
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO)
     import uvicorn; uvicorn.run(app, host="0.0.0.0", port=8000)
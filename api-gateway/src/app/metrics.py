@@ -0,0 +1,218 @@
+import bisect
+import inspect
+import logging
+import time
+from abc import ABC, abstractmethod
+from typing import Awaitable, Callable
+
+logger = logging.getLogger("gateway.metrics")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_metrics: list["_Metric"] = []
+_collectors: list[Callable[[], Awaitable[None] | None]] = []
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric(ABC):
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.description = description
+        self.labelnames = labels
+        self._children: dict[tuple, object] = {}
+        _metrics.append(self)
+
+    def labels(self, *values):
+        # дочерний объект кэшируется: на горячем пути это один поиск в dict
+        child = self._children.get(values)
+        if child is None:
+            child = self._children[values] = self._child()
+        return child
+
+    @abstractmethod
+    def _child(self):
+        ...
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in self._children.items():
+            lines.append(f"{self.name}{_labels(self.labelnames, values)} {child.value}")
+        return lines
+
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+
+class Counter(_Metric):
+    kind = "counter"
+    _child = _Value
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+    _child = _Value
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+    def clear(self) -> None:
+        self._children.clear()
+
+
+class _HistogramValue:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def _child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in self._children.items():
+            cumulative = 0
+            for bound, count in zip(child.buckets, child.counts):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, values, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_labels(self.labelnames, values, le)} {child.count}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, values)} {child.sum}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, values)} {child.count}")
+        return lines
+
+
+def collector(fn: Callable[[], Awaitable[None] | None]):
+    """
+    Регистрирует функцию, которая выставляет gauge'и перед каждым /metrics:
+    состояние пулов, размер outbox и т.п. считаются при скрейпе, а не на каждом запросе.
+    """
+    _collectors.append(fn)
+    return fn
+
+async def render() -> str:
+    for fn in _collectors:
+        try:
+            result = fn()
+            if inspect.isawaitable(result):
+                await result
+        except Exception as e:
+            logger.warning("[Gateway] Metrics collector %s failed: %s", fn.__name__, e)
+    lines = []
+    for metric in _metrics:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Время обработки HTTP-запроса", ("method", "route", "status"),
+)
+
+
+class MetricsMiddleware:
+    """
+    ASGI-middleware: время запроса в гистограмму по шаблону маршрута
+    (/orders/{order_id}, а не конкретный путь), методу и коду ответа.
+    Для стримингов (SSE, экспорт) это время до конца тела.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = getattr(scope.get("route"), "path", "unmatched")
+            HTTP_REQUEST_DURATION.labels(scope["method"], route, status).observe(time.perf_counter() - start)
+
+
+def httpx_pool_connections(client) -> tuple[int, int]:
+    """(всего соединений, из них простаивающих) в пуле httpx.AsyncClient."""
+    if client is None:
+        return 0, 0
+    # httpcore не даёт публичного API для пула, поэтому смотрим best-effort
+    pool = getattr(client._transport, "_pool", None)
+    connections = list(getattr(pool, "connections", []))
+    idle = sum(1 for c in connections if c.is_idle())
+    return len(connections), idle
+
+HTTPX_POOL_CONNECTIONS = Gauge("httpx_pool_connections", "Соединения в пуле httpx-клиента", ("client", "state"))
+
+def httpx_pool_collector(name: str, get_client: Callable[[], object]) -> None:
+    @collector
+    def httpx_pool() -> None:
+        total, idle = httpx_pool_connections(get_client())
+        HTTPX_POOL_CONNECTIONS.labels(name, "active").set(total - idle)
+        HTTPX_POOL_CONNECTIONS.labels(name, "idle").set(idle)
+
+
+def log_queue_collector(get_stats: Callable[[], dict]) -> None:
+    queued = Gauge("log_queue_records", "Записи лога в очереди к потоку вывода")
+    dropped = Counter("log_records_dropped_total", "Записи лога, отброшенные из-за переполненной очереди")
+
+    @collector
+    def log_queue() -> None:
+        stats = get_stats()
+        queued.set(stats["queued"])
+        # счётчик ведёт сам DroppingQueueHandler, здесь только снимается значение
+        dropped.labels().set(stats["dropped"])
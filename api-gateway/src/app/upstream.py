@@ -0,0 +1,151 @@
+import importlib.util
+import logging
+import time
+import httpx
+from fastapi import HTTPException
+from app.config import settings
+from app.metrics import Counter, Gauge, Histogram, collector, httpx_pool_collector, httpx_pool_connections
+from app.tracing import inject, span
+
+logger = logging.getLogger("gateway.upstream")
+
+UPSTREAM_DURATION = Histogram(
+    "upstream_request_duration_seconds", "Время запроса к апстриму до заголовков ответа", ("upstream", "route"),
+)
+UPSTREAM_ERRORS = Counter("upstream_errors_total", "Таймауты и транспортные ошибки апстримов", ("upstream", "kind"))
+UPSTREAM_IN_FLIGHT = Gauge("upstream_in_flight", "Запросы к апстриму в процессе", ("upstream",))
+
+
+class UpstreamClient:
+    """
+    Долгоживущий httpx.AsyncClient для одного апстрима: соединения
+    переиспользуются между запросами вместо нового клиента на каждый вызов.
+    """
+
+    def __init__(self, name: str, base_url: str):
+        self.name = name
+        self.base_url = base_url
+        self._client: httpx.AsyncClient | None = None
+        self.in_flight = 0
+        self.requests_total = 0
+        self.errors_total = 0
+
+    async def start(self) -> None:
+        http2 = settings.UPSTREAM_HTTP2
+        if http2 and importlib.util.find_spec("h2") is None:
+            logger.warning("[Gateway] HTTP/2 requested for %s but 'h2' is not installed, using HTTP/1.1", self.name)
+            http2 = False
+
+        self._client = httpx.AsyncClient(
+            base_url=self.base_url,
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=settings.UPSTREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.UPSTREAM_MAX_KEEPALIVE,
+                keepalive_expiry=settings.UPSTREAM_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(
+                settings.UPSTREAM_TIMEOUT,
+                connect=settings.UPSTREAM_CONNECT_TIMEOUT,
+                pool=settings.UPSTREAM_POOL_TIMEOUT,
+            ),
+        )
+        logger.info("[Gateway] Upstream client '%s' started (%s, http2=%s)", self.name, self.base_url, http2)
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            logger.info("[Gateway] Upstream client '%s' closed", self.name)
+
+    def _timeout(self, route: str | None) -> httpx.Timeout | None:
+        if route is None or route not in settings.UPSTREAM_ROUTE_TIMEOUTS:
+            return None
+        return httpx.Timeout(
+            settings.UPSTREAM_ROUTE_TIMEOUTS[route],
+            connect=settings.UPSTREAM_CONNECT_TIMEOUT,
+            pool=settings.UPSTREAM_POOL_TIMEOUT,
+        )
+
+    async def request(self, method: str, url: str, *, route: str | None = None, **kwargs) -> httpx.Response:
+        return await self._send(method, url, route, False, **kwargs)
+
+    async def stream(self, method: str, url: str, *, route: str | None = None, **kwargs) -> httpx.Response:
+        """
+        Как request, но тело ответа не читается целиком: его надо отдать
+        через aiter_raw() и закрыть aclose(), чтобы соединение вернулось в пул.
+        """
+        return await self._send(method, url, route, True, **kwargs)
+
+    async def _send(self, method: str, url: str, route: str | None, stream: bool, **kwargs) -> httpx.Response:
+        if self._client is None:
+            await self.start()
+
+        # явный timeout= вызывающего (SSE, long-poll) важнее таймаута маршрута
+        timeout = self._timeout(route)
+        if timeout is not None:
+            kwargs.setdefault("timeout", timeout)
+
+        self.in_flight += 1
+        self.requests_total += 1
+        start = time.perf_counter()
+        try:
+            with span(f"{self.name} {route or method}", upstream=self.name, method=method) as s:
+                kwargs["headers"] = inject(dict(kwargs.get("headers") or {}))
+                request = self._client.build_request(method, url, **kwargs)
+                resp = await self._client.send(request, stream=stream)
+                if s is not None:
+                    s.set("http.status_code", resp.status_code)
+                return resp
+        except httpx.TimeoutException:
+            self.errors_total += 1
+            UPSTREAM_ERRORS.labels(self.name, "timeout").inc()
+            logger.warning("[Gateway] %s %s%s timed out", method, self.name, url)
+            raise HTTPException(status_code=504, detail=f"Upstream '{self.name}' timed out")
+        except httpx.TransportError as e:
+            self.errors_total += 1
+            UPSTREAM_ERRORS.labels(self.name, "transport").inc()
+            logger.error("[Gateway] %s %s%s failed: %s", method, self.name, url, e)
+            raise HTTPException(status_code=502, detail=f"Upstream '{self.name}' unavailable")
+        finally:
+            self.in_flight -= 1
+            UPSTREAM_DURATION.labels(self.name, route or "other").observe(time.perf_counter() - start)
+
+    def stats(self) -> dict:
+        connections, idle = httpx_pool_connections(self._client)
+        return {
+            "base_url": self.base_url,
+            "in_flight": self.in_flight,
+            "requests_total": self.requests_total,
+            "errors_total": self.errors_total,
+            "connections": connections,
+            "connections_idle": idle,
+            "connections_active": connections - idle,
+            "max_connections": settings.UPSTREAM_MAX_CONNECTIONS,
+            "max_keepalive": settings.UPSTREAM_MAX_KEEPALIVE,
+        }
+
+
+payments = UpstreamClient("payments", settings.PAYMENTS_BASE)
+orders   = UpstreamClient("orders", settings.ORDERS_BASE)
+
+UPSTREAMS = (payments, orders)
+
+for _upstream in UPSTREAMS:
+    httpx_pool_collector(_upstream.name, lambda u=_upstream: u._client)
+
+@collector
+def upstream_in_flight() -> None:
+    for upstream in UPSTREAMS:
+        UPSTREAM_IN_FLIGHT.labels(upstream.name).set(upstream.in_flight)
+
+async def start_upstreams() -> None:
+    for upstream in UPSTREAMS:
+        await upstream.start()
+
+async def close_upstreams() -> None:
+    for upstream in UPSTREAMS:
+        await upstream.close()
+
+def upstream_stats() -> dict:
+    return {upstream.name: upstream.stats() for upstream in UPSTREAMS}
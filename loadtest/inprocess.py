@@ -0,0 +1,82 @@
+"""
+Весь стенд в одном процессе: gateway, Orders и Payments с их воркерами
+на одном event loop, сообщения между сервисами идут через общий MemoryBroker
+вместо RabbitMQ. Нужны только базы Orders и Payments (переменные *_DB_* как
+у сервисов) и зависимости сервисов.
+
+Так сагу можно гонять loadtest.py и профилировать (py-spy, cProfile) без
+брокера: в замере остаются только БД, HTTP и код самих сервисов.
+
+    python loadtest/inprocess.py --port 8000
+    python loadtest/loadtest.py --base-url http://127.0.0.1:8000 --rps 200
+"""
+import argparse
+import asyncio
+import importlib
+import os
+import sys
+
+import uvicorn
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVICES = ("orders-service", "payments-service", "api-gateway")
+
+
+def load_service(name: str):
+    """
+    Импортирует app.main сервиса. У всех трёх сервисов пакет называется app,
+    поэтому после импорта его модули убираются из sys.modules: загруженные
+    объекты держат ссылки друг на друга и дальше работают сами по себе.
+    """
+    path = os.path.join(ROOT, name, "src")
+    sys.path.insert(0, path)
+    try:
+        main = importlib.import_module("app.main")
+        messaging = sys.modules.get("app.messaging")
+    finally:
+        sys.path.remove(path)
+        for module in [m for m in sys.modules if m == "app" or m.startswith("app.")]:
+            del sys.modules[module]
+    return main.app, messaging
+
+
+async def serve(host: str, port: int, orders_port: int, payments_port: int, log_level: str) -> None:
+    apps = {}
+    for name in SERVICES:
+        apps[name] = load_service(name)
+
+    # брокеры сервисов - разные объекты (у каждого свой модуль messaging), очереди общие
+    orders_broker = apps["orders-service"][1].broker
+    payments_broker = apps["payments-service"][1].broker
+    payments_broker.queues = orders_broker.queues
+
+    servers = [
+        uvicorn.Server(uvicorn.Config(apps["payments-service"][0], host="127.0.0.1", port=payments_port, log_level=log_level, log_config=None)),
+        uvicorn.Server(uvicorn.Config(apps["orders-service"][0], host="127.0.0.1", port=orders_port, log_level=log_level, log_config=None)),
+        uvicorn.Server(uvicorn.Config(apps["api-gateway"][0], host=host, port=port, log_level=log_level, log_config=None)),
+    ]
+    tasks = [asyncio.create_task(server.serve()) for server in servers]
+    # uvicorn ловит SIGINT только последним сервером, остальных останавливаем сами
+    await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    for server in servers:
+        server.should_exit = True
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(description="Run gateway, orders and payments in one process without RabbitMQ")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000, help="gateway port")
+    parser.add_argument("--orders-port", type=int, default=8001)
+    parser.add_argument("--payments-port", type=int, default=8002)
+    parser.add_argument("--log-level", default="warning", help="uvicorn log level")
+    args = parser.parse_args(argv)
+
+    # настройки сервисов читаются при импорте, поэтому окружение готовится до load_service
+    os.environ["BROKER_BACKEND"] = "memory"
+    os.environ["PAYMENTS_BASE"] = f"http://127.0.0.1:{args.payments_port}"
+    os.environ["ORDERS_BASE"] = f"http://127.0.0.1:{args.orders_port}"
+    asyncio.run(serve(args.host, args.port, args.orders_port, args.payments_port, args.log_level))
+
+if __name__ == "__main__":
+    main()
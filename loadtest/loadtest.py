@@ -0,0 +1,294 @@
+"""
+Нагрузочный прогон саги заказа через API Gateway.
+
+Заводит счета и пополняет их, затем создаёт заказы с заданным RPS (открытая
+модель) или заданным числом параллельных клиентов (закрытая модель), следит
+за каждым заказом до финального статуса и пишет отчёт в JSON:
+пропускная способность, p50/p95/p99 HTTP-запросов и время саги
+(от отправки POST /orders до FINISHED/CANCELLED).
+
+    python loadtest.py --rps 200 --duration 60
+    python loadtest.py --concurrency 50 --orders 5000 --label coalesce-on
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import sys
+import time
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+
+import httpx
+
+FINAL_STATUSES = ("FINISHED", "CANCELLED")
+
+
+def percentiles(values: list[float]) -> dict:
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+
+    def rank(p: float) -> float:
+        # nearest-rank
+        return values[min(len(values) - 1, max(0, math.ceil(p / 100 * len(values)) - 1))]
+
+    return {
+        "count": len(values),
+        "mean_ms": round(sum(values) / len(values) * 1000, 3),
+        "p50_ms": round(rank(50) * 1000, 3),
+        "p95_ms": round(rank(95) * 1000, 3),
+        "p99_ms": round(rank(99) * 1000, 3),
+        "max_ms": round(values[-1] * 1000, 3),
+    }
+
+
+class Stats:
+    def __init__(self):
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.http_errors: Counter = Counter()
+        self.orders: Counter = Counter()
+        self.saga: list[float] = []
+        self.saga_by_status: dict[str, list[float]] = defaultdict(list)
+        self.first_sent: float | None = None
+        self.last_sent: float | None = None
+        self.last_final: float | None = None
+
+
+class LoadTest:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.stats = Stats()
+        self.users: list[str] = []
+        self.tracking: set[asyncio.Task] = set()
+        limits = httpx.Limits(max_connections=args.max_connections, max_keepalive_connections=args.max_connections)
+        self.client = httpx.AsyncClient(base_url=args.base_url, limits=limits, timeout=args.http_timeout)
+
+    async def call(self, name: str, method: str, url: str, **kwargs) -> httpx.Response | None:
+        start = time.perf_counter()
+        try:
+            resp = await self.client.request(method, url, **kwargs)
+        except httpx.HTTPError as e:
+            self.stats.http_errors[f"{name}:{type(e).__name__}"] += 1
+            return None
+        self.stats.latencies[name].append(time.perf_counter() - start)
+        if resp.status_code >= 400:
+            self.stats.http_errors[f"{name}:{resp.status_code}"] += 1
+        return resp
+
+    async def provision(self) -> None:
+        # счета заводятся до старта таймера и в отчёт по пропускной способности не входят
+        semaphore = asyncio.Semaphore(self.args.provision_concurrency)
+
+        async def one() -> None:
+            user_id = str(uuid.uuid4())
+            async with semaphore:
+                resp = await self.call("create_account", "POST", f"/accounts/{user_id}")
+                if resp is None or resp.status_code >= 400:
+                    return
+                resp = await self.call("deposit", "POST", f"/accounts/{user_id}/deposit",
+                                       json={"amount": self.args.deposit})
+                if resp is not None and resp.status_code < 400:
+                    self.users.append(user_id)
+
+        await asyncio.gather(*(one() for _ in range(self.args.users)))
+        if not self.users:
+            raise SystemExit("no accounts could be provisioned, is the stack up?")
+
+    async def create_order(self) -> None:
+        user_id = random.choice(self.users)
+        started = time.perf_counter()
+        self.stats.first_sent = self.stats.first_sent or started
+        self.stats.last_sent = started
+        self.stats.orders["sent"] += 1
+        resp = await self.call("create_order", "POST", "/orders", params={"user_id": user_id},
+                               json={"amount": self.args.amount, "description": "loadtest"})
+        if resp is None:
+            self.stats.orders["failed"] += 1
+            return
+        if resp.status_code == 400:
+            self.stats.orders["rejected"] += 1
+            return
+        if resp.status_code >= 400:
+            self.stats.orders["failed"] += 1
+            return
+
+        self.stats.orders["created"] += 1
+        order = resp.json()
+        if self.args.track == "none":
+            return
+        if self.args.concurrency:
+            # в закрытой модели клиент ждёт завершения саги перед следующим заказом
+            await self.track(order["id"], user_id, order["status"], started)
+        else:
+            task = asyncio.create_task(self.track(order["id"], user_id, order["status"], started))
+            self.tracking.add(task)
+            task.add_done_callback(self.tracking.discard)
+
+    async def track(self, order_id: str, user_id: str, status: str, started: float) -> None:
+        deadline = started + self.args.saga_timeout
+        while status not in FINAL_STATUSES:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                self.stats.orders["saga_timeout"] += 1
+                return
+            if self.args.track == "wait":
+                resp = await self.call("wait_order", "GET", f"/orders/{order_id}/wait",
+                                       params={"user_id": user_id, "known_status": status,
+                                               "timeout": round(min(remaining, 30), 3)})
+            else:
+                await asyncio.sleep(self.args.poll_interval)
+                resp = await self.call("get_order", "GET", f"/orders/{order_id}", params={"user_id": user_id})
+            if resp is None or resp.status_code >= 400:
+                await asyncio.sleep(self.args.poll_interval)
+                continue
+            status = resp.json()["status"]
+
+        finished = time.perf_counter()
+        self.stats.last_final = finished
+        self.stats.orders[status.lower()] += 1
+        self.stats.saga.append(finished - started)
+        self.stats.saga_by_status[status].append(finished - started)
+
+    def _more(self, sent: int, stop_at: float) -> bool:
+        if self.args.orders is not None:
+            return sent < self.args.orders
+        return time.perf_counter() < stop_at
+
+    async def run_open(self) -> None:
+        # открытая модель: заказы уходят по расписанию, не дожидаясь ответов
+        loop = asyncio.get_running_loop()
+        interval = 1 / self.args.rps
+        in_flight = asyncio.Semaphore(self.args.max_in_flight)
+        requests: set[asyncio.Task] = set()
+        stop_at = time.perf_counter() + self.args.duration
+        next_at = loop.time()
+        sent = 0
+
+        async def fire() -> None:
+            try:
+                await self.create_order()
+            finally:
+                in_flight.release()
+
+        while self._more(sent, stop_at):
+            delay = next_at - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            next_at += interval
+            if in_flight.locked():
+                # стенд не успевает: заказ пропускается, а не копится очередью у клиента
+                self.stats.orders["skipped_backpressure"] += 1
+                sent += 1
+                continue
+            await in_flight.acquire()
+            task = asyncio.create_task(fire())
+            requests.add(task)
+            task.add_done_callback(requests.discard)
+            sent += 1
+
+        await asyncio.gather(*requests)
+
+    async def run_closed(self) -> None:
+        stop_at = time.perf_counter() + self.args.duration
+        sent = 0
+
+        async def worker() -> None:
+            nonlocal sent
+            while self._more(sent, stop_at):
+                sent += 1
+                await self.create_order()
+
+        await asyncio.gather(*(worker() for _ in range(self.args.concurrency)))
+
+    async def run(self) -> dict:
+        await self.provision()
+        started = time.perf_counter()
+        started_at = datetime.now(timezone.utc)
+        try:
+            if self.args.concurrency:
+                await self.run_closed()
+            else:
+                await self.run_open()
+            sending_done = time.perf_counter()
+            if self.tracking:
+                await asyncio.gather(*self.tracking)
+        finally:
+            await self.client.aclose()
+        return self.report(started_at, started, sending_done, time.perf_counter())
+
+    def report(self, started_at: datetime, started: float, sending_done: float, finished: float) -> dict:
+        stats = self.stats
+        send_window = max(sending_done - started, 1e-9)
+        completed = stats.orders["finished"] + stats.orders["cancelled"]
+        saga_window = (stats.last_final - started) if stats.last_final else None
+        return {
+            "label": self.args.label,
+            "started_at": started_at.isoformat(),
+            "duration_seconds": round(finished - started, 3),
+            "config": {
+                key: value for key, value in vars(self.args).items() if key not in ("output",)
+            },
+            "environment": {"python": platform.python_version(), "host": platform.node()},
+            "orders": dict(stats.orders),
+            "throughput": {
+                "orders_sent_per_second": round(stats.orders["sent"] / send_window, 2),
+                "orders_created_per_second": round(stats.orders["created"] / send_window, 2),
+                "sagas_completed_per_second": round(completed / saga_window, 2) if saga_window else None,
+            },
+            "http": {name: percentiles(values) for name, values in sorted(stats.latencies.items())},
+            "http_errors": dict(stats.http_errors),
+            "saga": {
+                "all": percentiles(stats.saga),
+                **{status.lower(): percentiles(values) for status, values in stats.saga_by_status.items()},
+            },
+        }
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Load test of the order saga through the API gateway")
+    parser.add_argument("--base-url", default=os.getenv("LOADTEST_BASE_URL", "http://localhost:8000"))
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--rps", type=float, default=50, help="target order rate (open model)")
+    mode.add_argument("--concurrency", type=int, default=None, help="parallel clients, each waits for its saga (closed model)")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to send orders for")
+    parser.add_argument("--orders", type=int, default=None, help="stop after this many orders instead of --duration")
+    parser.add_argument("--users", type=int, default=100, help="accounts to provision")
+    parser.add_argument("--deposit", type=float, default=1_000_000, help="initial deposit per account")
+    parser.add_argument("--amount", type=float, default=1.0, help="amount of each order")
+    parser.add_argument("--track", choices=("wait", "poll", "none"), default="wait",
+                        help="follow orders via long-poll /wait, GET polling, or not at all")
+    parser.add_argument("--poll-interval", type=float, default=0.2)
+    parser.add_argument("--saga-timeout", type=float, default=60)
+    parser.add_argument("--http-timeout", type=float, default=60)
+    parser.add_argument("--max-in-flight", type=int, default=1000, help="cap of concurrent create requests in the open model")
+    parser.add_argument("--max-connections", type=int, default=1000)
+    parser.add_argument("--provision-concurrency", type=int, default=20)
+    parser.add_argument("--label", default="", help="free-form run name stored in the report")
+    parser.add_argument("--output", default=None, help="report path, default results/<timestamp>[-label].json")
+    args = parser.parse_args(argv)
+    if args.concurrency:
+        args.rps = None
+    return args
+
+def main(argv=None) -> None:
+    args = parse_args(argv)
+    report = asyncio.run(LoadTest(args).run())
+
+    output = args.output
+    if output is None:
+        name = datetime.now().strftime("%Y%m%d-%H%M%S") + (f"-{args.label}" if args.label else "")
+        output = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", f"{name}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+    json.dump({key: report[key] for key in ("orders", "throughput", "saga")}, sys.stdout, indent=2)
+    print(f"\nreport written to {output}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import time
+import tracemalloc
+import uuid
+from typing import Awaitable, Callable
+from sqlalchemy import event, text
+from app import crud, messaging, workers
+from app.codec import codec
+from app.db import AsyncSessionLocal, Base, engine, ensure_indexes
+from app.schemas import OrderCreate
+from app.config import settings
+
+SCALES = {"1k": 1_000, "100k": 100_000, "10m": 10_000_000}
+SEED_CHUNK = 1_000_000
+ORDERS_PER_USER = 100
+
+# пользователи сида детерминированы: md5('bench-user-N')::uuid
+SEED_ORDERS_SQL = """
+    INSERT INTO orders (id, user_id, amount, description, status, created_at)
+    SELECT gen_random_uuid(),
+           md5('bench-user-' || (i % :users))::uuid,
+           (i % 100) + 1,
+           'bench-seed',
+           CASE WHEN i % 10 = 0 THEN 'CANCELLED' ELSE 'FINISHED' END,
+           now() - make_interval(secs => i)
+    FROM generate_series(:start, :stop - 1) AS i
+"""
+
+SEED_OUTBOX_SQL = """
+    INSERT INTO orders_outbox (id, aggregate_id, event_type, payload, created_at, published_at)
+    SELECT gen_random_uuid(),
+           gen_random_uuid(),
+           'payment_requested',
+           jsonb_build_object('order_id', gen_random_uuid(), 'user_id', md5('bench-user-' || (i % :users))::uuid, 'amount', 1),
+           now() - make_interval(secs => i),
+           now() - make_interval(secs => i)
+    FROM generate_series(:start, :stop - 1) AS i
+"""
+
+
+def bench_user(n: int) -> uuid.UUID:
+    return uuid.UUID(hashlib.md5(f"bench-user-{n}".encode()).hexdigest())
+
+
+class RoundTrips:
+    """
+    Считает обращения к БД через события движка: statement'ы, BEGIN,
+    COMMIT и ROLLBACK. Подготовку statement'ов asyncpg кэширует,
+    поэтому после прогрева это число round trip'ов на операцию.
+    """
+
+    def __init__(self):
+        self.count = 0
+        target = engine.sync_engine
+        for name in ("before_cursor_execute", "begin", "commit", "rollback"):
+            event.listen(target, name, self._hit)
+
+    def _hit(self, *args, **kwargs) -> None:
+        self.count += 1
+
+
+class FakeMessage:
+    def __init__(self, payload: dict):
+        self.body = codec.dumps(payload)
+        self.content_type = codec.content_type
+        self.headers = {}
+
+    async def ack(self, multiple: bool = False) -> None:
+        pass
+
+    async def nack(self, multiple: bool = False, requeue: bool = True) -> None:
+        pass
+
+
+async def seed(rows: int) -> dict:
+    """Доливает orders и orders_outbox до rows строк в каждой таблице."""
+    users = max(1, rows // ORDERS_PER_USER)
+    seeded = {}
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(ensure_indexes)
+    for table, sql in (("orders", SEED_ORDERS_SQL), ("orders_outbox", SEED_OUTBOX_SQL)):
+        async with engine.connect() as conn:
+            have = (await conn.execute(text(f"SELECT count(*) FROM {table}"))).scalar_one()
+        start = time.perf_counter()
+        for chunk in range(have, rows, SEED_CHUNK):
+            # пачками по SEED_CHUNK, чтобы 10M не шли одной транзакцией
+            async with engine.begin() as conn:
+                await conn.execute(text(sql), {"users": users, "start": chunk, "stop": min(rows, chunk + SEED_CHUNK)})
+        if have < rows:
+            async with engine.begin() as conn:
+                await conn.execute(text(f"ANALYZE {table}"))
+        seeded[table] = {"existing": have, "inserted": max(0, rows - have), "seconds": round(time.perf_counter() - start, 3)}
+    return seeded
+
+
+async def measure(
+    name: str,
+    op: Callable[[int], Awaitable[None]],
+    iterations: int,
+    alloc_iterations: int,
+    round_trips: RoundTrips,
+    warmup: int = 10,
+) -> dict:
+    for i in range(warmup):
+        await op(i)
+
+    round_trips.count = 0
+    start = time.perf_counter()
+    for i in range(iterations):
+        await op(warmup + i)
+    elapsed = time.perf_counter() - start
+    trips = round_trips.count
+
+    # отдельный проход под tracemalloc: он сильно замедляет код и не должен влиять на ops/sec
+    tracemalloc.start()
+    base_current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    for i in range(alloc_iterations):
+        await op(warmup + iterations + i)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "name": name,
+        "iterations": iterations,
+        "ops_per_second": round(iterations / elapsed, 2),
+        "mean_ms": round(elapsed / iterations * 1000, 3),
+        "round_trips_per_op": round(trips / iterations, 2),
+        "alloc_peak_kib": round((peak - base_current) / 1024, 1),
+        "alloc_retained_kib_per_op": round((current - base_current) / 1024 / max(alloc_iterations, 1), 3),
+    }
+
+
+async def run_scale(rows: int, iterations: int, alloc_iterations: int, round_trips: RoundTrips) -> list[dict]:
+    users = max(1, rows // ORDERS_PER_USER)
+    total = 10 + iterations + alloc_iterations
+    results = []
+
+    async def create_order(i: int) -> None:
+        async with AsyncSessionLocal() as session:
+            await crud.create_order(OrderCreate(user_id=bench_user(i % users), amount=10, description="bench"), session)
+    results.append(await measure("create_order", create_order, iterations, alloc_iterations, round_trips))
+
+    async def list_orders(i: int) -> None:
+        async with AsyncSessionLocal() as session:
+            await crud.list_orders(bench_user(i % users), settings.ORDERS_PAGE_SIZE, session)
+    results.append(await measure("list_orders", list_orders, iterations, alloc_iterations, round_trips))
+
+    cursors = {}
+    async with AsyncSessionLocal() as session:
+        for n in range(min(users, 100)):
+            _, cursors[n] = await crud.list_orders(bench_user(n), settings.ORDERS_PAGE_SIZE, session)
+
+    async def list_orders_next_page(i: int) -> None:
+        n = i % len(cursors)
+        async with AsyncSessionLocal() as session:
+            await crud.list_orders(bench_user(n), settings.ORDERS_PAGE_SIZE, session, cursor=cursors[n])
+    if any(cursors.values()):
+        results.append(await measure("list_orders_next_page", list_orders_next_page, iterations, alloc_iterations, round_trips))
+
+    # одна итерация outbox_publisher = одна пачка OUTBOX_BATCH_SIZE; неопубликованный
+    # хвост готовится заранее и в замер не входит
+    batch = settings.OUTBOX_BATCH_SIZE
+    async with engine.begin() as conn:
+        await conn.execute(text("""
+            INSERT INTO orders_outbox (id, aggregate_id, event_type, payload)
+            SELECT gen_random_uuid(), gen_random_uuid(), 'payment_requested',
+                   jsonb_build_object('order_id', gen_random_uuid(), 'user_id', gen_random_uuid(), 'amount', 1)
+            FROM generate_series(1, :n)
+        """), {"n": total * batch})
+    # RabbitMQ не участвует: публикация идёт в брокер внутри процесса, очередь чистится
+    # каждую итерацию, чтобы опубликованные сообщения не копились в памяти
+    messaging.broker = messaging.MemoryBroker()
+    await messaging.broker.connect()
+
+    async def outbox_iteration(i: int) -> None:
+        await workers.publish_outbox_batch()
+        await messaging.broker.purge(messaging.QUEUE_PAYMENT_REQUESTS)
+    results.append(await measure(f"outbox_publisher_batch[{batch}]", outbox_iteration, iterations, alloc_iterations, round_trips))
+
+    # одна итерация result_consumer = пачка RESULT_BATCH_SIZE результатов по заказам в статусе NEW
+    batch = settings.RESULT_BATCH_SIZE
+    async with engine.begin() as conn:
+        new_ids = (await conn.execute(text("""
+            INSERT INTO orders (id, user_id, amount, description, status)
+            SELECT gen_random_uuid(), md5('bench-user-' || (i % :users))::uuid, 1, 'bench-pending', 'NEW'
+            FROM generate_series(1, :n) AS i
+            RETURNING id
+        """), {"users": users, "n": total * batch})).scalars().all()
+    batches = [
+        [FakeMessage({"order_id": str(order_id), "result": "success" if k % 5 else "failed"})
+         for k, order_id in enumerate(new_ids[n * batch:(n + 1) * batch])]
+        for n in range(total)
+    ]
+
+    async def result_iteration(i: int) -> None:
+        await workers.process_result_batch(batches[i])
+    results.append(await measure(f"result_consumer_batch[{batch}]", result_iteration, iterations, alloc_iterations, round_trips))
+    return results
+
+
+async def _main(scales: list[str], iterations: int, alloc_iterations: int, output: str | None) -> None:
+    round_trips = RoundTrips()
+    report = {"service": "orders", "scales": {}}
+    try:
+        for scale in scales:
+            rows = SCALES[scale]
+            seeded = await seed(rows)
+            report["scales"][scale] = {
+                "rows": rows,
+                "seed": seeded,
+                "benchmarks": await run_scale(rows, iterations, alloc_iterations, round_trips),
+            }
+    finally:
+        await engine.dispose()
+
+    text_report = json.dumps(report, ensure_ascii=False, indent=2)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(text_report)
+    print(text_report)
+
+if __name__ == "__main__":
+    # python -m app.bench --scale 1k --scale 100k --output bench-orders.json
+    # Пишет в БД из настроек: запускать на локальной/стендовой базе, не на боевой.
+    parser = argparse.ArgumentParser(description="Microbenchmarks of orders crud and worker hot paths")
+    parser.add_argument("--scale", action="append", choices=SCALES, help="seed size of orders and outbox (repeatable)")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--alloc-iterations", type=int, default=50)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+    engine.echo = False
+    asyncio.run(_main(args.scale or ["1k"], args.iterations, args.alloc_iterations, args.output))
@@ -0,0 +1,213 @@
+import logging
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Awaitable, Callable
+from app.config import settings
+
+logger = logging.getLogger("orders.cache")
+
+# слоты поколений: инвалидация ключа сдвигает поколение его слота, и загрузка,
+# начатая до инвалидации, не положит в кэш устаревшее значение
+GENERATION_SLOTS = 4096
+# сколько живёт версия ключа в Redis: дольше любой загрузки из БД
+GENERATION_TTL_SECONDS = 3600
+
+
+class BaseCache(ABC):
+    backend = "none"
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._generations = [0] * GENERATION_SLOTS
+
+    @abstractmethod
+    async def get(self, key: str) -> bytes | None:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, value: bytes) -> None:
+        ...
+
+    @abstractmethod
+    async def _delete(self, key: str) -> None:
+        ...
+
+    async def invalidate(self, key: str) -> None:
+        self._generations[hash(key) % GENERATION_SLOTS] += 1
+        self.invalidations += 1
+        await self._delete(key)
+
+    async def _generation(self, key: str):
+        return self._generations[hash(key) % GENERATION_SLOTS]
+
+    async def _set_if_generation(self, key: str, value: bytes, generation) -> None:
+        if self._generations[hash(key) % GENERATION_SLOTS] == generation:
+            await self.set(key, value)
+
+    async def get_or_load(self, key: str, loader: Callable[[], Awaitable[bytes | None]]) -> bytes | None:
+        value = await self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+        self.misses += 1
+
+        generation = await self._generation(key)
+        value = await loader()
+        if value is not None:
+            await self._set_if_generation(key, value, generation)
+        return value
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.backend,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+class MemoryCache(BaseCache):
+    """
+    In-process TTL + LRU кэш. Размер ограничен и числом записей,
+    и суммарным объёмом значений в байтах.
+    """
+    backend = "memory"
+
+    def __init__(self, ttl: float, max_entries: int, max_bytes: int):
+        super().__init__()
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries: OrderedDict[str, tuple[float, bytes]] = OrderedDict()
+
+    async def get(self, key: str) -> bytes | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            self._pop(key)
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: bytes) -> None:
+        if len(value) > self.max_bytes:
+            return
+        self._pop(key)
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self.bytes += len(value)
+        while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._pop(oldest)
+            self.evictions += 1
+
+    async def _delete(self, key: str) -> None:
+        self._pop(key)
+
+    def _pop(self, key: str) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= len(entry[1])
+
+    def stats(self) -> dict:
+        return {
+            **super().stats(),
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+        }
+
+
+# SET только если версия ключа не менялась с начала загрузки
+SET_IF_GENERATION = """
+if (redis.call('GET', KEYS[1]) or '') == ARGV[1] then
+    redis.call('SET', KEYS[2], ARGV[2], 'PX', ARGV[3])
+    return 1
+end
+return 0
+"""
+
+
+class RedisCache(BaseCache):
+    """
+    Общий кэш для нескольких реплик; лимит памяти задаётся на стороне
+    Redis (maxmemory + allkeys-lru). Версия ключа тоже живёт в Redis:
+    инвалидация на одной реплике не даёт загрузке, начатой на другой,
+    положить в кэш устаревшее значение.
+    """
+    backend = "redis"
+
+    def __init__(self, url: str, ttl: float, prefix: str):
+        super().__init__()
+        import redis.asyncio as redis
+        self.ttl = ttl
+        self.prefix = prefix
+        self._redis = redis.from_url(url)
+        self._set_if_current = self._redis.register_script(SET_IF_GENERATION)
+
+    def _generation_key(self, key: str) -> str:
+        return f"{self.prefix}gen:{key}"
+
+    async def invalidate(self, key: str) -> None:
+        self.invalidations += 1
+        await (
+            self._redis.pipeline(transaction=True)
+            .incr(self._generation_key(key))
+            .pexpire(self._generation_key(key), GENERATION_TTL_SECONDS * 1000)
+            .delete(self.prefix + key)
+            .execute()
+        )
+
+    async def _generation(self, key: str):
+        return await self._redis.get(self._generation_key(key)) or b""
+
+    async def _set_if_generation(self, key: str, value: bytes, generation) -> None:
+        await self._set_if_current(
+            keys=[self._generation_key(key), self.prefix + key],
+            args=[generation, value, int(self.ttl * 1000)],
+        )
+
+    async def get(self, key: str) -> bytes | None:
+        return await self._redis.get(self.prefix + key)
+
+    async def set(self, key: str, value: bytes) -> None:
+        await self._redis.set(self.prefix + key, value, px=int(self.ttl * 1000))
+
+    async def _delete(self, key: str) -> None:
+        await self._redis.delete(self.prefix + key)
+
+
+class NullCache(BaseCache):
+    async def get(self, key: str) -> bytes | None:
+        return None
+
+    async def set(self, key: str, value: bytes) -> None:
+        pass
+
+    async def _delete(self, key: str) -> None:
+        pass
+
+
+def build_cache() -> BaseCache:
+    if not settings.CACHE_ENABLED:
+        return NullCache()
+    if settings.CACHE_BACKEND == "redis":
+        try:
+            return RedisCache(settings.CACHE_REDIS_URL, settings.CACHE_TTL_SECONDS, "orders:")
+        except ImportError:
+            logger.warning("[Orders] CACHE_BACKEND=redis but 'redis' is not installed, using in-process cache")
+    return MemoryCache(settings.CACHE_TTL_SECONDS, settings.CACHE_MAX_ENTRIES, settings.CACHE_MAX_BYTES)
+
+
+cache = build_cache()
+
+def order_key(user_id, order_id) -> str:
+    return f"order:{user_id}:{order_id}"
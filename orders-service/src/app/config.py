@@ -1,4 +1,5 @@
 import os
+import json
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 class Settings(BaseSettings):
@@ -18,8 +19,66 @@ class Settings(BaseSettings):
     RABBIT_PASSWORD: str        = os.getenv("RABBIT_PASSWORD", "")
     RABBIT_HOST: str            = os.getenv("RABBIT_HOST", "")
     RABBIT_PORT: int            = int(os.getenv("RABBIT_PORT", "5672"))
+    # rabbitmq или memory: брокер внутри процесса, для бенчмарков и тестов без RabbitMQ
+    BROKER_BACKEND: str         = os.getenv("BROKER_BACKEND", "rabbitmq")
+    # кодек тел AMQP-сообщений: orjson (JSON), json (stdlib) или msgpack
+    MESSAGE_CODEC: str          = os.getenv("MESSAGE_CODEC", "orjson")
+
+    PAYMENTS_BASE: str              = os.getenv("PAYMENTS_BASE", "http://payments-service:8000")
+    # одиночные резервы POST /orders склеиваются в POST /accounts/holds:batch
+    HOLD_COALESCE_ENABLED: bool     = os.getenv("HOLD_COALESCE_ENABLED", "false").lower() == "true"
+    HOLD_COALESCE_LINGER_MS: int    = int(os.getenv("HOLD_COALESCE_LINGER_MS", "2"))
+    HOLD_COALESCE_MAX_BATCH: int    = int(os.getenv("HOLD_COALESCE_MAX_BATCH", "100"))
 
     OUTBOX_POLL_INTERVAL: int       = int(os.getenv("OUTBOX_POLL_INTERVAL", "1"))
+    OUTBOX_NOTIFY_ENABLED: bool     = os.getenv("OUTBOX_NOTIFY_ENABLED", "true").lower() == "true"
+    OUTBOX_BATCH_SIZE: int          = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))
+    OUTBOX_PUBLISH_WINDOW: int      = int(os.getenv("OUTBOX_PUBLISH_WINDOW", "50"))
+    OUTBOX_PUBLISH_RETRIES: int     = int(os.getenv("OUTBOX_PUBLISH_RETRIES", "2"))
     RESULT_CONSUMER_PREFETCH: int   = int(os.getenv("RESULT_CONSUMER_PREFETCH", "10"))
+    RESULT_BATCH_SIZE: int          = int(os.getenv("RESULT_BATCH_SIZE", "50"))
+    RESULT_BATCH_LINGER_MS: int     = int(os.getenv("RESULT_BATCH_LINGER_MS", "20"))
+
+    ORDERS_PAGE_SIZE: int           = int(os.getenv("ORDERS_PAGE_SIZE", "50"))
+    ORDERS_PAGE_SIZE_MAX: int       = int(os.getenv("ORDERS_PAGE_SIZE_MAX", "500"))
+    EXPORT_CHUNK_SIZE: int          = int(os.getenv("EXPORT_CHUNK_SIZE", "1000"))
+
+    # подписка на статус заказа (SSE / long-poll)
+    ORDER_EVENTS_TIMEOUT: int       = int(os.getenv("ORDER_EVENTS_TIMEOUT", "300"))
+    ORDER_EVENTS_HEARTBEAT: int     = int(os.getenv("ORDER_EVENTS_HEARTBEAT", "15"))
+    ORDER_WAIT_TIMEOUT_MAX: int     = int(os.getenv("ORDER_WAIT_TIMEOUT_MAX", "60"))
+
+    RETENTION_INTERVAL: int         = int(os.getenv("RETENTION_INTERVAL", "300"))
+    RETENTION_BATCH_SIZE: int       = int(os.getenv("RETENTION_BATCH_SIZE", "1000"))
+    OUTBOX_RETENTION_HOURS: int     = int(os.getenv("OUTBOX_RETENTION_HOURS", "168"))
+    OUTBOX_ARCHIVE_ENABLED: bool    = os.getenv("OUTBOX_ARCHIVE_ENABLED", "false").lower() == "true"
+
+    # ответы на запросы с Idempotency-Key хранятся IDEMPOTENCY_TTL_HOURS; незавершённый
+    # запрос держит ключ IDEMPOTENCY_LOCK_SECONDS, потом ретрай может выполнить его заново
+    IDEMPOTENCY_TTL_HOURS: int      = int(os.getenv("IDEMPOTENCY_TTL_HOURS", "24"))
+    IDEMPOTENCY_LOCK_SECONDS: int   = int(os.getenv("IDEMPOTENCY_LOCK_SECONDS", "60"))
+
+    CACHE_ENABLED: bool             = os.getenv("CACHE_ENABLED", "true").lower() == "true"
+    CACHE_BACKEND: str              = os.getenv("CACHE_BACKEND", "memory")
+    CACHE_TTL_SECONDS: float        = float(os.getenv("CACHE_TTL_SECONDS", "30"))
+    CACHE_MAX_ENTRIES: int          = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+    CACHE_MAX_BYTES: int            = int(os.getenv("CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+    CACHE_REDIS_URL: str            = os.getenv("CACHE_REDIS_URL", "redis://redis:6379/0")
+
+    # логи пишутся в stdout из фонового потока через очередь на LOG_QUEUE_SIZE записей
+    LOG_LEVEL: str                  = os.getenv("LOG_LEVEL", "INFO")
+    # JSON вида {"orders.workers": "DEBUG", "uvicorn.access": "WARNING"} - уровни отдельных логгеров
+    LOG_LEVELS: dict[str, str]      = json.loads(os.getenv("LOG_LEVELS", "{}"))
+    LOG_FORMAT: str                 = os.getenv("LOG_FORMAT", "text")
+    LOG_QUEUE_SIZE: int             = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+    # доля записей, проходящих через логгеры событий на каждое сообщение
+    LOG_SAMPLE_RATE: float          = float(os.getenv("LOG_SAMPLE_RATE", "0.01"))
+    SQL_ECHO: bool                  = os.getenv("SQL_ECHO", "false").lower() == "true"
+
+    # трассировка: none, memory (GET /traces/{trace_id}), file (NDJSON в TRACE_FILE) или "module:Class"
+    TRACE_EXPORTER: str             = os.getenv("TRACE_EXPORTER", "none")
+    TRACE_SAMPLE_RATE: float        = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))
+    TRACE_FILE: str                 = os.getenv("TRACE_FILE", "traces.ndjson")
+    TRACE_MEMORY_SPANS: int         = int(os.getenv("TRACE_MEMORY_SPANS", "10000"))
 
 settings = Settings()
@@ -1,10 +1,16 @@
-from typing import List
+import base64
+from datetime import datetime, timedelta
+from typing import List, Mapping, Sequence, Tuple
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
-from sqlalchemy import update, func
-from app.models import Order, OrdersOutbox
+from sqlalchemy.sql import Select
+from sqlalchemy import update, delete, insert, case, func, tuple_
+from app.models import IdempotencyKey, Order, OrdersOutbox, OrdersOutboxArchive
 from app.schemas import OrderCreate
-from uuid import UUID
+from app.tracing import outbox_fields
+from uuid import UUID, uuid4
+
+FINAL_STATUSES = ("FINISHED", "CANCELLED")
 
 async def create_order(
     order_in: OrderCreate,
@@ -15,19 +21,21 @@ async def create_order(
     """
     # добавляем запись в таблицу orders
     order = Order(
+        id=order_in.order_id or uuid4(),
         user_id=order_in.user_id,
         amount=order_in.amount,
         description=order_in.description,
         status="NEW"
     )
     session.add(order)
-    await session.flush()  # чтобы получить order.id
+    await session.flush()
 
     # добавляем запись в orders_outbox
     payload = {
         "order_id": str(order.id),
         "user_id": str(order.user_id),
-        "amount": float(order.amount)
+        "amount": float(order.amount),
+        **outbox_fields(),
     }
     outbox_rec = OrdersOutbox(
         aggregate_id=order.id,
@@ -40,15 +48,119 @@ async def create_order(
     await session.refresh(order)
     return order
 
-async def get_orders_by_user(
+async def create_orders(
     user_id: UUID,
+    orders_in: Sequence[Tuple[UUID, float, str | None]],
     session: AsyncSession
 ) -> List[Order]:
     """
-    Возвращает список заказов для данного user_id.
+    Пакетная версия create_order: заказы (order_id, amount, description)
+    и их события outbox вставляются двумя многострочными INSERT в одной
+    транзакции. id заказов задаёт вызывающий - это order_id резервов в Payments.
     """
-    result = await session.execute(select(Order).where(Order.user_id == user_id))
-    return result.scalars().all()
+    if not orders_in:
+        return []
+    result = await session.execute(
+        insert(Order)
+        .values([
+            {"id": order_id, "user_id": user_id, "amount": amount, "description": description, "status": "NEW"}
+            for order_id, amount, description in orders_in
+        ])
+        .returning(Order)
+    )
+    orders = list(result.scalars().all())
+    trace = outbox_fields()
+    await session.execute(
+        insert(OrdersOutbox).values([
+            {
+                "id": uuid4(),
+                "aggregate_id": order.id,
+                "event_type": "payment_requested",
+                "payload": {"order_id": str(order.id), "user_id": str(order.user_id), "amount": float(order.amount), **trace},
+            }
+            for order in orders
+        ])
+    )
+    await session.commit()
+    return orders
+
+def encode_cursor(order: Order) -> str:
+    raw = f"{order.created_at.isoformat()}|{order.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor: str) -> Tuple[datetime, UUID]:
+    """
+    Разбирает курсор из encode_cursor. ValueError, если курсор битый.
+    """
+    try:
+        created_at, order_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), UUID(order_id)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+
+def _filter_orders(
+    query: Select,
+    statuses: Sequence[str] | None,
+    created_from: datetime | None,
+    created_to: datetime | None,
+) -> Select:
+    if statuses:
+        query = query.where(Order.status.in_(statuses))
+    if created_from is not None:
+        query = query.where(Order.created_at >= created_from)
+    if created_to is not None:
+        query = query.where(Order.created_at < created_to)
+    return query
+
+async def list_orders(
+    user_id: UUID,
+    limit: int,
+    session: AsyncSession,
+    cursor: str | None = None,
+    statuses: Sequence[str] | None = None,
+    created_from: datetime | None = None,
+    created_to: datetime | None = None,
+) -> Tuple[List[Order], str | None]:
+    """
+    Страница заказов пользователя от новых к старым с keyset-пагинацией
+    по (created_at, id): следующая страница начинается строго после
+    последней строки предыдущей, без OFFSET. Читается по индексу
+    ix_orders_user_created.
+    Возвращает (заказы, курсор следующей страницы или None).
+    """
+    query = _filter_orders(select(Order).where(Order.user_id == user_id), statuses, created_from, created_to)
+    if cursor is not None:
+        created_at, order_id = decode_cursor(cursor)
+        query = query.where(tuple_(Order.created_at, Order.id) < tuple_(created_at, order_id))
+
+    # лишняя строка показывает, есть ли следующая страница
+    result = await session.execute(
+        query.order_by(Order.created_at.desc(), Order.id.desc()).limit(limit + 1)
+    )
+    orders = list(result.scalars().all())
+    if len(orders) <= limit:
+        return orders, None
+    orders = orders[:limit]
+    return orders, encode_cursor(orders[-1])
+
+ORDER_EXPORT_COLUMNS = ("id", "user_id", "amount", "description", "status", "created_at", "updated_at")
+
+def export_orders_query(
+    user_id: UUID | None = None,
+    statuses: Sequence[str] | None = None,
+    created_from: datetime | None = None,
+    created_to: datetime | None = None,
+) -> Select:
+    """
+    Запрос для выгрузки заказов (всех или одного пользователя) в порядке
+    создания. Выбираются только колонки, без ORM-объектов: строки
+    уходят в поток и не попадают в identity map сессии.
+    """
+    query = select(*(getattr(Order, column) for column in ORDER_EXPORT_COLUMNS))
+    if user_id is not None:
+        query = query.where(Order.user_id == user_id)
+    query = _filter_orders(query, statuses, created_from, created_to)
+    return query.order_by(Order.created_at, Order.id)
 
 async def get_order(
     order_id: UUID,
@@ -76,4 +188,116 @@ async def update_order_status(
         .where(Order.id == order_id)
         .values(status=new_status, updated_at=func.now())
     )
-    await session.commit()
\ No newline at end of file
+    await session.commit()
+
+async def apply_payment_results(
+    results: Mapping[UUID, str],
+    session: AsyncSession
+) -> List[Tuple[UUID, UUID, str, float]]:
+    """
+    Применяет пачку переходов {order_id: new_status} одним UPDATE ... CASE.
+    Заказы, уже находящиеся в финальном статусе, не трогаются.
+    Возвращает (id, user_id, status, секунды от создания заказа) реально
+    обновлённых заказов (без commit).
+    """
+    if not results:
+        return []
+    result = await session.execute(
+        update(Order)
+        .where(Order.id.in_(list(results)), Order.status.notin_(FINAL_STATUSES))
+        .values(status=case(dict(results), value=Order.id), updated_at=func.now())
+        .returning(Order.id, Order.user_id, Order.status, func.extract("epoch", func.now() - Order.created_at))
+        .execution_options(synchronize_session=False)
+    )
+    return [(order_id, user_id, status, float(age)) for order_id, user_id, status, age in result.all()]
+
+async def claim_outbox_batch(
+    limit: int,
+    session: AsyncSession
+) -> List[OrdersOutbox]:
+    """
+    Забирает пачку неопубликованных событий outbox в порядке создания.
+    Строки, уже заблокированные другой репликой, пропускаются (SKIP LOCKED),
+    поэтому несколько publisher'ов разбирают outbox параллельно без дублей.
+    Блокировка держится до commit/rollback сессии.
+    """
+    result = await session.execute(
+        select(OrdersOutbox)
+        .where(OrdersOutbox.published_at.is_(None))
+        .order_by(OrdersOutbox.created_at, OrdersOutbox.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    return result.scalars().all()
+
+async def outbox_backlog(session: AsyncSession) -> Tuple[int, float]:
+    """
+    Размер неопубликованного хвоста outbox и возраст самого старого события
+    в секундах (0, если хвост пуст). Читается по частичному индексу pending.
+    """
+    count, age = (await session.execute(
+        select(func.count(), func.extract("epoch", func.now() - func.min(OrdersOutbox.created_at)))
+        .where(OrdersOutbox.published_at.is_(None))
+    )).one()
+    return count, float(age or 0)
+
+async def mark_outbox_published(
+    event_ids: Sequence[UUID],
+    session: AsyncSession
+) -> None:
+    """
+    Помечает события опубликованными одним UPDATE (без commit).
+    """
+    await session.execute(
+        update(OrdersOutbox)
+        .where(OrdersOutbox.id.in_(event_ids))
+        .values(published_at=func.now())
+        .execution_options(synchronize_session=False)
+    )
+
+async def prune_published_outbox(
+    older_than: timedelta,
+    limit: int,
+    archive: bool,
+    session: AsyncSession
+) -> int:
+    """
+    Удаляет до limit опубликованных событий старше older_than (без commit).
+    При archive=True строки переносятся в orders_outbox_archive тем же запросом.
+    Возвращает число обработанных строк.
+    """
+    doomed = (
+        select(OrdersOutbox.id)
+        .where(OrdersOutbox.published_at < func.now() - older_than)
+        .order_by(OrdersOutbox.published_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    stmt = delete(OrdersOutbox).where(OrdersOutbox.id.in_(doomed.scalar_subquery()))
+    if archive:
+        columns = [c.name for c in OrdersOutbox.__table__.columns]
+        moved = stmt.returning(*OrdersOutbox.__table__.columns).cte("moved")
+        stmt = (
+            insert(OrdersOutboxArchive)
+            .from_select(columns, select(*moved.c))
+            .add_cte(moved)
+        )
+    result = await session.execute(stmt)
+    return result.rowcount
+
+async def prune_idempotency_keys(
+    limit: int,
+    session: AsyncSession
+) -> int:
+    """
+    Удаляет до limit просроченных ключей идемпотентности (без commit).
+    """
+    doomed = (
+        select(IdempotencyKey.key)
+        .where(IdempotencyKey.expires_at < func.now())
+        .order_by(IdempotencyKey.expires_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    result = await session.execute(delete(IdempotencyKey).where(IdempotencyKey.key.in_(doomed.scalar_subquery())))
+    return result.rowcount
@@ -14,7 +14,7 @@ DATABASE_URL = (
 
 engine = create_async_engine(
     DATABASE_URL,
-    echo=True,
+    echo=settings.SQL_ECHO,
     future=True
 )
 
@@ -26,6 +26,12 @@ AsyncSessionLocal = sessionmaker(
 
 Base = declarative_base()
 
+def ensure_indexes(sync_conn) -> None:
+    # create_all не добавляет новые индексы к уже существующим таблицам
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+
 async def get_session() -> AsyncGenerator[AsyncSession, None]:
     async_session = AsyncSessionLocal()
     try:
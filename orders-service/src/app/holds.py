@@ -0,0 +1,104 @@
+import asyncio
+import logging
+from uuid import UUID
+import httpx
+from app.config import settings
+from app.tracing import SpanContext, current_context, inject, span
+
+logger = logging.getLogger("orders.holds")
+
+
+class HoldCoalescer:
+    """
+    Склеивает одиночные резервы параллельных POST /orders в один запрос
+    POST /accounts/holds:batch к Payments. Первый резерв открывает окно
+    linger; пачка уходит по его истечении или как только набралось
+    max_batch резервов. Каждый вызывающий получает результат своего резерва.
+    """
+
+    def __init__(self, base_url: str, linger: float, max_batch: int):
+        self.base_url = base_url
+        self.linger = linger
+        self.max_batch = max_batch
+        self._client: httpx.AsyncClient | None = None
+        self._pending: list[tuple[dict, asyncio.Future, SpanContext | None]] = []
+        self._timer: asyncio.Task | None = None
+        self._sending: set[asyncio.Task] = set()
+
+    async def start(self) -> None:
+        self._client = httpx.AsyncClient(base_url=self.base_url, timeout=10)
+
+    async def close(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._pending:
+            await self._send(self._take())
+        if self._sending:
+            await asyncio.gather(*self._sending, return_exceptions=True)
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def hold(self, order_id: UUID, user_id: UUID, amount: float) -> str | None:
+        """
+        Резервирует amount под order_id. None - зарезервировано,
+        иначе причина отказа от Payments (insufficient_funds, no_account, ...).
+        """
+        if self._client is None:
+            await self.start()
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append(({"order_id": str(order_id), "user_id": str(user_id), "amount": amount}, future, current_context()))
+        if len(self._pending) >= self.max_batch:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._dispatch(self._take())
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+        with span("payments.hold", order_id=str(order_id), coalesced=True):
+            return await future
+
+    def _take(self) -> list[tuple[dict, asyncio.Future, SpanContext | None]]:
+        batch, self._pending = self._pending, []
+        return batch
+
+    def _dispatch(self, batch: list[tuple[dict, asyncio.Future, SpanContext | None]]) -> None:
+        # отправки отслеживаются в _sending, close() дожидается их
+        task = asyncio.create_task(self._send(batch))
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.linger)
+        self._timer = None
+        self._dispatch(self._take())
+
+    async def _send(self, batch: list[tuple[dict, asyncio.Future, SpanContext | None]]) -> None:
+        # у пачки свой trace; trace'ы заказов, попавших в неё, привязаны ссылками
+        try:
+            with span("payments.holds_batch", parent=None, links=[ctx for _, _, ctx in batch], holds=len(batch)):
+                resp = await self._client.post(
+                    "/accounts/holds:batch",
+                    json={"holds": [item for item, _, _ in batch]},
+                    headers=inject({}),
+                )
+            resp.raise_for_status()
+            results = resp.json()["results"]
+        except Exception as e:
+            logger.error("[Orders] Batched hold of %d orders failed: %s", len(batch), e)
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, future, _), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result["reason"])
+
+
+hold_coalescer = HoldCoalescer(
+    settings.PAYMENTS_BASE,
+    settings.HOLD_COALESCE_LINGER_MS / 1000,
+    settings.HOLD_COALESCE_MAX_BATCH,
+)
@@ -0,0 +1,42 @@
+import asyncio
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Iterator
+from uuid import UUID
+
+
+class OrderStatusHub:
+    """
+    In-process fan-out переходов статуса заказа: result_consumer публикует
+    новый статус, подписчики (SSE / long-poll) ждут его на своей очереди
+    и не ходят в БД. Подписчики видят только переходы, обработанные этой репликой.
+    """
+
+    def __init__(self):
+        self._subscribers: dict[UUID, set[asyncio.Queue]] = defaultdict(set)
+
+    @contextmanager
+    def subscribe(self, order_id: UUID) -> Iterator[asyncio.Queue]:
+        queue: asyncio.Queue = asyncio.Queue()
+        self._subscribers[order_id].add(queue)
+        try:
+            yield queue
+        finally:
+            subscribers = self._subscribers.get(order_id)
+            if subscribers is not None:
+                subscribers.discard(queue)
+                if not subscribers:
+                    del self._subscribers[order_id]
+
+    def publish(self, order_id: UUID, status: str) -> None:
+        for queue in self._subscribers.get(order_id, ()):
+            queue.put_nowait(status)
+
+    def stats(self) -> dict:
+        return {
+            "orders": len(self._subscribers),
+            "subscribers": sum(len(queues) for queues in self._subscribers.values()),
+        }
+
+
+hub = OrderStatusHub()
@@ -1,44 +1,107 @@
 import asyncio
 import logging
 import httpx
-from fastapi import FastAPI, HTTPException, Depends, Query
+import json
+from datetime import datetime
+from typing import Literal
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Response
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
-from uuid import UUID, uuid4
+from uuid import UUID, NAMESPACE_OID, uuid4, uuid5
 from app import crud, schemas, workers
-from app.db import engine, Base, get_session
-from app.messaging import init_rabbit, close_rabbit
+from app.db import engine, Base, AsyncSessionLocal, get_session, ensure_indexes
+from app.messaging import init_broker, close_broker
+from app.notify import install_outbox_notify_trigger
+from app.cache import cache, order_key
+from app.hub import hub
+from app.idempotency import idempotent, IDEMPOTENCY_HEADER
+from app.holds import hold_coalescer
+from app.export import stream_export, EXPORT_MEDIA_TYPES
+from app.config import settings
+from app.logs import log_stats, setup_logging
+from app.metrics import MetricsMiddleware, CONTENT_TYPE, render, httpx_pool_collector, log_queue_collector, sqlalchemy_pool_collector
+from app.tracing import TracingMiddleware, MemoryExporter, close_exporter, exporter, inject, span
 import uvicorn
 
+setup_logging()
 logger = logging.getLogger(__name__)
 app = FastAPI(title="Orders Service")
-PAYMENTS_BASE = "http://payments-service:8000"
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
+sqlalchemy_pool_collector(engine)
+httpx_pool_collector("payments_holds", lambda: hold_coalescer._client)
+log_queue_collector(log_stats)
+PAYMENTS_BASE = settings.PAYMENTS_BASE
 
 @app.on_event("startup")
 async def startup_event():
     #Миграции
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(ensure_indexes)
+        await install_outbox_notify_trigger(conn)
 
     # RabbitMQ (кролика накормили кобальтом) (это мем из матстата)
-    await init_rabbit()
+    await init_broker()
+
+    # Payments
+    if settings.HOLD_COALESCE_ENABLED:
+        await hold_coalescer.start()
 
     # Воркеры
     app.state.outbox_task = asyncio.create_task(workers.outbox_publisher())
     app.state.result_consumer_task = asyncio.create_task(workers.result_consumer())
+    app.state.retention_task = asyncio.create_task(workers.retention_worker())
 
 @app.on_event("shutdown")
 async def shutdown_event():
     app.state.outbox_task.cancel()
     app.state.result_consumer_task.cancel()
-    await close_rabbit()
+    app.state.retention_task.cancel()
+    await hold_coalescer.close()
+    await close_broker()
+    close_exporter()
 
 
 @app.get("/orders", response_model=list[schemas.OrderRead])
 async def list_orders(
+    response: Response,
     user_id: UUID,
+    limit: int = Query(settings.ORDERS_PAGE_SIZE, ge=1, le=settings.ORDERS_PAGE_SIZE_MAX),
+    cursor: str | None = Query(None, description="X-Next-Cursor из предыдущей страницы"),
+    status: list[str] | None = Query(None),
+    created_from: datetime | None = Query(None),
+    created_to: datetime | None = Query(None),
     session: AsyncSession = Depends(get_session)
 ):
-    return await crud.get_orders_by_user(user_id, session)
+    try:
+        orders, next_cursor = await crud.list_orders(
+            user_id, limit, session,
+            cursor=cursor,
+            statuses=status,
+            created_from=created_from,
+            created_to=created_to,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return orders
+
+@app.get("/orders/export")
+async def export_orders(
+    user_id: UUID | None = None,
+    format: Literal["ndjson", "csv"] = "ndjson",
+    status: list[str] | None = Query(None),
+    created_from: datetime | None = Query(None),
+    created_to: datetime | None = Query(None),
+):
+    query = crud.export_orders_query(user_id, status, created_from, created_to)
+    return StreamingResponse(
+        stream_export(query, crud.ORDER_EXPORT_COLUMNS, format),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="orders.{format}"'},
+    )
 
 @app.get("/orders/{order_id}", response_model=schemas.OrderRead)
 async def get_order(
@@ -46,36 +109,178 @@ async def get_order(
     user_id: UUID,
     session: AsyncSession = Depends(get_session)
 ):
-    order = await crud.get_order(order_id, user_id, session)
-    if not order:
+    body = await _cached_order(order_id, user_id, session)
+    if body is None:
         raise HTTPException(status_code=404, detail="Order not found")
-    return order
+    return Response(content=body, media_type="application/json")
+
+async def _cached_order(order_id: UUID, user_id: UUID, session: AsyncSession) -> bytes | None:
+    async def load() -> bytes | None:
+        order = await crud.get_order(order_id, user_id, session)
+        return schemas.OrderRead.model_validate(order, from_attributes=True).model_dump_json().encode() if order else None
+
+    return await cache.get_or_load(order_key(user_id, order_id), load)
+
+async def _current_status(order_id: UUID, user_id: UUID) -> str | None:
+    # вызывается уже после hub.subscribe: переход, закоммиченный после чтения,
+    # придёт в очередь, потому что publish идёт после инвалидации кэша
+    async with AsyncSessionLocal() as session:
+        body = await _cached_order(order_id, user_id, session)
+    return json.loads(body)["status"] if body is not None else None
+
+def _sse(order_id: UUID, status: str) -> str:
+    return f"event: status\ndata: {json.dumps({'order_id': str(order_id), 'status': status})}\n\n"
+
+@app.get("/orders/{order_id}/events")
+async def order_events(order_id: UUID, user_id: UUID):
+    # текущий статус сразу, затем каждый переход из result_consumer; поток закрывается
+    # на финальном статусе или через ORDER_EVENTS_TIMEOUT, между событиями - keepalive
+    async def events():
+        with hub.subscribe(order_id) as queue:
+            status = await _current_status(order_id, user_id)
+            if status is None:
+                yield "event: error\ndata: {\"detail\": \"Order not found\"}\n\n"
+                return
+            yield _sse(order_id, status)
+
+            deadline = asyncio.get_running_loop().time() + settings.ORDER_EVENTS_TIMEOUT
+            while status not in crud.FINAL_STATUSES:
+                remaining = deadline - asyncio.get_running_loop().time()
+                if remaining <= 0:
+                    return
+                try:
+                    status = await asyncio.wait_for(queue.get(), min(remaining, settings.ORDER_EVENTS_HEARTBEAT))
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield _sse(order_id, status)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/orders/{order_id}/wait")
+async def wait_order_status(
+    order_id: UUID,
+    user_id: UUID,
+    known_status: str | None = Query(None, description="Статус, который клиент уже видел"),
+    timeout: float = Query(30, gt=0),
+):
+    # long-poll: ответ сразу, если статус уже не known_status или финальный,
+    # иначе ждём перехода не дольше timeout
+    with hub.subscribe(order_id) as queue:
+        status = await _current_status(order_id, user_id)
+        if status is None:
+            raise HTTPException(status_code=404, detail="Order not found")
+        if status == known_status and status not in crud.FINAL_STATUSES:
+            try:
+                status = await asyncio.wait_for(queue.get(), min(timeout, settings.ORDER_WAIT_TIMEOUT_MAX))
+            except asyncio.TimeoutError:
+                pass
+    return {"order_id": order_id, "status": status, "changed": status != known_status}
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return cache.stats()
+
+@app.get("/hub/stats")
+async def hub_stats():
+    return hub.stats()
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return Response(await render(), media_type=CONTENT_TYPE)
+
+@app.get("/traces/{trace_id}")
+async def get_trace(trace_id: str):
+    if not isinstance(exporter, MemoryExporter):
+        raise HTTPException(404, "In-memory trace exporter is not enabled (TRACE_EXPORTER=memory)")
+    return exporter.find(trace_id)
 
 
 @app.post("/orders", response_model=schemas.OrderRead)
 async def create_order(
     order_in: schemas.OrderCreateRequest,
     user_id: UUID = Query(...),
+    idempotency_key: str | None = Header(None, alias=IDEMPOTENCY_HEADER),
     session: AsyncSession = Depends(get_session)
 ):
-    async with httpx.AsyncClient() as client:
-        resp = await client.post(
-            f"{PAYMENTS_BASE}/accounts/{user_id}/hold",
-            json={"order_id": str(uuid_order := uuid4()), "amount": order_in.amount}
-        )
-    if resp.status_code == 400:
-        raise HTTPException(400, "Insufficient funds")
-    resp.raise_for_status()
-    new_order = await crud.create_order(
-        schemas.OrderCreate(order_id=uuid_order,
-                             user_id=user_id,
-                             amount=order_in.amount,
-                             description=order_in.description),
-        session
-    )
-    return new_order
+    async def handler():
+        # с ключом id резерва детерминирован, и ретрай попадёт в тот же hold в Payments
+        uuid_order = uuid5(NAMESPACE_OID, f"{user_id}:{idempotency_key}") if idempotency_key else uuid4()
+        if settings.HOLD_COALESCE_ENABLED and not idempotency_key:
+            # резерв уходит в Payments пачкой вместе с параллельными заказами
+            if await hold_coalescer.hold(uuid_order, user_id, order_in.amount) is not None:
+                raise HTTPException(400, "Insufficient funds")
+        else:
+            headers = {IDEMPOTENCY_HEADER: idempotency_key} if idempotency_key else {}
+            with span("payments.hold", order_id=str(uuid_order)):
+                async with httpx.AsyncClient() as client:
+                    resp = await client.post(
+                        f"{PAYMENTS_BASE}/accounts/{user_id}/hold",
+                        json={"order_id": str(uuid_order), "amount": order_in.amount},
+                        headers=inject(headers)
+                    )
+            if resp.status_code == 400:
+                raise HTTPException(400, "Insufficient funds")
+            resp.raise_for_status()
+        with span("db.create_order", order_id=str(uuid_order)):
+            new_order = await crud.create_order(
+                schemas.OrderCreate(order_id=uuid_order,
+                                     user_id=user_id,
+                                     amount=order_in.amount,
+                                     description=order_in.description),
+                session
+            )
+        return schemas.OrderRead.model_validate(new_order, from_attributes=True)
+
+    return await idempotent(idempotency_key, f"create_order:{user_id}", order_in, handler)
+
+
+@app.post("/orders:batch", response_model=schemas.OrderBatchResponse)
+async def create_orders_batch(
+    req: schemas.OrderBatchRequest,
+    user_id: UUID = Query(...),
+    idempotency_key: str | None = Header(None, alias=IDEMPOTENCY_HEADER),
+    session: AsyncSession = Depends(get_session)
+):
+    async def handler():
+        order_ids = [
+            uuid5(NAMESPACE_OID, f"{user_id}:{idempotency_key}:{i}") if idempotency_key else uuid4()
+            for i in range(len(req.orders))
+        ]
+        headers = {IDEMPOTENCY_HEADER: idempotency_key} if idempotency_key else {}
+        # один запрос на все резервы; деньги резервируются по порядку, пока хватает
+        with span("payments.holds_batch", orders=len(order_ids)):
+            async with httpx.AsyncClient() as client:
+                resp = await client.post(
+                    f"{PAYMENTS_BASE}/accounts/{user_id}/holds:batch",
+                    json={"holds": [{"order_id": str(order_id), "amount": o.amount} for order_id, o in zip(order_ids, req.orders)]},
+                    headers=inject(headers)
+                )
+        if resp.status_code == 404:
+            raise HTTPException(404, "Account not found")
+        resp.raise_for_status()
+        holds = resp.json()["results"]
+
+        held = [
+            (order_id, o.amount, o.description)
+            for order_id, o, hold in zip(order_ids, req.orders, holds)
+            if hold["status"] == "held"
+        ]
+        with span("db.create_orders", orders=len(held)):
+            created = {order.id: order for order in await crud.create_orders(user_id, held, session)}
+        return schemas.OrderBatchResponse(results=[
+            schemas.OrderBatchResult(status="created", order=schemas.OrderRead.model_validate(created[order_id], from_attributes=True))
+            if order_id in created else
+            schemas.OrderBatchResult(status="rejected", reason=hold["reason"])
+            for order_id, hold in zip(order_ids, holds)
+        ])
+
+    return await idempotent(idempotency_key, f"create_orders_batch:{user_id}", req, handler)
 
 
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO)
     uvicorn.run("app.main:app", host="0.0.0.0", port=8000)
@@ -1,10 +1,14 @@
 import uuid
-from sqlalchemy import Column, String, DECIMAL, TIMESTAMP, func
+from sqlalchemy import Column, Integer, LargeBinary, String, DECIMAL, TIMESTAMP, Index, func, text
 from sqlalchemy.dialects.postgresql import UUID as PG_UUID, JSONB
 from app.db import Base
 
 class Order(Base):
     __tablename__ = "orders"
+    __table_args__ = (
+        # листинг заказов пользователя идёт по ключу (created_at, id), см. crud.list_orders
+        Index("ix_orders_user_created", "user_id", "created_at", "id"),
+    )
 
     id = Column(PG_UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     user_id = Column(PG_UUID(as_uuid=True), nullable=False)
@@ -16,6 +20,11 @@ class Order(Base):
 
 class OrdersOutbox(Base):
     __tablename__ = "orders_outbox"
+    __table_args__ = (
+        # выборка publisher'а видит только неопубликованный хвост, а не всю историю
+        Index("ix_orders_outbox_pending", "created_at", "id", postgresql_where=text("published_at IS NULL")),
+        Index("ix_orders_outbox_published_at", "published_at", postgresql_where=text("published_at IS NOT NULL")),
+    )
 
     id = Column(PG_UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     aggregate_id = Column(PG_UUID(as_uuid=True), nullable=False)
@@ -23,3 +32,27 @@ class OrdersOutbox(Base):
     payload = Column(JSONB, nullable=False)
     created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
     published_at = Column(TIMESTAMP(timezone=True), nullable=True)
+
+class OrdersOutboxArchive(Base):
+    __tablename__ = "orders_outbox_archive"
+
+    id = Column(PG_UUID(as_uuid=True), primary_key=True)
+    aggregate_id = Column(PG_UUID(as_uuid=True), nullable=False)
+    event_type = Column(String(50), nullable=False)
+    payload = Column(JSONB, nullable=False)
+    created_at = Column(TIMESTAMP(timezone=True))
+    published_at = Column(TIMESTAMP(timezone=True))
+    archived_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (
+        Index("ix_idempotency_keys_expires_at", "expires_at"),
+    )
+
+    key = Column(String(300), primary_key=True)       # "<scope>:<Idempotency-Key>"
+    fingerprint = Column(String(64), nullable=False)  # sha256 параметров запроса
+    status_code = Column(Integer, nullable=True)      # NULL - запрос ещё выполняется
+    response = Column(LargeBinary, nullable=True)
+    created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
+    expires_at = Column(TIMESTAMP(timezone=True), nullable=False)
@@ -12,6 +12,8 @@ class OrderCreateRequest(BaseModel):
     description: Optional[str] = Field(None, description="Описание заказа")
 
 class OrderCreate(BaseModel):
+    # id заказа = order_id резерва в Payments; без него генерируется новый
+    order_id: Optional[UUID] = None
     user_id: UUID
     amount: float = Field(..., gt=0)
     description: Optional[str]
@@ -29,7 +31,24 @@ class OrderRead(BaseModel):
         orm_mode = True
 
 
+class OrderBatchRequest(BaseModel):
+    orders: List[OrderCreateRequest] = Field(..., min_length=1, max_length=1000)
+
+class OrderBatchResult(BaseModel):
+    status: str  # created | rejected
+    reason: Optional[str] = None
+    order: Optional[OrderRead] = None
+
+class OrderBatchResponse(BaseModel):
+    results: List[OrderBatchResult]
+
+
 class PaymentRequestEvent(BaseModel):
     order_id: UUID
     user_id: UUID
     amount: float
+
+class PaymentResultEvent(BaseModel):
+    order_id: UUID
+    result: str
+    reason: Optional[str] = None
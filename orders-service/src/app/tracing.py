@@ -0,0 +1,247 @@
+import importlib
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Mapping
+from app.config import settings
+
+logger = logging.getLogger("orders.tracing")
+
+SERVICE_NAME = "orders"
+TRACEPARENT_HEADER = "traceparent"
+
+
+class SpanContext:
+    __slots__ = ("trace_id", "span_id", "sampled")
+
+    def __init__(self, trace_id: str, span_id: str, sampled: bool):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.sampled = sampled
+
+    @property
+    def traceparent(self) -> str:
+        # W3C Trace Context: version-trace_id-parent_id-flags
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+
+def parse_traceparent(value: str | None) -> SpanContext | None:
+    if not value:
+        return None
+    parts = value.strip().split("-")
+    if len(parts) < 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        flags = int(parts[3], 16)
+        int(parts[1], 16), int(parts[2], 16)
+    except ValueError:
+        return None
+    return SpanContext(parts[1], parts[2], bool(flags & 1))
+
+
+_current: ContextVar[SpanContext | None] = ContextVar("orders_trace_context", default=None)
+_INHERIT = object()
+
+
+class Span:
+    __slots__ = ("context", "parent_id", "name", "start", "attributes", "links", "status")
+
+    def __init__(self, name: str, context: SpanContext, parent_id: str | None, links, attributes: dict):
+        self.name = name
+        self.context = context
+        self.parent_id = parent_id
+        self.links = [link for link in links if link is not None]
+        self.attributes = attributes
+        self.start = time.time()
+        self.status = "ok"
+
+    def set(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def as_dict(self, end: float) -> dict:
+        return {
+            "trace_id": self.context.trace_id,
+            "span_id": self.context.span_id,
+            "parent_id": self.parent_id,
+            "service": SERVICE_NAME,
+            "name": self.name,
+            "start": self.start,
+            "duration_ms": round((end - self.start) * 1000, 3),
+            "status": self.status,
+            "attributes": self.attributes,
+            "links": [{"trace_id": link.trace_id, "span_id": link.span_id} for link in self.links],
+        }
+
+
+class MemoryExporter:
+    """Последние TRACE_MEMORY_SPANS спанов в памяти процесса, отдаются через GET /traces/{trace_id}."""
+
+    def __init__(self, limit: int):
+        self.spans: deque[dict] = deque(maxlen=limit)
+
+    def export(self, span: dict) -> None:
+        self.spans.append(span)
+
+    def find(self, trace_id: str) -> list[dict]:
+        return sorted((s for s in self.spans if s["trace_id"] == trace_id), key=lambda s: s["start"])
+
+    def close(self) -> None:
+        pass
+
+
+class FileExporter:
+    """
+    Дописывает спаны NDJSON-строками в TRACE_FILE для разбора офлайн.
+    Запись идёт из фонового потока, export только кладёт спан в очередь.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._write, name="trace-exporter", daemon=True)
+        self._thread.start()
+
+    def export(self, span: dict) -> None:
+        self._queue.put(span)
+
+    def _write(self) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                span = self._queue.get()
+                if span is None:
+                    return
+                f.write(json.dumps(span, default=str, ensure_ascii=False) + "\n")
+                if self._queue.empty():
+                    f.flush()
+
+    def close(self) -> None:
+        self._queue.put(None)
+        self._thread.join(timeout=5)
+
+
+def build_exporter(name: str):
+    if name in ("", "none"):
+        return None
+    if name == "memory":
+        return MemoryExporter(settings.TRACE_MEMORY_SPANS)
+    if name == "file":
+        return FileExporter(settings.TRACE_FILE)
+    # свой экспортер: "package.module:ClassName", объект с export(span: dict) и close()
+    module, _, attr = name.partition(":")
+    try:
+        return getattr(importlib.import_module(module), attr)()
+    except (ImportError, AttributeError, ValueError) as e:
+        logger.warning("[Orders] Unknown TRACE_EXPORTER %r (%s), tracing disabled", name, e)
+        return None
+
+
+exporter = build_exporter(settings.TRACE_EXPORTER)
+
+
+def current_context() -> SpanContext | None:
+    return _current.get()
+
+@contextmanager
+def span(name: str, parent=_INHERIT, links=(), **attributes) -> Iterator[Span | None]:
+    """
+    Спан вокруг блока кода. Родитель - текущий спан контекста, либо явный
+    parent (SpanContext из заголовков/outbox, None - новый trace). Решение
+    о сэмплировании принимает корневой спан и наследуют все потомки.
+    С выключенной трассировкой (TRACE_EXPORTER=none) ничего не делает.
+    """
+    if exporter is None:
+        yield None
+        return
+
+    parent_ctx = _current.get() if parent is _INHERIT else parent
+    if parent_ctx is None:
+        context = SpanContext(os.urandom(16).hex(), os.urandom(8).hex(), random.random() < settings.TRACE_SAMPLE_RATE)
+    else:
+        context = SpanContext(parent_ctx.trace_id, os.urandom(8).hex(), parent_ctx.sampled)
+    current = Span(name, context, parent_ctx.span_id if parent_ctx else None, links, attributes)
+
+    token = _current.set(context)
+    try:
+        yield current
+    except BaseException as e:
+        current.status = "error"
+        current.attributes.setdefault("error", type(e).__name__)
+        raise
+    finally:
+        _current.reset(token)
+        if context.sampled:
+            exporter.export(current.as_dict(time.time()))
+
+def record(name: str, parent: SpanContext | None, start: float, end: float, **attributes) -> None:
+    # спан задним числом: например, обработка одного сообщения внутри общей пачки
+    if exporter is None or parent is None or not parent.sampled:
+        return
+    done = Span(name, SpanContext(parent.trace_id, os.urandom(8).hex(), True), parent.span_id, (), attributes)
+    done.start = start
+    exporter.export(done.as_dict(end))
+
+def inject(headers: dict) -> dict:
+    context = _current.get()
+    if context is not None:
+        headers[TRACEPARENT_HEADER] = context.traceparent
+    return headers
+
+def extract(headers: Mapping | None) -> SpanContext | None:
+    if not headers:
+        return None
+    value = headers.get(TRACEPARENT_HEADER)
+    if isinstance(value, bytes):
+        value = value.decode()
+    return parse_traceparent(value)
+
+def outbox_fields() -> dict:
+    # traceparent едет в payload outbox-записи, publisher переносит его в заголовки AMQP
+    context = _current.get()
+    return {TRACEPARENT_HEADER: context.traceparent} if context is not None else {}
+
+def close_exporter() -> None:
+    if exporter is not None:
+        exporter.close()
+
+
+class TracingMiddleware:
+    """
+    ASGI-middleware: серверный спан на каждый HTTP-запрос, продолжает trace
+    из входящего заголовка traceparent и отдаёт его в ответе.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or exporter is None:
+            return await self.app(scope, receive, send)
+
+        parent = None
+        for key, value in scope["headers"]:
+            if key == b"traceparent":
+                parent = parse_traceparent(value.decode("latin-1"))
+                break
+
+        with span(scope["method"], parent=parent) as server:
+            traceparent = server.context.traceparent.encode()
+
+            async def send_with_trace(message):
+                if message["type"] == "http.response.start":
+                    server.set("http.status_code", message["status"])
+                    message["headers"] = list(message.get("headers", [])) + [(b"traceparent", traceparent)]
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_trace)
+            finally:
+                route = getattr(scope.get("route"), "path", None) or scope["path"]
+                server.name = f"{scope['method']} {route}"
+                server.set("http.route", route)
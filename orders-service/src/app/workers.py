@@ -1,85 +1,279 @@
 import asyncio
-import json
 import logging
+import time
+from datetime import timedelta
+from uuid import UUID
 
-from aio_pika import Message, ExchangeType
+# брокер читается через модуль, чтобы бенчмарки могли подменить messaging.broker
+from app import messaging
 from app.messaging import (
-    get_channel,
-    PAYMENT_EXCHANGE,
+    PublishRejected,
     QUEUE_PAYMENT_REQUESTS,
     QUEUE_PAYMENT_RESULTS
 )
-from app.schemas import PaymentRequestEvent
-from app.crud import update_order_status
+from app.schemas import PaymentResultEvent
+from app.codec import UnsupportedContentType, codec, decode_model
+from app.crud import (
+    apply_payment_results,
+    claim_outbox_batch,
+    mark_outbox_published,
+    outbox_backlog,
+    prune_published_outbox,
+    prune_idempotency_keys
+)
 from app.db import get_session
-from app.models import OrdersOutbox, Order
-from sqlalchemy import select, func
+from app.cache import cache, order_key
+from app.hub import hub
 from app.config import settings
+from app.notify import OutboxNotifier
+from app.logs import sampled
+from app.metrics import Counter, Gauge, Histogram, collector
+from app.tracing import TRACEPARENT_HEADER, extract, inject, parse_traceparent, record, span
 
 logger = logging.getLogger("orders.workers")
+# записи на каждое сообщение/заказ проходят с долей LOG_SAMPLE_RATE
+message_logger = sampled("orders.workers.messages")
+
+OUTBOX_PUBLISHED = Counter("outbox_published_total", "События outbox, подтверждённые брокером")
+OUTBOX_NACKED = Counter("outbox_publish_nacked_total", "Публикации outbox, отклонённые брокером")
+OUTBOX_BATCH_DURATION = Histogram("outbox_publish_batch_seconds", "Время одной пачки outbox_publisher")
+OUTBOX_BACKLOG = Gauge("outbox_backlog", "Неопубликованные события outbox")
+OUTBOX_OLDEST_AGE = Gauge("outbox_oldest_unpublished_age_seconds", "Возраст самого старого неопубликованного события")
+CONSUMER_MESSAGES = Counter("consumer_messages_total", "Сообщения, обработанные консьюмером", ("consumer", "outcome"))
+CONSUMER_DURATION = Histogram("consumer_processing_seconds", "Время обработки пачки консьюмером", ("consumer",))
+ORDER_SAGA_DURATION = Histogram(
+    "order_saga_seconds", "Время от создания заказа до финального статуса", ("status",),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300),
+)
+
+@collector
+async def collect_outbox_backlog() -> None:
+    async for session in get_session():
+        count, age = await outbox_backlog(session)
+    OUTBOX_BACKLOG.set(count)
+    OUTBOX_OLDEST_AGE.set(age)
+
+async def publish_confirmed(events) -> list:
+    """
+    Публикует события конвейером: до OUTBOX_PUBLISH_WINDOW неподтверждённых
+    сообщений одновременно. Возвращает id событий, подтверждённых брокером (ack);
+    nack'нутые переотправляются до OUTBOX_PUBLISH_RETRIES раз, остальные остаются
+    в outbox до следующего sweep.
+    """
+    window = asyncio.Semaphore(settings.OUTBOX_PUBLISH_WINDOW)
+
+    async def publish(ev):
+        async with window:
+            message_logger.info("[Orders] Publishing payment request",
+                                extra={"event_id": ev.id, "order_id": ev.payload.get("order_id")})
+            # контекст trace'а едет в заголовках сообщения, а не в теле
+            payload = dict(ev.payload)
+            parent = parse_traceparent(payload.pop(TRACEPARENT_HEADER, None))
+            with span("amqp.publish", parent=parent, queue=QUEUE_PAYMENT_REQUESTS, order_id=payload.get("order_id")) as s:
+                if s is not None and ev.created_at is not None:
+                    s.set("outbox.wait_ms", round((s.start - ev.created_at.timestamp()) * 1000, 3))
+                try:
+                    await messaging.broker.publish(
+                        QUEUE_PAYMENT_REQUESTS, codec.dumps(payload), codec.content_type, inject({})
+                    )
+                except PublishRejected as e:
+                    logger.warning("[Orders] Broker nacked outbox event %s: %s", ev.id, e)
+                    OUTBOX_NACKED.inc()
+                    if s is not None:
+                        s.status = "error"
+                    return False
+            return True
+
+    confirmed = []
+    pending = list(events)
+    for _ in range(settings.OUTBOX_PUBLISH_RETRIES + 1):
+        results = await asyncio.gather(*(publish(ev) for ev in pending))
+        confirmed += [ev.id for ev, ok in zip(pending, results) if ok]
+        pending = [ev for ev, ok in zip(pending, results) if not ok]
+        if not pending:
+            break
+    return confirmed
+
+async def publish_outbox_batch() -> int:
+    """
+    Одна итерация publisher'а: забирает пачку событий (SKIP LOCKED),
+    публикует и помечает их одним UPDATE. Возвращает размер пачки.
+    """
+    async for session in get_session():
+        events = await claim_outbox_batch(settings.OUTBOX_BATCH_SIZE, session)
+        logger.debug("[Orders] Pending outbox events: %d", len(events))
+        if not events:
+            await session.rollback()
+            return 0
+
+        start = time.perf_counter()
+        confirmed = await publish_confirmed(events)
+
+        if confirmed:
+            await mark_outbox_published(confirmed, session)
+        await session.commit()
+        OUTBOX_PUBLISHED.inc(len(confirmed))
+        OUTBOX_BATCH_DURATION.observe(time.perf_counter() - start)
+        logger.info("[Orders] Outbox publish commit complete: %d/%d confirmed", len(confirmed), len(events))
+        return len(confirmed)
 
 async def outbox_publisher():
+    # OUTBOX_POLL_INTERVAL - только страховочный sweep, основной триггер - NOTIFY
     INTERVAL = settings.OUTBOX_POLL_INTERVAL
+    notifier = OutboxNotifier() if settings.OUTBOX_NOTIFY_ENABLED else None
+    if notifier:
+        await notifier.start()
 
-    while True:
-        async for session in get_session():
-            stmt = select(OrdersOutbox).where(OrdersOutbox.published_at.is_(None))
-            result = await session.execute(stmt)
-            events = result.scalars().all()
-            logger.info("[Orders] Pending outbox events: %d", len(events))
-
-            if events:
-                channel = await get_channel()
-                exchange = await channel.declare_exchange(
-                    PAYMENT_EXCHANGE, ExchangeType.DIRECT, durable=True
-                )
-
-                for ev in events:
-                    payload = ev.payload
-                    logger.info("[Orders] Publishing request: %s", payload)
-                    await exchange.publish(
-                        Message(body=json.dumps(payload).encode()),
-                        routing_key=QUEUE_PAYMENT_REQUESTS
-                    )
-                    ev.published_at = func.now()
-                    session.add(ev)
+    try:
+        while True:
+            # выгребаем backlog полными пачками, потом ждём новых событий
+            while await publish_outbox_batch() == settings.OUTBOX_BATCH_SIZE:
+                pass
 
+            if notifier:
+                await notifier.wait(INTERVAL)
+            else:
+                await asyncio.sleep(INTERVAL)
+    finally:
+        # при отмене на shutdown LISTEN-соединение иначе остаётся открытым
+        if notifier:
+            await notifier.close()
+
+async def collect_batch(buffer: asyncio.Queue, size: int, linger: float) -> list:
+    """
+    Ждёт первое сообщение, затем добирает пачку до size сообщений,
+    но не дольше linger секунд.
+    """
+    loop = asyncio.get_running_loop()
+    batch = [await buffer.get()]
+    deadline = loop.time() + linger
+    while len(batch) < size:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(buffer.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+    return batch
+
+async def process_result_batch(messages: list) -> None:
+    start = time.perf_counter()
+    started_at = time.time()
+    results: dict[UUID, str] = {}
+    traces = []
+    invalid = 0
+    unreadable = []
+    for message in messages:
+        try:
+            event = decode_model(PaymentResultEvent, message.body, message.content_type)
+        except UnsupportedContentType as e:
+            # один раз возвращаем в очередь - его может дочитать реплика с нужным кодеком;
+            # повторно доставленное отклоняется без requeue (уходит в DLX, если он настроен)
+            logger.error("[Orders] Cannot decode payment result (%s): %s",
+                         "rejecting" if message.redelivered else "requeueing", e)
+            unreadable.append(message)
+            continue
+        except Exception as e:
+            logger.error("[Orders] Invalid result format: %s", e)
+            invalid += 1
+            continue
+        message_logger.info("[Orders] Received payment result",
+                            extra={"order_id": event.order_id, "result": event.result})
+        traces.append((extract(message.headers), event.order_id))
+        # финальный статус не меняется, поэтому при дублях в пачке достаточно первого
+        results.setdefault(event.order_id, "FINISHED" if event.result == "success" else "CANCELLED")
+
+    if unreadable:
+        for message in unreadable:
+            await message.nack(requeue=not message.redelivered)
+            CONSUMER_MESSAGES.labels("result_consumer", "invalid" if message.redelivered else "requeued").inc()
+        # nack'нутые уже не входят в ack(multiple=True) ниже
+        messages = [m for m in messages if m not in unreadable]
+        if not messages:
+            await asyncio.sleep(1)
+            return
+
+    try:
+        updated = []
+        with span("db.apply_payment_results", parent=None, links=[ctx for ctx, _ in traces], results=len(results)):
+            async for session in get_session():
+                updated = await apply_payment_results(results, session)
                 await session.commit()
-                logger.info("[Orders] Outbox publish commit complete")
+    except Exception as e:
+        logger.error("[Orders] Failed to apply %d payment results: %s", len(results), e)
+        CONSUMER_MESSAGES.labels("result_consumer", "requeued").inc(len(messages) - invalid)
+        await messages[-1].nack(multiple=True, requeue=True)
+        await asyncio.sleep(1)
+        return
 
-        await asyncio.sleep(INTERVAL)
+    for order_id, user_id, status, saga_seconds in updated:
+        await cache.invalidate(order_key(user_id, order_id))
+        hub.publish(order_id, status)
+        ORDER_SAGA_DURATION.labels(status).observe(saga_seconds)
+        message_logger.info("[Orders] Order status updated", extra={"order_id": order_id, "status": status})
+    logger.info("[Orders] Applied payment results: %d updated, %d not found or already final",
+                len(updated), len(results) - len(updated))
+
+    # delivery tag'и на канале монотонны, все более ранние сообщения входят в эту пачку
+    await messages[-1].ack(multiple=True)
+    CONSUMER_MESSAGES.labels("result_consumer", "processed").inc(len(messages) - invalid)
+    CONSUMER_MESSAGES.labels("result_consumer", "invalid").inc(invalid)
+    CONSUMER_DURATION.labels("result_consumer").observe(time.perf_counter() - start)
+    finished_at = time.time()
+    for parent, order_id in traces:
+        record("result_consumer.apply", parent, started_at, finished_at, order_id=str(order_id), batch=len(messages))
 
 async def result_consumer():
-    channel = await get_channel()
-    queue = await channel.declare_queue(QUEUE_PAYMENT_RESULTS, durable=True)
-    await channel.set_qos(prefetch_count=settings.RESULT_CONSUMER_PREFETCH)
-
-    logger.info("[Orders] Starting result_consumer on '%s'", QUEUE_PAYMENT_RESULTS)
-    async with queue.iterator() as it:
-        async for message in it:
-            async with message.process():
-                body = message.body.decode()
-                logger.info("[Orders] Received result message: %s", body)
-                try:
-                    data = json.loads(body)
-                    order_id = data["order_id"]
-                    result   = data["result"]
-                except Exception as e:
-                    logger.error("[Orders] Invalid result format: %s", e)
-                    continue
-
-                new_status = "FINISHED" if result == "success" else "CANCELLED"
-                async for session in get_session():
-                    order = await session.get(Order, order_id)
-                    if not order:
-                        logger.warning("[Orders] Order %s not found", order_id)
-                        continue
-                    if order.status in ("FINISHED", "CANCELLED"):
-                        logger.info("[Orders] Order %s already final status %s", order_id, order.status)
-                        continue
-
-                    order.status = new_status
-                    order.updated_at = func.now()
-                    session.add(order)
-                    await session.commit()
-                    logger.info("[Orders] Order %s status updated to %s", order_id, new_status)
+    buffer: asyncio.Queue = asyncio.Queue()
+    consumer_tag = await messaging.broker.consume(
+        QUEUE_PAYMENT_RESULTS,
+        max(settings.RESULT_CONSUMER_PREFETCH, settings.RESULT_BATCH_SIZE),
+        buffer.put,
+    )
+
+    logger.info("[Orders] Starting result_consumer on '%s' (batch %d, linger %d ms, %s broker)",
+                QUEUE_PAYMENT_RESULTS, settings.RESULT_BATCH_SIZE, settings.RESULT_BATCH_LINGER_MS,
+                messaging.broker.backend)
+    try:
+        while True:
+            batch = await collect_batch(buffer, settings.RESULT_BATCH_SIZE, settings.RESULT_BATCH_LINGER_MS / 1000)
+            await process_result_batch(batch)
+    finally:
+        await messaging.broker.cancel(consumer_tag)
+
+async def run_retention() -> dict[str, int]:
+    """
+    Один проход retention: чистит опубликованный outbox и просроченные ключи
+    идемпотентности пачками по RETENTION_BATCH_SIZE, каждая пачка - отдельная
+    короткая транзакция.
+    """
+    older_than = timedelta(hours=settings.OUTBOX_RETENTION_HOURS)
+    pruned = {"orders_outbox": 0, "idempotency_keys": 0}
+    while True:
+        async for session in get_session():
+            n = await prune_published_outbox(
+                older_than, settings.RETENTION_BATCH_SIZE, settings.OUTBOX_ARCHIVE_ENABLED, session
+            )
+            await session.commit()
+        pruned["orders_outbox"] += n
+        if n < settings.RETENTION_BATCH_SIZE:
+            break
+
+    while True:
+        async for session in get_session():
+            n = await prune_idempotency_keys(settings.RETENTION_BATCH_SIZE, session)
+            await session.commit()
+        pruned["idempotency_keys"] += n
+        if n < settings.RETENTION_BATCH_SIZE:
+            return pruned
+
+async def retention_worker():
+    while True:
+        try:
+            pruned = await run_retention()
+            logger.info("[Orders] Retention run complete, pruned rows: %s (archive=%s)",
+                        pruned, settings.OUTBOX_ARCHIVE_ENABLED)
+        except Exception as e:
+            logger.error("[Orders] Retention run failed: %s", e)
+        await asyncio.sleep(settings.RETENTION_INTERVAL)
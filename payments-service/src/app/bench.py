@@ -0,0 +1,242 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import time
+import tracemalloc
+import uuid
+from decimal import Decimal
+from typing import Awaitable, Callable
+from sqlalchemy import event, text
+from app import crud, messaging, workers
+from app.codec import codec
+from app.db import AsyncSessionLocal, Base, engine, ensure_columns, ensure_indexes
+from app.schemas import PaymentRequestEvent
+from app.config import settings
+
+SCALES = {"1k": 1_000, "100k": 100_000, "10m": 10_000_000}
+SEED_CHUNK = 1_000_000
+ROWS_PER_USER = 100
+
+# счета сида те же, что у пользователей сида orders: md5('bench-user-N')::uuid,
+# баланса хватает на любое число прогонов
+SEED_ACCOUNTS_SQL = """
+    INSERT INTO accounts (user_id, balance)
+    SELECT md5('bench-user-' || i)::uuid, 1000000000000
+    FROM generate_series(:start, :stop - 1) AS i
+    ON CONFLICT (user_id) DO NOTHING
+"""
+
+SEED_INBOX_SQL = """
+    INSERT INTO payments_inbox (message_id, event_type, payload, processed_at)
+    SELECT gen_random_uuid(),
+           'payment_requested',
+           jsonb_build_object('order_id', gen_random_uuid(), 'user_id', md5('bench-user-' || (i % :users))::uuid, 'amount', 1),
+           now() - make_interval(secs => i)
+    FROM generate_series(:start, :stop - 1) AS i
+"""
+
+SEED_OUTBOX_SQL = """
+    INSERT INTO payments_outbox (id, aggregate_id, event_type, payload, created_at, published_at)
+    SELECT gen_random_uuid(),
+           gen_random_uuid(),
+           'payment_succeeded',
+           jsonb_build_object('order_id', gen_random_uuid(), 'user_id', md5('bench-user-' || (i % :users))::uuid, 'amount', 1, 'result', 'success'),
+           now() - make_interval(secs => i),
+           now() - make_interval(secs => i)
+    FROM generate_series(:start, :stop - 1) AS i
+"""
+
+
+def bench_user(n: int) -> uuid.UUID:
+    return uuid.UUID(hashlib.md5(f"bench-user-{n}".encode()).hexdigest())
+
+
+class RoundTrips:
+    # statement'ы, BEGIN, COMMIT и ROLLBACK на движке; после прогрева - round trip'ы на операцию
+    def __init__(self):
+        self.count = 0
+        target = engine.sync_engine
+        for name in ("before_cursor_execute", "begin", "commit", "rollback"):
+            event.listen(target, name, self._hit)
+
+    def _hit(self, *args, **kwargs) -> None:
+        self.count += 1
+
+
+class FakeMessage:
+    def __init__(self, payload: dict):
+        self.body = codec.dumps(payload)
+        self.content_type = codec.content_type
+        self.headers = {}
+
+
+async def seed(rows: int) -> dict:
+    # accounts - rows / ROWS_PER_USER счетов, inbox и outbox доливаются до rows строк
+    users = max(1, rows // ROWS_PER_USER)
+    seeded = {}
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(ensure_columns)
+        await conn.run_sync(ensure_indexes)
+
+    start = time.perf_counter()
+    inserted = 0
+    for chunk in range(0, users, SEED_CHUNK):
+        async with engine.begin() as conn:
+            result = await conn.execute(text(SEED_ACCOUNTS_SQL), {"start": chunk, "stop": min(users, chunk + SEED_CHUNK)})
+            inserted += result.rowcount
+    seeded["accounts"] = {"inserted": inserted, "seconds": round(time.perf_counter() - start, 3)}
+
+    for table, sql in (("payments_inbox", SEED_INBOX_SQL), ("payments_outbox", SEED_OUTBOX_SQL)):
+        async with engine.connect() as conn:
+            have = (await conn.execute(text(f"SELECT count(*) FROM {table}"))).scalar_one()
+        start = time.perf_counter()
+        for chunk in range(have, rows, SEED_CHUNK):
+            # пачками по SEED_CHUNK, чтобы 10M не шли одной транзакцией
+            async with engine.begin() as conn:
+                await conn.execute(text(sql), {"users": users, "start": chunk, "stop": min(rows, chunk + SEED_CHUNK)})
+        seeded[table] = {"existing": have, "inserted": max(0, rows - have), "seconds": round(time.perf_counter() - start, 3)}
+
+    async with engine.begin() as conn:
+        await conn.execute(text("ANALYZE accounts, payments_inbox, payments_outbox"))
+    return seeded
+
+
+async def measure(
+    name: str,
+    op: Callable[[int], Awaitable[None]],
+    iterations: int,
+    alloc_iterations: int,
+    round_trips: RoundTrips,
+    warmup: int = 10,
+) -> dict:
+    for i in range(warmup):
+        await op(i)
+
+    round_trips.count = 0
+    start = time.perf_counter()
+    for i in range(iterations):
+        await op(warmup + i)
+    elapsed = time.perf_counter() - start
+    trips = round_trips.count
+
+    # отдельный проход под tracemalloc: он сильно замедляет код и не должен влиять на ops/sec
+    tracemalloc.start()
+    base_current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    for i in range(alloc_iterations):
+        await op(warmup + iterations + i)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "name": name,
+        "iterations": iterations,
+        "ops_per_second": round(iterations / elapsed, 2),
+        "mean_ms": round(elapsed / iterations * 1000, 3),
+        "round_trips_per_op": round(trips / iterations, 2),
+        "alloc_peak_kib": round((peak - base_current) / 1024, 1),
+        "alloc_retained_kib_per_op": round((current - base_current) / 1024 / max(alloc_iterations, 1), 3),
+    }
+
+
+async def run_scale(rows: int, iterations: int, alloc_iterations: int, round_trips: RoundTrips) -> list[dict]:
+    users = max(1, rows // ROWS_PER_USER)
+    total = 10 + iterations + alloc_iterations
+    results = []
+
+    async def deposit(i: int) -> None:
+        async with AsyncSessionLocal() as session:
+            await crud.deposit(bench_user(i % users), 1.0, session)
+    results.append(await measure("deposit", deposit, iterations, alloc_iterations, round_trips))
+
+    async def hold_amount(i: int) -> None:
+        async with AsyncSessionLocal() as session:
+            await crud.hold_amount(uuid.uuid4(), bench_user(i % users), Decimal("1.00"), session)
+    results.append(await measure("hold_amount", hold_amount, iterations, alloc_iterations, round_trips))
+
+    async def process_payment_event(i: int) -> None:
+        async with AsyncSessionLocal() as session:
+            await crud.process_payment_event(
+                PaymentRequestEvent(order_id=uuid.uuid4(), user_id=bench_user(i % users), amount=1.0), session
+            )
+    results.append(await measure("process_payment_event", process_payment_event, iterations, alloc_iterations, round_trips))
+
+    # повторная доставка: ON CONFLICT в inbox отсекает сообщение без списания
+    duplicates = [PaymentRequestEvent(order_id=uuid.uuid4(), user_id=bench_user(n % users), amount=1.0) for n in range(total)]
+    for duplicate in duplicates:
+        async with AsyncSessionLocal() as session:
+            await crud.process_payment_event(duplicate, session)
+
+    async def process_payment_event_duplicate(i: int) -> None:
+        async with AsyncSessionLocal() as session:
+            await crud.process_payment_event(duplicates[i], session)
+    results.append(await measure("process_payment_event_duplicate", process_payment_event_duplicate,
+                                 iterations, alloc_iterations, round_trips))
+
+    # одна итерация inbox_consumer без брокера: разбор сообщения и обработка в своей сессии
+    messages = [
+        FakeMessage({"order_id": str(uuid.uuid4()), "user_id": str(bench_user(n % users)), "amount": 1.0})
+        for n in range(total)
+    ]
+
+    async def inbox_iteration(i: int) -> None:
+        event = workers.parse_payment_request(messages[i])
+        await workers.handle_payment_request(event)
+    results.append(await measure("inbox_consumer_message", inbox_iteration, iterations, alloc_iterations, round_trips))
+
+    # одна итерация outbox_publisher = одна пачка OUTBOX_BATCH_SIZE; неопубликованный
+    # хвост готовится заранее и в замер не входит
+    batch = settings.OUTBOX_BATCH_SIZE
+    async with engine.begin() as conn:
+        await conn.execute(text("""
+            INSERT INTO payments_outbox (id, aggregate_id, event_type, payload)
+            SELECT gen_random_uuid(), gen_random_uuid(), 'payment_succeeded',
+                   jsonb_build_object('order_id', gen_random_uuid(), 'user_id', gen_random_uuid(), 'amount', 1, 'result', 'success')
+            FROM generate_series(1, :n)
+        """), {"n": total * batch})
+    # RabbitMQ не участвует: публикация идёт в брокер внутри процесса, очередь чистится
+    # каждую итерацию, чтобы опубликованные сообщения не копились в памяти
+    messaging.broker = messaging.MemoryBroker()
+    await messaging.broker.connect()
+
+    async def outbox_iteration(i: int) -> None:
+        await workers.publish_outbox_batch()
+        await messaging.broker.purge(messaging.QUEUE_PAYMENT_RESULTS)
+    results.append(await measure(f"outbox_publisher_batch[{batch}]", outbox_iteration, iterations, alloc_iterations, round_trips))
+    return results
+
+
+async def _main(scales: list[str], iterations: int, alloc_iterations: int, output: str | None) -> None:
+    round_trips = RoundTrips()
+    report = {"service": "payments", "balance_mode": settings.BALANCE_MODE, "scales": {}}
+    try:
+        for scale in scales:
+            rows = SCALES[scale]
+            seeded = await seed(rows)
+            report["scales"][scale] = {
+                "rows": rows,
+                "seed": seeded,
+                "benchmarks": await run_scale(rows, iterations, alloc_iterations, round_trips),
+            }
+    finally:
+        await engine.dispose()
+
+    text_report = json.dumps(report, ensure_ascii=False, indent=2)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(text_report)
+    print(text_report)
+
+if __name__ == "__main__":
+    # python -m app.bench --scale 1k --scale 100k --output bench-payments.json
+    # Пишет в БД из настроек: запускать на локальной/стендовой базе, не на боевой.
+    parser = argparse.ArgumentParser(description="Microbenchmarks of payments crud and worker hot paths")
+    parser.add_argument("--scale", action="append", choices=SCALES, help="seed size of inbox and outbox (repeatable)")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--alloc-iterations", type=int, default=50)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+    engine.echo = False
+    asyncio.run(_main(args.scale or ["1k"], args.iterations, args.alloc_iterations, args.output))
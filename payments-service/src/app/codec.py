@@ -0,0 +1,92 @@
+import json
+import logging
+from typing import Any, Type, TypeVar
+from pydantic import BaseModel
+from app.config import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger("payments.codec")
+
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+
+M = TypeVar("M", bound=BaseModel)
+
+
+class UnsupportedContentType(Exception):
+    # сообщение целое, но этот процесс не умеет его читать - его нельзя считать битым
+    pass
+
+
+class JsonCodec:
+    name = "json"
+    content_type = JSON_CONTENT_TYPE
+
+    def dumps(self, obj: Any) -> bytes:
+        return json.dumps(obj, separators=(",", ":")).encode()
+
+    def loads(self, data: bytes) -> Any:
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    # тот же JSON на проводе, только быстрее; получателю без orjson разница не видна
+    name = "orjson"
+
+    def dumps(self, obj: Any) -> bytes:
+        return orjson.dumps(obj)
+
+    def loads(self, data: bytes) -> Any:
+        return orjson.loads(data)
+
+
+class MsgpackCodec:
+    name = "msgpack"
+    content_type = MSGPACK_CONTENT_TYPE
+
+    def dumps(self, obj: Any) -> bytes:
+        return msgpack.packb(obj)
+
+    def loads(self, data: bytes) -> Any:
+        return msgpack.unpackb(data)
+
+
+def build_codec(name: str):
+    if name == "msgpack":
+        if msgpack is not None:
+            return MsgpackCodec()
+        logger.warning("[Payments] MESSAGE_CODEC=msgpack but 'msgpack' is not installed, using JSON")
+    if name in ("orjson", "msgpack") and orjson is not None:
+        return OrjsonCodec()
+    return JsonCodec()
+
+
+codec = build_codec(settings.MESSAGE_CODEC)
+_json_codec = OrjsonCodec() if orjson is not None else JsonCodec()
+
+def _unpack(body: bytes) -> Any:
+    if msgpack is None:
+        raise UnsupportedContentType(f"{MSGPACK_CONTENT_TYPE} message but 'msgpack' is not installed")
+    return msgpack.unpackb(body)
+
+def decode(body: bytes, content_type: str | None) -> Any:
+    # формат берётся из content-type сообщения, а не из своей настройки:
+    # при раскатке отправитель и получатель могут быть на разных кодеках
+    if content_type == MSGPACK_CONTENT_TYPE:
+        return _unpack(body)
+    return _json_codec.loads(body)
+
+def decode_model(model: Type[M], body: bytes, content_type: str | None) -> M:
+    # JSON валидируется pydantic'ом прямо из байтов, без промежуточного dict
+    if content_type == MSGPACK_CONTENT_TYPE:
+        return model.model_validate(_unpack(body))
+    return model.model_validate_json(body)
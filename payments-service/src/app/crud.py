@@ -1,11 +1,20 @@
-from decimal import Decimal
+import uuid
+from datetime import datetime, timedelta
+from decimal import Decimal, ROUND_DOWN
+from typing import Sequence
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy import UUID, select, func,  update, delete
+from sqlalchemy import UUID, Numeric, select, func,  update, delete, insert, exists, literal, case, values, column
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.sql import Select
+from sqlalchemy.dialects.postgresql import JSONB, insert as pg_insert
 from sqlalchemy.exc import IntegrityError, NoResultFound
 from fastapi.encoders import jsonable_encoder
 
-from app.models import Account, PaymentsInbox, PaymentsOutbox, Account, Hold
+from app.models import Account, AccountStripe, IdempotencyKey, LedgerEntry, PaymentsInbox, PaymentsOutbox, PaymentsOutboxArchive, Account, Hold
 from app.schemas import PaymentRequestEvent
+from app.config import settings
+from app.cache import cache, account_key
+from app.tracing import outbox_fields
 
 class AccountExistsError(Exception):
     pass
@@ -30,111 +39,713 @@ async def create_account(
     await session.refresh(account)
     return account
 
+def _total_balance():
+    # accounts.balance + полосы (stripe_count > 1) + записи ledger после снапшота;
+    # оба подзапроса читаются по индексам по user_id
+    stripes_total = (
+        select(func.coalesce(func.sum(AccountStripe.balance), 0))
+        .where(AccountStripe.user_id == Account.user_id)
+        .scalar_subquery()
+    )
+    ledger_delta = (
+        select(func.coalesce(func.sum(LedgerEntry.amount), 0))
+        .where(LedgerEntry.user_id == Account.user_id, LedgerEntry.id > Account.snapshot_entry_id)
+        .scalar_subquery()
+    )
+    return Account.balance + stripes_total + ledger_delta
+
 async def get_account(
     user_id: str,
     session: AsyncSession
 ) -> Account | None:
-    return await session.get(Account, user_id)
+    row = (await session.execute(
+        select(Account, _total_balance())
+        .where(Account.user_id == user_id)
+        .execution_options(populate_existing=True)
+    )).one_or_none()
+    if row is None:
+        return None
+    account, total = row
+    set_committed_value(account, "balance", total)
+    return account
 
-async def deposit(
+# --- выгрузки (app.export) ---
+
+ACCOUNT_EXPORT_COLUMNS = ("user_id", "balance", "stripe_count", "created_at", "updated_at")
+HOLD_EXPORT_COLUMNS = ("order_id", "user_id", "amount", "created_at", "released_at", "captured_at")
+
+def export_accounts_query() -> Select:
+    # баланс тот же, что отдаёт get_account: с полосами и хвостом ledger
+    return (
+        select(Account.user_id, _total_balance(), Account.stripe_count, Account.created_at, Account.updated_at)
+        .order_by(Account.user_id)
+    )
+
+def export_holds_query(
+    user_id: UUID | None = None,
+    created_from: datetime | None = None,
+    created_to: datetime | None = None,
+    active_only: bool = False,
+) -> Select:
+    query = select(*(getattr(Hold, column) for column in HOLD_EXPORT_COLUMNS))
+    if user_id is not None:
+        query = query.where(Hold.user_id == user_id)
+    if created_from is not None:
+        query = query.where(Hold.created_at >= created_from)
+    if created_to is not None:
+        query = query.where(Hold.created_at < created_to)
+    if active_only:
+        query = query.where(Hold.released_at.is_(None), Hold.captured_at.is_(None))
+    return query.order_by(Hold.created_at, Hold.order_id)
+
+# --- полосы баланса (stripe_count > 1) ---
+# Горячий счёт раскладывается на N строк account_stripes, операции берут
+# случайную незаблокированную полосу (SKIP LOCKED) и не сериализуются на одной строке.
+
+def _split(total: Decimal, parts: int) -> list[Decimal]:
+    share = (total / parts).quantize(Decimal("0.01"), rounding=ROUND_DOWN)
+    return [total - share * (parts - 1)] + [share] * (parts - 1)
+
+async def _credit_stripe(user_id, amount: Decimal, session: AsyncSession) -> bool:
+    for skip_locked in (True, False):
+        pick = (
+            select(AccountStripe.stripe)
+            .where(AccountStripe.user_id == user_id)
+            .order_by(func.random())
+            .limit(1)
+        )
+        if skip_locked:
+            pick = pick.with_for_update(skip_locked=True)
+        stmt = (
+            update(AccountStripe)
+            .where(AccountStripe.user_id == user_id, AccountStripe.stripe == pick.scalar_subquery())
+            .values(balance=AccountStripe.balance + amount, updated_at=func.now())
+            .returning(AccountStripe.stripe)
+            .execution_options(synchronize_session=False)
+        )
+        if (await session.execute(stmt)).scalar_one_or_none() is not None:
+            return True
+    return False
+
+async def _debit_stripe(user_id, amount: Decimal, session: AsyncSession) -> bool:
+    pick = (
+        select(AccountStripe.stripe)
+        .where(AccountStripe.user_id == user_id, AccountStripe.balance >= amount)
+        .order_by(func.random())
+        .limit(1)
+        .with_for_update(skip_locked=True)
+    )
+    stmt = (
+        update(AccountStripe)
+        .where(
+            AccountStripe.user_id == user_id,
+            AccountStripe.stripe == pick.scalar_subquery(),
+            AccountStripe.balance >= amount,
+        )
+        .values(balance=AccountStripe.balance - amount, updated_at=func.now())
+        .returning(AccountStripe.stripe)
+        .execution_options(synchronize_session=False)
+    )
+    if (await session.execute(stmt)).scalar_one_or_none() is not None:
+        return True
+
+    # ни в одной свободной полосе не хватает денег: блокируем все полосы
+    # (в фиксированном порядке), списываем из суммы и раскладываем остаток заново
+    stripes = (await session.execute(
+        select(AccountStripe)
+        .where(AccountStripe.user_id == user_id)
+        .order_by(AccountStripe.stripe)
+        .with_for_update()
+    )).scalars().all()
+    total = sum((s.balance for s in stripes), Decimal("0"))
+    if not stripes or total < amount:
+        return False
+    for stripe, balance in zip(stripes, _split(total - amount, len(stripes))):
+        stripe.balance = balance
+        stripe.updated_at = func.now()
+    await session.flush()
+    return True
+
+async def set_stripe_count(
     user_id: str,
-    amount: float,
+    stripe_count: int,
     session: AsyncSession
 ) -> Account | None:
     stmt = select(Account).where(Account.user_id == user_id).with_for_update()
-    result = await session.execute(stmt)
-    account = result.scalar_one_or_none()
-
+    account = (await session.execute(stmt)).scalar_one_or_none()
     if not account:
         return None
 
-    account.balance += Decimal(str(amount))
+    stripes = (await session.execute(
+        select(AccountStripe)
+        .where(AccountStripe.user_id == user_id)
+        .order_by(AccountStripe.stripe)
+        .with_for_update()
+    )).scalars().all()
+    total = account.balance + sum((s.balance for s in stripes), Decimal("0"))
+
+    await session.execute(delete(AccountStripe).where(AccountStripe.user_id == user_id))
+    if stripe_count > 1:
+        session.add_all([
+            AccountStripe(user_id=account.user_id, stripe=i, balance=balance)
+            for i, balance in enumerate(_split(total, stripe_count))
+        ])
+        account.balance = Decimal("0")
+    else:
+        account.balance = total
+    account.stripe_count = stripe_count
     account.updated_at = func.now()
-    session.add(account)
     await session.commit()
-    await session.refresh(account)
-    return account
+    await cache.invalidate(account_key(user_id))
+    return await get_account(user_id, session)
+
+# --- ledger (BALANCE_MODE=ledger) ---
+# Движения денег - только INSERT в ledger_entries, accounts.balance обновляет
+# периодический снапшот. Блокировки строки счёта:
+#   зачисление - FOR KEY SHARE (не конфликтует ни с зачислениями, ни со списаниями),
+#   списание   - FOR NO KEY UPDATE (списания по счёту идут по очереди),
+#   снапшот    - FOR UPDATE (дожидается всех незакоммиченных записей по счёту).
+
+async def _ledger_credit(user_id, amount: Decimal, kind: str, ref_id, session: AsyncSession) -> bool:
+    stmt = (
+        insert(LedgerEntry)
+        .from_select(
+            ["user_id", "amount", "kind", "ref_id"],
+            select(Account.user_id, literal(amount, Numeric(18, 2)), literal(kind), literal(ref_id, UUID))
+            .where(Account.user_id == user_id)
+            .with_for_update(read=True, key_share=True)
+        )
+        .returning(LedgerEntry.id)
+    )
+    return (await session.execute(stmt)).scalar_one_or_none() is not None
+
+async def _ledger_debit(user_id, amount: Decimal, kind: str, ref_id, session: AsyncSession) -> str | None:
+    # None - списано, иначе причина отказа.
+    # Лок и чтение баланса - разные statement'ы: снапшот READ COMMITTED берётся в начале
+    # statement'а, и сумма, прочитанная вместе с локом, не видела бы списание, которого
+    # statement дождался (списание пишет только ledger, строку accounts оно не меняет)
+    locked = (await session.execute(
+        select(literal(1)).where(Account.user_id == user_id).with_for_update(key_share=True, of=Account)
+    )).scalar_one_or_none()
+    if locked is None:
+        return "no_account"
+    balance = (await session.execute(
+        select(_total_balance()).where(Account.user_id == user_id)
+    )).scalar_one()
+    if balance < amount:
+        return "insufficient_funds"
+    session.add(LedgerEntry(user_id=user_id, amount=-amount, kind=kind, ref_id=ref_id))
+    await session.flush()
+    return None
+
+async def take_ledger_snapshots(limit: int, session: AsyncSession) -> int:
+    # счета с записями после снапшота; занятые зачислением пропускаем до следующего прохода
+    pending = exists().where(LedgerEntry.user_id == Account.user_id, LedgerEntry.id > Account.snapshot_entry_id)
+    user_ids = (await session.execute(
+        select(Account.user_id).where(pending).limit(limit).with_for_update(skip_locked=True)
+    )).scalars().all()
+    if not user_ids:
+        return 0
+
+    delta = (
+        select(
+            LedgerEntry.user_id,
+            Account.stripe_count,
+            func.sum(LedgerEntry.amount).label("delta"),
+            func.max(LedgerEntry.id).label("last_id"),
+        )
+        .join(Account, Account.user_id == LedgerEntry.user_id)
+        .where(LedgerEntry.user_id.in_(user_ids), LedgerEntry.id > Account.snapshot_entry_id)
+        .group_by(LedgerEntry.user_id, Account.stripe_count)
+        .subquery()
+    )
+    # у полосатого счёта accounts.balance держится равным 0, дельта уходит в полосу 0
+    # (как в импорте): иначе после возврата в inplace её не увидят списания по полосам.
+    # Полосы - первыми, пока snapshot_entry_id ещё старый и delta не пуста
+    await session.execute(
+        update(AccountStripe)
+        .where(AccountStripe.user_id == delta.c.user_id, AccountStripe.stripe == 0, delta.c.stripe_count > 1)
+        .values(balance=AccountStripe.balance + delta.c.delta, updated_at=func.now())
+        .execution_options(synchronize_session=False)
+    )
+    await session.execute(
+        update(Account)
+        .where(Account.user_id == delta.c.user_id)
+        .values(
+            balance=case((delta.c.stripe_count > 1, Account.balance), else_=Account.balance + delta.c.delta),
+            snapshot_entry_id=delta.c.last_id,
+        )
+        .execution_options(synchronize_session=False)
+    )
+    return len(user_ids)
+
+async def deposit(
+    user_id: str,
+    amount: float,
+    session: AsyncSession
+) -> Account | None:
+    amount = Decimal(str(amount))
+    if settings.BALANCE_MODE == "ledger":
+        if not await _ledger_credit(user_id, amount, "deposit", None, session):
+            await session.rollback()
+            return None
+        await session.commit()
+        await cache.invalidate(account_key(user_id))
+        return await get_account(user_id, session)
+
+    # одно условное UPDATE ... RETURNING вместо SELECT FOR UPDATE + flush + refresh
+    stmt = (
+        update(Account)
+        .where(Account.user_id == user_id, Account.stripe_count == 1)
+        .values(balance=Account.balance + amount, updated_at=func.now())
+        .returning(Account)
+        .execution_options(populate_existing=True)
+    )
+    account = (await session.execute(stmt)).scalar_one_or_none()
+    if account:
+        await session.commit()
+        await cache.invalidate(account_key(user_id))
+        return account
+
+    if not await _credit_stripe(user_id, amount, session):
+        await session.rollback()
+        return None
+    await session.commit()
+    await cache.invalidate(account_key(user_id))
+    return await get_account(user_id, session)
 
 async def process_payment_event(
     event: PaymentRequestEvent,
     session: AsyncSession
 ) -> None:
     raw = jsonable_encoder(event)
+    amount = Decimal(str(raw["amount"]))
+    if settings.BALANCE_MODE == "ledger":
+        return await _process_payment_event_ledger(raw, amount, session)
 
-    inbox_rec = PaymentsInbox(
-        message_id=raw["order_id"], # строка
-        event_type="payment_requested",
-        payload=raw
+    # Весь платёж по обычному счёту - один statement: запись в inbox (дедупликация
+    # через ON CONFLICT), условное списание и запись результата в outbox. Лок строки
+    # счёта держится только до commit, без промежуточных round trip'ов.
+    # Для полосатого счёта outbox-запись не создаётся, её пишет ветка ниже.
+    inbox = (
+        pg_insert(PaymentsInbox)
+        .values(message_id=raw["order_id"], event_type="payment_requested", payload=raw)
+        .on_conflict_do_nothing()
+        .returning(PaymentsInbox.message_id)
+        .cte("inbox")
     )
-    session.add(inbox_rec)
-    try:
-        await session.flush()
-    except IntegrityError:
+    is_new = exists(select(inbox.c.message_id))
+
+    debited = (
+        update(Account)
+        .where(Account.user_id == raw["user_id"], Account.stripe_count == 1, Account.balance >= amount, is_new)
+        .values(balance=Account.balance - amount, updated_at=func.now())
+        .returning(Account.user_id)
+        .cte("debited")
+    )
+    succeeded = exists(select(debited.c.user_id))
+    has_account = exists(select(Account.user_id).where(Account.user_id == raw["user_id"]))
+    is_striped = exists(select(Account.user_id).where(Account.user_id == raw["user_id"], Account.stripe_count > 1))
+
+    base = {
+        "order_id": raw["order_id"],
+        "user_id": raw["user_id"],
+        "amount": raw["amount"],
+        **outbox_fields(),
+    }
+    event_type = case((succeeded, "payment_succeeded"), else_="payment_failed")
+    out_payload = case(
+        (succeeded, literal({**base, "result": "success"}, JSONB)),
+        (has_account, literal({**base, "result": "failed", "reason": "insufficient_funds"}, JSONB)),
+        else_=literal({**base, "result": "failed", "reason": "no_account"}, JSONB),
+    )
+
+    outbox = (
+        insert(PaymentsOutbox)
+        .from_select(
+            ["id", "aggregate_id", "event_type", "payload"],
+            select(
+                literal(uuid.uuid4(), UUID),
+                literal(event.order_id, UUID),
+                event_type,
+                out_payload,
+            ).where(is_new, ~is_striped)
+        )
+        .returning(PaymentsOutbox.id)
+        .cte("outbox")
+    )
+    stmt = (
+        select(is_new.label("is_new"), exists(select(outbox.c.id)).label("done"))
+        .add_cte(inbox)
+        .add_cte(debited)
+        .add_cte(outbox)
+    )
+    is_new, done = (await session.execute(stmt)).one()
+    if not is_new:
+        # сообщение уже обрабатывалось
         await session.rollback()
         return
 
-    # Проверяем и блокируем счёт
-    account = await session.get(Account, raw["user_id"], with_for_update=True)
-    if not account:
-        out_payload = {
-            "order_id": raw["order_id"],
-            "user_id": raw["user_id"],
-            "amount": raw["amount"],
-            "result": "failed",
-            "reason": "no_account"
-        }
-        event_type = "payment_failed"
-    else:
-        if account.balance < Decimal(str(raw["amount"])):
-            out_payload = {
-                "order_id": raw["order_id"],
-                "user_id": raw["user_id"],
-                "amount": raw["amount"],
-                "result": "failed",
-                "reason": "insufficient_funds"
-            }
-            event_type = "payment_failed"
+    if not done:
+        if await _debit_stripe(raw["user_id"], amount, session):
+            out_payload, event_type = {**base, "result": "success"}, "payment_succeeded"
         else:
-            account.balance -= Decimal(str(raw["amount"]))
-            account.updated_at = func.now()
-            session.add(account)
+            out_payload = {**base, "result": "failed", "reason": "insufficient_funds"}
+            event_type = "payment_failed"
+        session.add(PaymentsOutbox(aggregate_id=raw["order_id"], event_type=event_type, payload=out_payload))
 
-            out_payload = {
-                "order_id": raw["order_id"],
-                "user_id": raw["user_id"],
-                "amount": raw["amount"],
-                "result": "success"
-            }
-            event_type = "payment_succeeded"
+    await session.commit()
+    await cache.invalidate(account_key(raw["user_id"]))
 
-    outbox_rec = PaymentsOutbox(
-        aggregate_id=raw["order_id"],
-        event_type=event_type,
-        payload=out_payload
+async def _process_payment_event_ledger(raw: dict, amount: Decimal, session: AsyncSession) -> None:
+    stmt = (
+        pg_insert(PaymentsInbox)
+        .values(message_id=raw["order_id"], event_type="payment_requested", payload=raw)
+        .on_conflict_do_nothing()
+        .returning(PaymentsInbox.message_id)
     )
-    session.add(outbox_rec)
+    if (await session.execute(stmt)).scalar_one_or_none() is None:
+        await session.rollback()
+        return
 
+    reason = await _ledger_debit(raw["user_id"], amount, "payment", raw["order_id"], session)
+    out_payload = {
+        "order_id": raw["order_id"],
+        "user_id": raw["user_id"],
+        "amount": raw["amount"],
+        **outbox_fields(),
+    }
+    if reason is None:
+        out_payload["result"] = "success"
+        event_type = "payment_succeeded"
+    else:
+        out_payload.update(result="failed", reason=reason)
+        event_type = "payment_failed"
+
+    session.add(PaymentsOutbox(aggregate_id=raw["order_id"], event_type=event_type, payload=out_payload))
     await session.commit()
+    await cache.invalidate(account_key(raw["user_id"]))
 
 async def hold_amount(order_id: UUID, user_id: UUID, amount: Decimal, session: AsyncSession):
-    stmt = select(Account).where(Account.user_id==user_id).with_for_update()
-    account = (await session.execute(stmt)).scalar_one_or_none()
-    if not account or account.balance < amount:
+    if settings.BALANCE_MODE == "ledger":
+        if await _ledger_debit(user_id, amount, "hold", order_id, session) is not None:
+            await session.rollback()
+            raise InsufficientFunds()
+        session.add(Hold(order_id=order_id, user_id=user_id, amount=amount))
+        await session.commit()
+        await cache.invalidate(account_key(user_id))
+        return
+
+    # списание и вставка hold одним statement: INSERT ... SELECT из UPDATE ... RETURNING
+    debited = (
+        update(Account)
+        .where(Account.user_id == user_id, Account.stripe_count == 1, Account.balance >= amount)
+        .values(balance=Account.balance - amount, updated_at=func.now())
+        .returning(Account.user_id)
+        .cte("debited")
+    )
+    stmt = (
+        insert(Hold)
+        .from_select(
+            ["order_id", "user_id", "amount"],
+            select(literal(order_id, UUID), debited.c.user_id, literal(amount, Numeric(18, 2)))
+        )
+        .add_cte(debited)
+        .returning(Hold.order_id)
+    )
+    if (await session.execute(stmt)).scalar_one_or_none() is not None:
+        await session.commit()
+        await cache.invalidate(account_key(user_id))
+        return
+
+    if not await _debit_stripe(user_id, amount, session):
+        await session.rollback()
         raise InsufficientFunds()
-    account.balance -= amount
-    session.add(account)
     session.add(Hold(order_id=order_id, user_id=user_id, amount=amount))
     await session.commit()
+    await cache.invalidate(account_key(user_id))
+
+# --- пакетные резервы и возвраты ---
+# Затронутые счета блокируются одним SELECT ... FOR NO KEY UPDATE в порядке user_id,
+# поэтому пачки с пересекающимися счетами не дедлочатся; всё коммитится один раз.
+
+async def _lock_accounts(user_ids, session: AsyncSession) -> dict:
+    accounts = (await session.execute(
+        select(Account)
+        .where(Account.user_id.in_(sorted(set(user_ids))))
+        .order_by(Account.user_id)
+        .with_for_update(key_share=True)
+        .execution_options(populate_existing=True)
+    )).scalars().all()
+    return {account.user_id: account for account in accounts}
+
+async def _lock_stripes(user_ids, session: AsyncSession) -> dict:
+    stripes: dict = {user_id: [] for user_id in user_ids}
+    if stripes:
+        rows = (await session.execute(
+            select(AccountStripe)
+            .where(AccountStripe.user_id.in_(list(stripes)))
+            .order_by(AccountStripe.user_id, AccountStripe.stripe)
+            .with_for_update()
+        )).scalars().all()
+        for stripe in rows:
+            stripes[stripe.user_id].append(stripe)
+    return stripes
+
+async def _shift_balances(deltas: dict, session: AsyncSession) -> None:
+    # один UPDATE ... FROM (VALUES ...) для всех обычных счетов пачки
+    if not deltas:
+        return
+    shift = values(
+        column("user_id", UUID), column("delta", Numeric(18, 2)), name="shift"
+    ).data(sorted(deltas.items()))
+    await session.execute(
+        update(Account)
+        .where(Account.user_id == shift.c.user_id)
+        .values(balance=Account.balance + shift.c.delta, updated_at=func.now())
+        .execution_options(synchronize_session=False)
+    )
+
+async def hold_batch(
+    holds: Sequence[tuple[UUID, UUID, Decimal]],
+    session: AsyncSession
+) -> list[str | None]:
+    # holds - (order_id, user_id, amount). Резервы каждого счёта применяются по порядку,
+    # пока хватает денег; для каждого - None (зарезервирован) или причина отказа
+    accounts = await _lock_accounts([user_id for _, user_id, _ in holds], session)
+    ledger = settings.BALANCE_MODE == "ledger"
+    striped = [] if ledger else [a.user_id for a in accounts.values() if a.stripe_count > 1]
+    stripes = await _lock_stripes(striped, session)
+
+    if ledger and accounts:
+        available = dict((await session.execute(
+            select(Account.user_id, _total_balance()).where(Account.user_id.in_(list(accounts)))
+        )).all())
+    else:
+        # accounts.balance у полосатого счёта держится равным 0
+        available = {
+            user_id: sum((s.balance for s in stripes[user_id]), Decimal("0")) if user_id in stripes else account.balance
+            for user_id, account in accounts.items()
+        }
+
+    existing = set((await session.execute(
+        select(Hold.order_id).where(Hold.order_id.in_([order_id for order_id, _, _ in holds]))
+    )).scalars().all())
+
+    results: list[str | None] = []
+    accepted: list[tuple[UUID, UUID, Decimal]] = []
+    debited: dict = {}
+    for order_id, user_id, amount in holds:
+        if user_id not in accounts:
+            results.append("no_account")
+        elif order_id in existing:
+            results.append("duplicate")
+        elif debited.get(user_id, Decimal("0")) + amount > available[user_id]:
+            results.append("insufficient_funds")
+        else:
+            existing.add(order_id)
+            accepted.append((order_id, user_id, amount))
+            debited[user_id] = debited.get(user_id, Decimal("0")) + amount
+            results.append(None)
+
+    if accepted:
+        # параллельный резерв с тем же order_id мог вставиться после проверки выше:
+        # такой резерв получает "duplicate", остальная пачка проходит
+        inserted = set((await session.execute(
+            pg_insert(Hold)
+            .values([
+                {"order_id": order_id, "user_id": user_id, "amount": amount}
+                for order_id, user_id, amount in accepted
+            ])
+            .on_conflict_do_nothing(index_elements=[Hold.order_id])
+            .returning(Hold.order_id)
+        )).scalars().all())
+        if len(inserted) < len(accepted):
+            lost = {order_id for order_id, _, _ in accepted} - inserted
+            results = ["duplicate" if order_id in lost and r is None else r for (order_id, _, _), r in zip(holds, results)]
+            accepted = [h for h in accepted if h[0] in inserted]
+            debited = {}
+            for _, user_id, amount in accepted:
+                debited[user_id] = debited.get(user_id, Decimal("0")) + amount
+
+    if not accepted:
+        await session.rollback()
+        return results
+
+    if ledger:
+        await session.execute(insert(LedgerEntry).values([
+            {"user_id": user_id, "amount": -amount, "kind": "hold", "ref_id": order_id}
+            for order_id, user_id, amount in accepted
+        ]))
+    else:
+        for user_id in striped:
+            if user_id in debited:
+                for stripe, balance in zip(stripes[user_id], _split(available[user_id] - debited[user_id], len(stripes[user_id]))):
+                    stripe.balance = balance
+                    stripe.updated_at = func.now()
+        await _shift_balances({u: -d for u, d in debited.items() if u not in stripes}, session)
+    await session.commit()
+    for user_id in debited:
+        await cache.invalidate(account_key(user_id))
+    return results
+
+async def hold_amounts(
+    user_id: UUID,
+    holds: Sequence[tuple[UUID, Decimal]],
+    session: AsyncSession
+) -> list[str | None] | None:
+    # пачка резервов одного счёта; None - счёта нет
+    results = await hold_batch([(order_id, user_id, amount) for order_id, amount in holds], session)
+    return None if results and results[0] == "no_account" else results
+
+async def release_batch(order_ids: Sequence[UUID], session: AsyncSession) -> list[str | None]:
+    # None - резерв отпущен, "not_found" - нет активного резерва с таким order_id
+    owners = (await session.execute(
+        select(Hold.user_id)
+        .where(Hold.order_id.in_(order_ids), Hold.released_at.is_(None), Hold.captured_at.is_(None))
+        .distinct()
+    )).scalars().all()
+    accounts = await _lock_accounts(owners, session)
+
+    released = (await session.execute(
+        update(Hold)
+        .where(Hold.order_id.in_(order_ids), Hold.released_at.is_(None), Hold.captured_at.is_(None))
+        .values(released_at=func.now())
+        .returning(Hold.order_id, Hold.user_id, Hold.amount)
+        .execution_options(synchronize_session=False)
+    )).all()
+    if not released:
+        await session.rollback()
+        return ["not_found"] * len(order_ids)
+
+    credited: dict = {}
+    for _, user_id, amount in released:
+        credited[user_id] = credited.get(user_id, Decimal("0")) + amount
+
+    if settings.BALANCE_MODE == "ledger":
+        await session.execute(insert(LedgerEntry).values([
+            {"user_id": user_id, "amount": amount, "kind": "release", "ref_id": order_id}
+            for order_id, user_id, amount in released
+        ]))
+    else:
+        plain = {}
+        for user_id, amount in credited.items():
+            account = accounts.get(user_id)
+            if account is not None and account.stripe_count > 1:
+                await _credit_stripe(user_id, amount, session)
+            else:
+                plain[user_id] = amount
+        await _shift_balances(plain, session)
+    await session.commit()
+    for user_id in credited:
+        await cache.invalidate(account_key(user_id))
+
+    done = {order_id for order_id, _, _ in released}
+    return [None if order_id in done else "not_found" for order_id in order_ids]
 
 async def release_hold(order_id: UUID, session: AsyncSession):
-    stmt = select(Hold).where(Hold.order_id==order_id, Hold.released_at.is_(None), Hold.captured_at.is_(None)).with_for_update()
-    hold = (await session.execute(stmt)).scalar_one_or_none()
-    if not hold:
+    released = (
+        update(Hold)
+        .where(Hold.order_id == order_id, Hold.released_at.is_(None), Hold.captured_at.is_(None))
+        .values(released_at=func.now())
+        .returning(Hold.user_id, Hold.amount)
+        .cte("released")
+    )
+    if settings.BALANCE_MODE == "ledger":
+        stmt = select(released.c.user_id, released.c.amount, literal(False)).add_cte(released)
+    else:
+        credited = (
+            update(Account)
+            .where(Account.user_id == released.c.user_id, Account.stripe_count == 1)
+            .values(balance=Account.balance + released.c.amount, updated_at=func.now())
+            .returning(Account.user_id)
+            .cte("credited")
+        )
+        stmt = (
+            select(released.c.user_id, released.c.amount, exists(select(credited.c.user_id)))
+            .add_cte(released)
+            .add_cte(credited)
+        )
+    row = (await session.execute(stmt)).one_or_none()
+    if row is None:
+        await session.rollback()
         raise NoResultFound()
 
-    stmt_acc = select(Account).where(Account.user_id==hold.user_id).with_for_update()
-    account = (await session.execute(stmt_acc)).scalar_one()
-    account.balance += hold.amount
-    hold.released_at = func.now()
-    session.add_all([account, hold])
-    await session.commit()
\ No newline at end of file
+    user_id, amount, done = row
+    if settings.BALANCE_MODE == "ledger":
+        await _ledger_credit(user_id, amount, "release", order_id, session)
+    elif not done:
+        await _credit_stripe(user_id, amount, session)
+    await session.commit()
+    await cache.invalidate(account_key(user_id))
+
+async def claim_outbox_batch(limit: int, session: AsyncSession) -> list[PaymentsOutbox]:
+    # SKIP LOCKED: строки, взятые другой репликой, пропускаются; лок живёт до commit
+    stmt = (
+        select(PaymentsOutbox)
+        .where(PaymentsOutbox.published_at.is_(None))
+        .order_by(PaymentsOutbox.created_at, PaymentsOutbox.id)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    return (await session.execute(stmt)).scalars().all()
+
+async def outbox_backlog(session: AsyncSession) -> tuple[int, float]:
+    # размер неопубликованного хвоста и возраст самого старого события, секунды
+    count, age = (await session.execute(
+        select(func.count(), func.extract("epoch", func.now() - func.min(PaymentsOutbox.created_at)))
+        .where(PaymentsOutbox.published_at.is_(None))
+    )).one()
+    return count, float(age or 0)
+
+async def mark_outbox_published(event_ids: Sequence[UUID], session: AsyncSession) -> None:
+    stmt = (
+        update(PaymentsOutbox)
+        .where(PaymentsOutbox.id.in_(event_ids))
+        .values(published_at=func.now())
+        .execution_options(synchronize_session=False)
+    )
+    await session.execute(stmt)
+
+async def prune_published_outbox(older_than: timedelta, limit: int, archive: bool, session: AsyncSession) -> int:
+    # до limit опубликованных событий старше older_than; с archive=True - переносом в архив тем же запросом
+    doomed = (
+        select(PaymentsOutbox.id)
+        .where(PaymentsOutbox.published_at < func.now() - older_than)
+        .order_by(PaymentsOutbox.published_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    stmt = delete(PaymentsOutbox).where(PaymentsOutbox.id.in_(doomed.scalar_subquery()))
+    if archive:
+        columns = [c.name for c in PaymentsOutbox.__table__.columns]
+        moved = stmt.returning(*PaymentsOutbox.__table__.columns).cte("moved")
+        stmt = (
+            insert(PaymentsOutboxArchive)
+            .from_select(columns, select(*moved.c))
+            .add_cte(moved)
+        )
+    return (await session.execute(stmt)).rowcount
+
+async def prune_inbox(older_than: timedelta, limit: int, session: AsyncSession) -> int:
+    # inbox нужен только для дедупликации; после окна ретраев записи можно удалять
+    doomed = (
+        select(PaymentsInbox.message_id)
+        .where(PaymentsInbox.processed_at < func.now() - older_than)
+        .order_by(PaymentsInbox.processed_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    stmt = delete(PaymentsInbox).where(PaymentsInbox.message_id.in_(doomed.scalar_subquery()))
+    return (await session.execute(stmt)).rowcount
+
+async def prune_idempotency_keys(limit: int, session: AsyncSession) -> int:
+    doomed = (
+        select(IdempotencyKey.key)
+        .where(IdempotencyKey.expires_at < func.now())
+        .order_by(IdempotencyKey.expires_at)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+    )
+    stmt = delete(IdempotencyKey).where(IdempotencyKey.key.in_(doomed.scalar_subquery()))
+    return (await session.execute(stmt)).rowcount
@@ -1,5 +1,7 @@
 from typing import AsyncGenerator
+from sqlalchemy import inspect, text
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.schema import CreateColumn
 from sqlalchemy.orm import sessionmaker, declarative_base
 from app.config import settings
 
@@ -14,7 +16,7 @@ DATABASE_URL = (
 
 engine = create_async_engine(
     DATABASE_URL,
-    echo=True,
+    echo=settings.SQL_ECHO,
     future=True
 )
 
@@ -26,6 +28,24 @@ AsyncSessionLocal = sessionmaker(
 
 Base = declarative_base()
 
+def ensure_indexes(sync_conn) -> None:
+    # create_all не добавляет новые индексы к уже существующим таблицам
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(sync_conn, checkfirst=True)
+
+def ensure_columns(sync_conn) -> None:
+    # create_all не добавляет новые колонки к уже существующим таблицам
+    existing_tables = set(inspect(sync_conn).get_table_names())
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            continue
+        existing = {c["name"] for c in inspect(sync_conn).get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                ddl = CreateColumn(column).compile(dialect=sync_conn.dialect)
+                sync_conn.execute(text(f"ALTER TABLE {table.name} ADD COLUMN IF NOT EXISTS {ddl}"))
+
 async def get_session() -> AsyncGenerator[AsyncSession, None]:
     async_session = AsyncSessionLocal()
     try:
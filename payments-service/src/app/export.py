@@ -0,0 +1,48 @@
+import csv
+import io
+import json
+from datetime import datetime
+from decimal import Decimal
+from typing import AsyncIterator, Sequence
+from uuid import UUID
+from sqlalchemy.sql import Select
+from app.db import AsyncSessionLocal
+from app.config import settings
+
+EXPORT_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+def _plain(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, (UUID, Decimal)):
+        return str(value)
+    return value
+
+def _ndjson(rows, columns: Sequence[str]) -> bytes:
+    return "".join(
+        json.dumps(dict(zip(columns, map(_plain, row))), ensure_ascii=False) + "\n"
+        for row in rows
+    ).encode()
+
+def _csv(rows) -> bytes:
+    buf = io.StringIO()
+    csv.writer(buf).writerows([_plain(value) for value in row] for row in rows)
+    return buf.getvalue().encode()
+
+async def stream_export(query: Select, columns: Sequence[str], fmt: str) -> AsyncIterator[bytes]:
+    """
+    Выгружает результат запроса в NDJSON или CSV через server-side курсор:
+    строки читаются из БД пачками по EXPORT_CHUNK_SIZE и сразу уходят клиенту,
+    так что память не зависит от размера выгрузки.
+    Сессия своя, а не из Depends: она должна жить, пока отдаётся тело ответа.
+    """
+    if fmt == "csv":
+        yield _csv([columns])
+
+    async with AsyncSessionLocal() as session:
+        result = await session.stream(query.execution_options(yield_per=settings.EXPORT_CHUNK_SIZE))
+        async for rows in result.partitions():
+            yield _csv(rows) if fmt == "csv" else _ndjson(rows, columns)
@@ -0,0 +1,127 @@
+import hashlib
+import json
+import logging
+from datetime import timedelta
+from typing import Any, Awaitable, Callable
+from fastapi import HTTPException, Response
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel
+from sqlalchemy import and_, delete, func, or_, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.db import AsyncSessionLocal
+from app.models import IdempotencyKey
+from app.config import settings
+
+logger = logging.getLogger("payments.idempotency")
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 200
+
+
+def _fingerprint(params: Any) -> str:
+    raw = json.dumps(jsonable_encoder(params), sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+def _json(status_code: int, body: bytes, replayed: bool = False) -> Response:
+    headers = {REPLAYED_HEADER: "true"} if replayed else None
+    return Response(content=body, status_code=status_code, media_type="application/json", headers=headers)
+
+async def _claim(key: str, fingerprint: str) -> IdempotencyKey | None:
+    """
+    Захватывает ключ одним INSERT ... ON CONFLICT. Просроченную запись или
+    брошенный незавершённый запрос перезахватываем. Возвращает None, если
+    ключ наш, иначе существующую запись.
+    """
+    stmt = pg_insert(IdempotencyKey).values(
+        key=key,
+        fingerprint=fingerprint,
+        expires_at=func.now() + timedelta(hours=settings.IDEMPOTENCY_TTL_HOURS),
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[IdempotencyKey.key],
+        set_={
+            "fingerprint": stmt.excluded.fingerprint,
+            "status_code": None,
+            "response": None,
+            "created_at": func.now(),
+            "expires_at": stmt.excluded.expires_at,
+        },
+        where=or_(
+            IdempotencyKey.expires_at < func.now(),
+            and_(
+                IdempotencyKey.status_code.is_(None),
+                IdempotencyKey.created_at < func.now() - timedelta(seconds=settings.IDEMPOTENCY_LOCK_SECONDS),
+            ),
+        ),
+    ).returning(IdempotencyKey.key)
+
+    async with AsyncSessionLocal() as session:
+        claimed = (await session.execute(stmt)).scalar_one_or_none()
+        await session.commit()
+        if claimed is not None:
+            return None
+        return (await session.execute(select(IdempotencyKey).where(IdempotencyKey.key == key))).scalar_one()
+
+async def _store(key: str, status_code: int, body: bytes) -> None:
+    async with AsyncSessionLocal() as session:
+        await session.execute(
+            update(IdempotencyKey)
+            .where(IdempotencyKey.key == key)
+            .values(status_code=status_code, response=body)
+        )
+        await session.commit()
+
+async def _release(key: str) -> None:
+    async with AsyncSessionLocal() as session:
+        await session.execute(delete(IdempotencyKey).where(IdempotencyKey.key == key, IdempotencyKey.status_code.is_(None)))
+        await session.commit()
+
+async def idempotent(
+    idempotency_key: str | None,
+    scope: str,
+    params: Any,
+    handler: Callable[[], Awaitable[Any]],
+) -> Any:
+    """
+    Выполняет handler не больше одного раза на (scope, Idempotency-Key).
+    Ретрай с тем же ключом получает сохранённый ответ (заголовок
+    Idempotent-Replayed). Ключ с другими параметрами запроса даёт 422,
+    а ретрай, пока первый запрос ещё выполняется, получает 409.
+    Сохраняются успешные ответы и 4xx; после 5xx/исключения ключ освобождается.
+    Без ключа handler просто выполняется.
+    """
+    if idempotency_key is None:
+        return await handler()
+    if len(idempotency_key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail=f"{IDEMPOTENCY_HEADER} is longer than {MAX_KEY_LENGTH} characters")
+
+    key = f"{scope}:{idempotency_key}"
+    fingerprint = _fingerprint(params)
+    stored = await _claim(key, fingerprint)
+    if stored is not None:
+        if stored.fingerprint != fingerprint:
+            raise HTTPException(status_code=422, detail=f"{IDEMPOTENCY_HEADER} was already used with different parameters")
+        if stored.status_code is None:
+            raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is in progress")
+        logger.info("[Payments] Replaying stored response for %s", key)
+        return _json(stored.status_code, stored.response, replayed=True)
+
+    try:
+        result = await handler()
+    except HTTPException as e:
+        if e.status_code >= 500:
+            await _release(key)
+            raise
+        await _store(key, e.status_code, json.dumps({"detail": e.detail}).encode())
+        raise
+    except Exception:
+        await _release(key)
+        raise
+
+    if isinstance(result, BaseModel):
+        body = result.model_dump_json().encode()
+    else:
+        body = json.dumps(jsonable_encoder(result)).encode()
+    await _store(key, 200, body)
+    return _json(200, body)
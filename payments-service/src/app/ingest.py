@@ -0,0 +1,200 @@
+import argparse
+import asyncio
+import codecs
+import csv
+import json
+import logging
+import time
+from decimal import Decimal, InvalidOperation
+from typing import AsyncIterator
+from uuid import UUID
+from sqlalchemy import text
+from app.db import engine
+from app.cache import cache, account_key
+from app.config import settings
+
+logger = logging.getLogger("payments.ingest")
+
+IMPORT_FORMATS = ("csv", "ndjson")
+
+# staging живёт до конца транзакции импорта и видна только её соединению
+STAGING_DDL = """
+    CREATE TEMP TABLE accounts_import (
+        line    integer NOT NULL,
+        user_id uuid NOT NULL,
+        amount  numeric(18, 2) NOT NULL
+    ) ON COMMIT DROP
+"""
+
+# Суммы одного user_id из файла складываются. Новые счета создаются с этим балансом,
+# существующим он зачисляется; у полосатых счетов - в полосу 0, т.к. accounts.balance
+# у них держится равным 0. В режиме ledger снапшот тоже прибавляется к balance,
+# так что прямое зачисление в balance с ним согласовано.
+MERGE_SQL = """
+    WITH src AS (
+        SELECT user_id, sum(amount) AS amount
+        FROM accounts_import
+        GROUP BY user_id
+    ),
+    merged AS (
+        INSERT INTO accounts (user_id, balance)
+        SELECT user_id, amount FROM src ORDER BY user_id
+        ON CONFLICT (user_id) DO UPDATE
+            SET balance = accounts.balance + excluded.balance, updated_at = now()
+            WHERE accounts.stripe_count = 1
+        RETURNING user_id, (xmax = 0) AS created
+    ),
+    striped AS (
+        UPDATE account_stripes s
+        SET balance = s.balance + src.amount, updated_at = now()
+        FROM src
+        WHERE s.user_id = src.user_id
+          AND s.stripe = 0
+          AND NOT EXISTS (SELECT 1 FROM merged m WHERE m.user_id = src.user_id)
+        RETURNING s.user_id
+    )
+    SELECT user_id, created FROM merged
+    UNION ALL
+    SELECT user_id, false FROM striped
+"""
+
+
+class ImportReport:
+    def __init__(self):
+        self.rows = 0
+        self.loaded = 0
+        self.rejected = 0
+        self.rejects: list[dict] = []
+        self.accounts_created = 0
+        self.accounts_updated = 0
+        self.started = time.monotonic()
+
+    def reject(self, line: int, reason: str) -> None:
+        self.rejected += 1
+        if len(self.rejects) < settings.IMPORT_REJECTS_LIMIT:
+            self.rejects.append({"line": line, "reason": reason})
+
+    def as_dict(self) -> dict:
+        elapsed = time.monotonic() - self.started
+        return {
+            "rows": self.rows,
+            "loaded": self.loaded,
+            "rejected": self.rejected,
+            "accounts_created": self.accounts_created,
+            "accounts_updated": self.accounts_updated,
+            "elapsed_seconds": round(elapsed, 3),
+            "rows_per_second": round(self.rows / elapsed) if elapsed > 0 else None,
+            "rejects": self.rejects,
+        }
+
+
+async def _lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[tuple[int, str]]:
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    tail = ""
+    number = 0
+    async for chunk in chunks:
+        tail += decoder.decode(chunk)
+        *lines, tail = tail.split("\n")
+        for line in lines:
+            number += 1
+            yield number, line.rstrip("\r")
+    tail += decoder.decode(b"", final=True)
+    if tail:
+        yield number + 1, tail.rstrip("\r")
+
+def _parse(line: str, fmt: str) -> tuple[UUID, Decimal]:
+    if fmt == "ndjson":
+        row = json.loads(line)
+        user_id, amount = row["user_id"], row.get("amount", 0)
+    else:
+        fields = next(csv.reader([line]))
+        user_id, amount = fields[0], fields[1] if len(fields) > 1 and fields[1] else 0
+
+    amount = Decimal(str(amount))
+    if not amount.is_finite() or amount < 0:
+        raise ValueError(f"invalid amount {amount}")
+    if amount != amount.quantize(Decimal("0.01")):
+        raise ValueError(f"amount {amount} has more than 2 decimal places")
+    return UUID(str(user_id)), amount
+
+async def _records(chunks: AsyncIterator[bytes], fmt: str, report: ImportReport):
+    async for number, line in _lines(chunks):
+        if not line.strip():
+            continue
+        # необязательная строка заголовка CSV
+        if fmt == "csv" and number == 1 and line.lstrip().lower().startswith("user_id"):
+            continue
+        report.rows += 1
+        try:
+            user_id, amount = _parse(line, fmt)
+        except (ValueError, KeyError, IndexError, TypeError, InvalidOperation) as e:
+            report.reject(number, str(e) or type(e).__name__)
+            continue
+        report.loaded += 1
+        yield number, user_id, amount
+
+async def import_accounts(chunks: AsyncIterator[bytes], fmt: str) -> dict:
+    """
+    Потоково грузит CSV (user_id,amount) или NDJSON ({"user_id", "amount"})
+    в staging через COPY и одним INSERT ... ON CONFLICT сливает в accounts.
+    Строки разбираются по мере чтения, файл целиком в памяти не держится.
+    Всё в одной транзакции: при ошибке слияния не применяется ничего.
+    """
+    report = ImportReport()
+    # ключи обновлённых счетов помним только до IMPORT_MERGE_BATCH штук,
+    # при большем импорте после commit сбрасывается весь кэш
+    updated: list[str] | None = []
+    async with engine.begin() as conn:
+        await conn.execute(text(STAGING_DDL))
+        raw = await conn.get_raw_connection()
+        await raw.driver_connection.copy_records_to_table(
+            "accounts_import",
+            records=_records(chunks, fmt, report),
+            columns=["line", "user_id", "amount"],
+        )
+
+        result = await conn.stream(text(MERGE_SQL))
+        async for rows in result.partitions(settings.IMPORT_MERGE_BATCH):
+            for user_id, created in rows:
+                if created:
+                    report.accounts_created += 1
+                else:
+                    report.accounts_updated += 1
+                    if updated is not None:
+                        updated.append(account_key(user_id))
+                        if len(updated) > settings.IMPORT_MERGE_BATCH:
+                            updated = None
+
+    # после commit, как в crud: иначе чтение между инвалидацией и commit
+    # положит в кэш старый баланс под новым поколением
+    if updated is None:
+        await cache.invalidate_all()
+    elif updated:
+        await cache.invalidate_many(updated)
+
+    summary = report.as_dict()
+    logger.info("[Payments] Imported accounts: %d rows, %d rejected, %d created, %d updated in %ss (%s rows/s)",
+                summary["rows"], summary["rejected"], summary["accounts_created"],
+                summary["accounts_updated"], summary["elapsed_seconds"], summary["rows_per_second"])
+    return summary
+
+
+async def _file_chunks(path: str, size: int = 1 << 16) -> AsyncIterator[bytes]:
+    with open(path, "rb") as f:
+        while chunk := f.read(size):
+            yield chunk
+
+async def _main(path: str, fmt: str) -> None:
+    try:
+        print(json.dumps(await import_accounts(_file_chunks(path), fmt), ensure_ascii=False, indent=2))
+    finally:
+        await engine.dispose()
+
+if __name__ == "__main__":
+    # python -m app.ingest accounts.csv [--format ndjson]
+    parser = argparse.ArgumentParser(description="Bulk import of accounts and initial balances")
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=IMPORT_FORMATS, default=None)
+    args = parser.parse_args()
+    engine.echo = False
+    asyncio.run(_main(args.path, args.format or ("ndjson" if args.path.endswith(".ndjson") else "csv")))
@@ -1,32 +1,114 @@
 import asyncio
 import logging
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request, Response
+from fastapi.responses import StreamingResponse
 from sqlalchemy.ext.asyncio import AsyncSession
 from uuid import UUID
 from decimal import Decimal
-from app import crud, schemas, workers
-from app.db import engine, Base, get_session
-from app.messaging import init_rabbit, close_rabbit
+from datetime import datetime
+from typing import Literal
+from app import crud, ingest, schemas, workers
+from app.db import engine, Base, get_session, ensure_columns, ensure_indexes
+from app.messaging import init_broker, close_broker
+from app.notify import install_outbox_notify_trigger
+from app.config import settings
+from app.logs import log_stats, setup_logging
+from app.metrics import MetricsMiddleware, CONTENT_TYPE, render, log_queue_collector, sqlalchemy_pool_collector
+from app.tracing import TracingMiddleware, MemoryExporter, close_exporter, exporter
+from app.cache import cache, account_key
+from app.export import stream_export, EXPORT_MEDIA_TYPES
+from app.idempotency import idempotent, IDEMPOTENCY_HEADER
 import uvicorn
 
+setup_logging()
 logger = logging.getLogger(__name__)
 app = FastAPI(title="Payments Service")
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
+sqlalchemy_pool_collector(engine)
+log_queue_collector(log_stats)
 
 @app.on_event("startup")
 async def startup_event():
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(ensure_columns)
+        await conn.run_sync(ensure_indexes)
+        await install_outbox_notify_trigger(conn)
 
-    await init_rabbit()
+    if settings.BALANCE_MODE != "ledger":
+        # после выключения ledger-режима сворачиваем хвост записей в accounts.balance
+        await workers.run_ledger_snapshots()
+
+    await init_broker()
 
     app.state.inbox_task  = asyncio.create_task(workers.inbox_consumer())
     app.state.outbox_task = asyncio.create_task(workers.outbox_publisher())
+    app.state.retention_task = asyncio.create_task(workers.retention_worker())
+    if settings.BALANCE_MODE == "ledger":
+        app.state.snapshot_task = asyncio.create_task(workers.ledger_snapshotter())
 
 @app.on_event("shutdown")
 async def shutdown_event():
     app.state.inbox_task.cancel()
     app.state.outbox_task.cancel()
-    await close_rabbit()
+    app.state.retention_task.cancel()
+    if settings.BALANCE_MODE == "ledger":
+        app.state.snapshot_task.cancel()
+    await close_broker()
+    close_exporter()
+
+@app.get("/accounts/export")
+async def export_accounts(format: Literal["ndjson", "csv"] = "ndjson"):
+    return StreamingResponse(
+        stream_export(crud.export_accounts_query(), crud.ACCOUNT_EXPORT_COLUMNS, format),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="accounts.{format}"'},
+    )
+
+@app.get("/holds/export")
+async def export_holds(
+    user_id: UUID | None = None,
+    format: Literal["ndjson", "csv"] = "ndjson",
+    created_from: datetime | None = Query(None),
+    created_to: datetime | None = Query(None),
+    active_only: bool = False,
+):
+    query = crud.export_holds_query(user_id, created_from, created_to, active_only)
+    return StreamingResponse(
+        stream_export(query, crud.HOLD_EXPORT_COLUMNS, format),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="holds.{format}"'},
+    )
+
+@app.post("/accounts:import")
+async def import_accounts(request: Request, format: Literal["csv", "ndjson"] = "csv"):
+    # тело читается потоком и сразу уходит в COPY, без буферизации файла
+    return await ingest.import_accounts(request.stream(), format)
+
+# объявлены до /accounts/{user_id}, иначе путь уйдёт в create_account
+@app.post("/accounts/holds:batch", response_model=schemas.HoldBatchResponse)
+async def api_hold_batch_accounts(
+    req: schemas.AccountHoldBatchRequest,
+    session: AsyncSession = Depends(get_session)
+):
+    holds = [(h.order_id, h.user_id, Decimal(str(h.amount))) for h in req.holds]
+    reasons = await crud.hold_batch(holds, session)
+    return schemas.HoldBatchResponse(results=[
+        schemas.HoldResult(order_id=h.order_id, status="held" if reason is None else "rejected", reason=reason)
+        for h, reason in zip(req.holds, reasons)
+    ])
+
+@app.post("/accounts/releases:batch", response_model=schemas.ReleaseBatchResponse)
+async def api_release_batch(
+    req: schemas.ReleaseBatchRequest,
+    session: AsyncSession = Depends(get_session)
+):
+    reasons = await crud.release_batch(req.order_ids, session)
+    return schemas.ReleaseBatchResponse(results=[
+        schemas.ReleaseResult(order_id=order_id, status="released" if reason is None else reason)
+        for order_id, reason in zip(req.order_ids, reasons)
+    ])
 
 @app.post("/accounts/{user_id}", response_model=schemas.AccountRead)
 async def create_account(
@@ -42,31 +124,91 @@ async def create_account(
 async def deposit(
     user_id: UUID,
     deposit_in: schemas.DepositRequest,
+    idempotency_key: str | None = Header(None, alias=IDEMPOTENCY_HEADER),
     session: AsyncSession = Depends(get_session)
 ):
-    acc = await crud.deposit(str(user_id), deposit_in.amount, session)
-    if not acc:
-        raise HTTPException(status_code=404, detail="Account not found")
-    return acc
+    async def handler():
+        acc = await crud.deposit(str(user_id), deposit_in.amount, session)
+        if not acc:
+            raise HTTPException(status_code=404, detail="Account not found")
+        return schemas.AccountRead.model_validate(acc, from_attributes=True)
+
+    return await idempotent(idempotency_key, f"deposit:{user_id}", deposit_in, handler)
 
 @app.get("/accounts/{user_id}", response_model=schemas.AccountRead)
 async def get_account(
     user_id: UUID,
     session: AsyncSession = Depends(get_session)
 ):
-    acc = await crud.get_account(str(user_id), session)
+    async def load() -> bytes | None:
+        acc = await crud.get_account(str(user_id), session)
+        return schemas.AccountRead.model_validate(acc, from_attributes=True).model_dump_json().encode() if acc else None
+
+    body = await cache.get_or_load(account_key(user_id), load)
+    if body is None:
+        raise HTTPException(status_code=404, detail="Account not found")
+    return Response(content=body, media_type="application/json")
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return cache.stats()
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return Response(await render(), media_type=CONTENT_TYPE)
+
+@app.get("/traces/{trace_id}")
+async def get_trace(trace_id: str):
+    if not isinstance(exporter, MemoryExporter):
+        raise HTTPException(404, "In-memory trace exporter is not enabled (TRACE_EXPORTER=memory)")
+    return exporter.find(trace_id)
+
+@app.put("/accounts/{user_id}/stripes", response_model=schemas.AccountRead)
+async def set_stripes(
+    user_id: UUID,
+    req: schemas.StripeCountRequest,
+    session: AsyncSession = Depends(get_session)
+):
+    acc = await crud.set_stripe_count(str(user_id), req.stripe_count, session)
     if not acc:
         raise HTTPException(status_code=404, detail="Account not found")
     return acc
 
 
 @app.post("/accounts/{user_id}/hold", status_code=200)
-async def api_hold(user_id: UUID, req: schemas.HoldRequest, session: AsyncSession = Depends(get_session)):
-    try:
-        await crud.hold_amount(req.order_id, user_id, Decimal(str(req.amount)), session)
-    except crud.InsufficientFunds:
-        raise HTTPException(400, "Insufficient funds")
-    return {"status":"held"}
+async def api_hold(
+    user_id: UUID,
+    req: schemas.HoldRequest,
+    idempotency_key: str | None = Header(None, alias=IDEMPOTENCY_HEADER),
+    session: AsyncSession = Depends(get_session)
+):
+    async def handler():
+        try:
+            await crud.hold_amount(req.order_id, user_id, Decimal(str(req.amount)), session)
+        except crud.InsufficientFunds:
+            raise HTTPException(400, "Insufficient funds")
+        return {"status":"held"}
+
+    return await idempotent(idempotency_key, f"hold:{user_id}", req, handler)
+
+@app.post("/accounts/{user_id}/holds:batch", response_model=schemas.HoldBatchResponse)
+async def api_hold_batch(
+    user_id: UUID,
+    req: schemas.HoldBatchRequest,
+    idempotency_key: str | None = Header(None, alias=IDEMPOTENCY_HEADER),
+    session: AsyncSession = Depends(get_session)
+):
+    async def handler():
+        holds = [(h.order_id, Decimal(str(h.amount))) for h in req.holds]
+        reasons = await crud.hold_amounts(user_id, holds, session)
+        if reasons is None:
+            raise HTTPException(404, "Account not found")
+        return schemas.HoldBatchResponse(results=[
+            schemas.HoldResult(order_id=h.order_id, status="held" if reason is None else "rejected", reason=reason)
+            for h, reason in zip(req.holds, reasons)
+        ])
+
+    return await idempotent(idempotency_key, f"hold_batch:{user_id}", req, handler)
 
 @app.post("/accounts/{user_id}/release", status_code=200)
 async def api_release(user_id: UUID, req: schemas.ReleaseRequest, session: AsyncSession = Depends(get_session)):
@@ -77,5 +219,4 @@ async def api_release(user_id: UUID, req: schemas.ReleaseRequest, session: Async
     return {"status":"released"}
 
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO)
     uvicorn.run("app.main:app", host="0.0.0.0", port=8000)
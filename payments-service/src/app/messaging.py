@@ -1,7 +1,10 @@
 import asyncio
 import logging
-from aio_pika import connect_robust, ExchangeType
-from aio_pika.abc import AbstractRobustConnection, AbstractRobustChannel
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Awaitable, Callable
+from aio_pika import connect_robust, DeliveryMode, ExchangeType, Message
+from aio_pika.exceptions import DeliveryError
 from app.config import settings
 
 logger = logging.getLogger("payments.messaging")
@@ -9,49 +12,273 @@ logger = logging.getLogger("payments.messaging")
 PAYMENT_EXCHANGE       = "payment_exchange"
 QUEUE_PAYMENT_REQUESTS = "payment_requests"
 QUEUE_PAYMENT_RESULTS  = "payment_results"
+QUEUES = (QUEUE_PAYMENT_REQUESTS, QUEUE_PAYMENT_RESULTS)
 
-rabbit_connection: AbstractRobustConnection | None = None
-rabbit_channel:    AbstractRobustChannel     | None = None
+# Полученное сообщение у любого брокера: body, content_type, headers,
+# ack(multiple=False) и nack(multiple=False, requeue=True). multiple=True
+# подтверждает все ранее доставленные этому консьюмеру сообщения.
+MessageCallback = Callable[[object], Awaitable[None]]
 
-async def init_rabbit(retry_attempts: int = 5, retry_delay: int = 2) -> None:
-    global rabbit_connection, rabbit_channel
-    url = f"amqp://{settings.RABBIT_USER}:{settings.RABBIT_PASSWORD}@{settings.RABBIT_HOST}:{settings.RABBIT_PORT}/"
 
-    for attempt in range(1, retry_attempts + 1):
-        try:
-            logger.info(f"[Payments] Connecting to RabbitMQ (attempt {attempt}/{retry_attempts})")
-            rabbit_connection = await connect_robust(url)
-            rabbit_channel    = await rabbit_connection.channel()
+class PublishRejected(Exception):
+    """Брокер не подтвердил публикацию (nack), событие остаётся в outbox."""
 
-            exchange = await rabbit_channel.declare_exchange(
-                PAYMENT_EXCHANGE, ExchangeType.DIRECT, durable=True
-            )
-            queue_req = await rabbit_channel.declare_queue(
-                QUEUE_PAYMENT_REQUESTS, durable=True
-            )
-            await queue_req.bind(exchange, QUEUE_PAYMENT_REQUESTS)
-            queue_res = await rabbit_channel.declare_queue(
-                QUEUE_PAYMENT_RESULTS, durable=True
+
+class BaseBroker(ABC):
+    backend = "none"
+
+    @abstractmethod
+    async def connect(self) -> None:
+        ...
+
+    @abstractmethod
+    async def publish(self, routing_key: str, body: bytes, content_type: str, headers: dict) -> None:
+        """Возвращается, когда брокер подтвердил сообщение; при nack - PublishRejected."""
+        ...
+
+    @abstractmethod
+    async def consume(self, queue: str, prefetch: int, callback: MessageCallback) -> str:
+        """
+        Подписывает callback на очередь: не больше prefetch неподтверждённых
+        сообщений одновременно. Возвращает тег консьюмера для cancel.
+        """
+        ...
+
+    @abstractmethod
+    async def cancel(self, consumer_tag: str) -> None:
+        # неподтверждённые сообщения консьюмера возвращаются в очередь
+        ...
+
+    @abstractmethod
+    async def purge(self, queue: str) -> int:
+        ...
+
+    @abstractmethod
+    async def close(self) -> None:
+        ...
+
+
+class RabbitBroker(BaseBroker):
+    """
+    RabbitMQ через aio-pika: direct exchange PAYMENT_EXCHANGE, очереди привязаны
+    по своему имени. Публикация идёт через отдельный канал в confirm-режиме,
+    у каждого консьюмера свой канал со своим prefetch.
+    """
+    backend = "rabbitmq"
+
+    def __init__(self, url: str):
+        self.url = url
+        self._connection = None
+        self._channel = None
+        self._exchange = None
+        self._consumers: dict[str, object] = {}
+
+    async def connect(self, retry_attempts: int = 5, retry_delay: int = 2) -> None:
+        for attempt in range(1, retry_attempts + 1):
+            try:
+                logger.info("[Payments] Connecting to RabbitMQ (attempt %d/%d)", attempt, retry_attempts)
+                self._connection = await connect_robust(self.url)
+                self._channel = await self._connection.channel()
+
+                exchange = await self._channel.declare_exchange(
+                    PAYMENT_EXCHANGE, ExchangeType.DIRECT, durable=True
+                )
+                for name in QUEUES:
+                    queue = await self._channel.declare_queue(name, durable=True)
+                    await queue.bind(exchange, name)
+
+                publish_channel = await self._connection.channel(publisher_confirms=True)
+                self._exchange = await publish_channel.declare_exchange(
+                    PAYMENT_EXCHANGE, ExchangeType.DIRECT, durable=True
+                )
+
+                logger.info("[Payments] RabbitMQ setup complete")
+                return
+            except Exception as e:
+                logger.error("[Payments] RabbitMQ init failed: %s", e)
+                if attempt < retry_attempts:
+                    await asyncio.sleep(retry_delay)
+                else:
+                    logger.critical("[Payments] Could not connect to RabbitMQ, giving up")
+                    raise
+
+    async def publish(self, routing_key: str, body: bytes, content_type: str, headers: dict) -> None:
+        if self._exchange is None:
+            await self.connect()
+        try:
+            await self._exchange.publish(
+                Message(body=body, content_type=content_type, delivery_mode=DeliveryMode.PERSISTENT, headers=headers),
+                routing_key=routing_key,
             )
-            await queue_res.bind(exchange, QUEUE_PAYMENT_RESULTS)
-
-            logger.info("[Payments] RabbitMQ setup complete")
-            return
-        except Exception as e:
-            logger.error(f"[Payments] RabbitMQ init failed: {e}")
-            if attempt < retry_attempts:
-                await asyncio.sleep(retry_delay)
-            else:
-                logger.critical("[Payments] Could not connect to RabbitMQ, giving up")
-                raise
-
-async def get_channel() -> AbstractRobustChannel:
-    if rabbit_channel is None:
-        await init_rabbit()
-    return rabbit_channel
-
-async def close_rabbit() -> None:
-    global rabbit_connection
-    if rabbit_connection:
-        await rabbit_connection.close()
-        logger.info("[Payments] RabbitMQ connection closed")
+        except DeliveryError as e:
+            raise PublishRejected(str(e)) from e
+
+    async def consume(self, queue: str, prefetch: int, callback: MessageCallback) -> str:
+        if self._connection is None:
+            await self.connect()
+        channel = await self._connection.channel()
+        await channel.set_qos(prefetch_count=prefetch)
+        declared = await channel.declare_queue(queue, durable=True)
+        consumer_tag = await declared.consume(callback)
+        self._consumers[consumer_tag] = channel
+        return consumer_tag
+
+    async def cancel(self, consumer_tag: str) -> None:
+        channel = self._consumers.pop(consumer_tag, None)
+        if channel is not None and not channel.is_closed:
+            await channel.close()
+
+    async def purge(self, queue: str) -> int:
+        if self._channel is None:
+            await self.connect()
+        declared = await self._channel.declare_queue(queue, durable=True)
+        result = await declared.purge()
+        return result.message_count
+
+    async def close(self) -> None:
+        if self._connection:
+            await self._connection.close()
+            self._connection = None
+            logger.info("[Payments] RabbitMQ connection closed")
+
+
+class MemoryMessage:
+    __slots__ = ("body", "content_type", "headers", "redelivered", "delivery_tag", "_consumer")
+
+    def __init__(self, body: bytes, content_type: str, headers: dict, redelivered: bool = False):
+        self.body = body
+        self.content_type = content_type
+        self.headers = headers
+        self.redelivered = redelivered
+        self.delivery_tag = 0
+        self._consumer = None
+
+    async def ack(self, multiple: bool = False) -> None:
+        self._consumer.settle(self.delivery_tag, multiple, requeue=False)
+
+    async def nack(self, multiple: bool = False, requeue: bool = True) -> None:
+        self._consumer.settle(self.delivery_tag, multiple, requeue)
+
+
+class MemoryQueue:
+    def __init__(self):
+        self.messages: deque[MemoryMessage] = deque()
+        self._ready = asyncio.Event()
+
+    def put(self, message: MemoryMessage, front: bool = False) -> None:
+        if front:
+            self.messages.appendleft(message)
+        else:
+            self.messages.append(message)
+        self._ready.set()
+
+    async def get(self) -> MemoryMessage:
+        while not self.messages:
+            self._ready.clear()
+            await self._ready.wait()
+        return self.messages.popleft()
+
+
+class _MemoryConsumer:
+    def __init__(self, queue: MemoryQueue, prefetch: int, callback: MessageCallback):
+        self.queue = queue
+        self.prefetch = prefetch
+        self.callback = callback
+        self.unacked: dict[int, MemoryMessage] = {}
+        self._next_tag = 0
+        self._has_room = asyncio.Event()
+        self.task = asyncio.create_task(self._deliver())
+
+    async def _deliver(self) -> None:
+        while True:
+            if self.prefetch and len(self.unacked) >= self.prefetch:
+                self._has_room.clear()
+                await self._has_room.wait()
+                continue
+            message = await self.queue.get()
+            self._next_tag += 1
+            message.delivery_tag = self._next_tag
+            message._consumer = self
+            self.unacked[message.delivery_tag] = message
+            try:
+                await self.callback(message)
+            except Exception as e:
+                logger.error("[Payments] Memory broker consumer callback failed: %s", e)
+
+    def settle(self, tag: int, multiple: bool, requeue: bool) -> None:
+        tags = [t for t in self.unacked if t <= tag] if multiple else [tag]
+        # в начало очереди в обратном порядке, чтобы сохранить исходный
+        for t in reversed(tags):
+            message = self.unacked.pop(t, None)
+            if message is not None and requeue:
+                self.queue.put(MemoryMessage(message.body, message.content_type, message.headers, True), front=True)
+        self._has_room.set()
+
+    def stop(self) -> None:
+        self.task.cancel()
+        if self.unacked:
+            self.settle(max(self.unacked), multiple=True, requeue=True)
+
+
+class MemoryBroker(BaseBroker):
+    """
+    Брокер внутри процесса на asyncio: для бенчмарков и тестов без RabbitMQ.
+    Семантика как у direct exchange с очередями по routing key: prefetch,
+    ack/nack с multiple, requeue в начало очереди. Ничего не переживает
+    рестарт. Словарь queues можно отдать другому MemoryBroker, тогда сервисы
+    в одном процессе обмениваются сообщениями через общие очереди.
+    """
+    backend = "memory"
+
+    def __init__(self, queues: dict[str, MemoryQueue] | None = None):
+        self.queues = queues if queues is not None else {}
+        self._consumers: dict[str, _MemoryConsumer] = {}
+
+    async def connect(self) -> None:
+        for name in QUEUES:
+            self.queues.setdefault(name, MemoryQueue())
+
+    async def publish(self, routing_key: str, body: bytes, content_type: str, headers: dict) -> None:
+        queue = self.queues.get(routing_key)
+        # как у direct exchange: сообщение без подходящей очереди теряется
+        if queue is not None:
+            queue.put(MemoryMessage(body, content_type, dict(headers)))
+
+    async def consume(self, queue: str, prefetch: int, callback: MessageCallback) -> str:
+        consumer_tag = f"memory-{queue}-{len(self._consumers) + 1}"
+        self._consumers[consumer_tag] = _MemoryConsumer(self.queues.setdefault(queue, MemoryQueue()), prefetch, callback)
+        return consumer_tag
+
+    async def cancel(self, consumer_tag: str) -> None:
+        consumer = self._consumers.pop(consumer_tag, None)
+        if consumer is not None:
+            consumer.stop()
+
+    async def purge(self, queue: str) -> int:
+        messages = self.queues[queue].messages if queue in self.queues else deque()
+        count = len(messages)
+        messages.clear()
+        return count
+
+    async def close(self) -> None:
+        for consumer_tag in list(self._consumers):
+            await self.cancel(consumer_tag)
+
+
+def build_broker() -> BaseBroker:
+    if settings.BROKER_BACKEND == "memory":
+        return MemoryBroker()
+    if settings.BROKER_BACKEND != "rabbitmq":
+        logger.warning("[Payments] Unknown BROKER_BACKEND %r, using rabbitmq", settings.BROKER_BACKEND)
+    return RabbitBroker(
+        f"amqp://{settings.RABBIT_USER}:{settings.RABBIT_PASSWORD}@{settings.RABBIT_HOST}:{settings.RABBIT_PORT}/"
+    )
+
+
+broker = build_broker()
+
+async def init_broker() -> None:
+    await broker.connect()
+
+async def close_broker() -> None:
+    await broker.close()
@@ -1,5 +1,5 @@
 import uuid
-from sqlalchemy import Column, DateTime, Numeric, String, DECIMAL, TIMESTAMP, func
+from sqlalchemy import BigInteger, Column, DateTime, Integer, LargeBinary, Numeric, String, DECIMAL, TIMESTAMP, Index, func, text
 from sqlalchemy.dialects.postgresql import UUID as PG_UUID, JSONB
 from app.db import Base
 
@@ -8,11 +8,40 @@ class Account(Base):
 
     user_id = Column(PG_UUID(as_uuid=True), primary_key=True)
     balance = Column(DECIMAL(18, 2), nullable=False, default=0)
+    # 1 - обычный счёт; N > 1 - баланс разложен по N строкам account_stripes,
+    # а accounts.balance держится равным 0
+    stripe_count = Column(Integer, nullable=False, default=1, server_default=text("1"))
+    # в режиме ledger balance - снапшот, учитывающий записи ledger_entries до этого id
+    snapshot_entry_id = Column(BigInteger, nullable=False, default=0, server_default=text("0"))
     created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
     updated_at = Column(TIMESTAMP(timezone=True), onupdate=func.now())
 
+class AccountStripe(Base):
+    __tablename__ = "account_stripes"
+
+    user_id = Column(PG_UUID(as_uuid=True), primary_key=True)
+    stripe = Column(Integer, primary_key=True)
+    balance = Column(DECIMAL(18, 2), nullable=False, default=0)
+    updated_at = Column(TIMESTAMP(timezone=True), onupdate=func.now())
+
+class LedgerEntry(Base):
+    __tablename__ = "ledger_entries"
+    __table_args__ = (
+        Index("ix_ledger_entries_user_id_id", "user_id", "id"),
+    )
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    user_id = Column(PG_UUID(as_uuid=True), nullable=False)
+    amount = Column(DECIMAL(18, 2), nullable=False)  # со знаком: + зачисление, - списание
+    kind = Column(String(20), nullable=False)
+    ref_id = Column(PG_UUID(as_uuid=True), nullable=True)
+    created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
+
 class PaymentsInbox(Base):
     __tablename__ = "payments_inbox"
+    __table_args__ = (
+        Index("ix_payments_inbox_processed_at", "processed_at"),
+    )
 
     message_id = Column(PG_UUID(as_uuid=True), primary_key=True)
     event_type = Column(String(50), nullable=False)
@@ -21,6 +50,11 @@ class PaymentsInbox(Base):
 
 class PaymentsOutbox(Base):
     __tablename__ = "payments_outbox"
+    __table_args__ = (
+        # выборка publisher'а видит только неопубликованный хвост, а не всю историю
+        Index("ix_payments_outbox_pending", "created_at", "id", postgresql_where=text("published_at IS NULL")),
+        Index("ix_payments_outbox_published_at", "published_at", postgresql_where=text("published_at IS NOT NULL")),
+    )
 
     id = Column(PG_UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     aggregate_id = Column(PG_UUID(as_uuid=True), nullable=False)
@@ -29,8 +63,22 @@ class PaymentsOutbox(Base):
     created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
     published_at = Column(TIMESTAMP(timezone=True), nullable=True)
 
+class PaymentsOutboxArchive(Base):
+    __tablename__ = "payments_outbox_archive"
+
+    id = Column(PG_UUID(as_uuid=True), primary_key=True)
+    aggregate_id = Column(PG_UUID(as_uuid=True), nullable=False)
+    event_type = Column(String(50), nullable=False)
+    payload = Column(JSONB, nullable=False)
+    created_at = Column(TIMESTAMP(timezone=True))
+    published_at = Column(TIMESTAMP(timezone=True))
+    archived_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
+
 class Hold(Base):
     __tablename__ = "holds"
+    __table_args__ = (
+        Index("ix_holds_user_id_created_at", "user_id", "created_at"),
+    )
 
     order_id = Column(PG_UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     user_id = Column(PG_UUID(as_uuid=True), nullable=False)
@@ -38,3 +86,16 @@ class Hold(Base):
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     released_at= Column(DateTime(timezone=True), nullable=True)
     captured_at= Column(DateTime(timezone=True), nullable=True)
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (
+        Index("ix_idempotency_keys_expires_at", "expires_at"),
+    )
+
+    key = Column(String(300), primary_key=True)       # "<scope>:<Idempotency-Key>"
+    fingerprint = Column(String(64), nullable=False)  # sha256 параметров запроса
+    status_code = Column(Integer, nullable=True)      # NULL - запрос ещё выполняется
+    response = Column(LargeBinary, nullable=True)
+    created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
+    expires_at = Column(TIMESTAMP(timezone=True), nullable=False)
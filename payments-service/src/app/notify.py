@@ -0,0 +1,92 @@
+import asyncio
+import logging
+import asyncpg
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+from app.db import engine
+
+logger = logging.getLogger("payments.notify")
+
+OUTBOX_NOTIFY_CHANNEL = "payments_outbox"
+
+# Триггер шлёт NOTIFY на каждую вставку в outbox; сообщение доставляется
+# слушателям только после COMMIT, так что воркер не увидит незакоммиченные строки
+OUTBOX_NOTIFY_DDL = (
+    f"""
+    CREATE OR REPLACE FUNCTION notify_payments_outbox() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('{OUTBOX_NOTIFY_CHANNEL}', '');
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql
+    """,
+    """
+    CREATE OR REPLACE TRIGGER payments_outbox_notify
+    AFTER INSERT ON payments_outbox
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_payments_outbox()
+    """,
+)
+
+# паузы между попытками восстановить LISTEN: удваиваются до максимума
+RECONNECT_MIN_DELAY = 1.0
+RECONNECT_MAX_DELAY = 60.0
+
+async def install_outbox_notify_trigger(conn: AsyncConnection) -> None:
+    for ddl in OUTBOX_NOTIFY_DDL:
+        await conn.execute(text(ddl))
+
+
+class OutboxNotifier:
+    """
+    Держит отдельное asyncpg-соединение с LISTEN на канал outbox и будит
+    publisher при вставке новых событий. Если соединение недоступно,
+    wait() вырождается в обычный sleep на время fallback-интервала.
+    """
+
+    def __init__(self, channel: str = OUTBOX_NOTIFY_CHANNEL):
+        self.channel = channel
+        self._event = asyncio.Event()
+        self._conn: asyncpg.Connection | None = None
+        self._retry_delay = RECONNECT_MIN_DELAY
+        self._retry_at = 0.0
+
+    async def start(self) -> None:
+        dsn = engine.url.set(drivername="postgresql").render_as_string(hide_password=False)
+        loop = asyncio.get_running_loop()
+        try:
+            self._conn = await asyncpg.connect(dsn)
+            await self._conn.add_listener(self.channel, self._on_notify)
+            self._conn.add_termination_listener(self._on_terminate)
+            self._retry_delay = RECONNECT_MIN_DELAY
+            logger.info("[Payments] Listening for outbox notifications on '%s'", self.channel)
+        except Exception as e:
+            await self.close()
+            self._retry_at = loop.time() + self._retry_delay
+            logger.warning("[Payments] LISTEN '%s' failed, falling back to polling, retry in %.0fs: %s",
+                           self.channel, self._retry_delay, e)
+            self._retry_delay = min(self._retry_delay * 2, RECONNECT_MAX_DELAY)
+
+    def _on_notify(self, conn, pid, channel, payload) -> None:
+        self._event.set()
+
+    def _on_terminate(self, conn) -> None:
+        logger.warning("[Payments] Outbox LISTEN connection lost")
+        self._conn = None
+        # будим publisher, чтобы он не пропустил события, пришедшие во время обрыва
+        self._event.set()
+
+    async def wait(self, timeout: float) -> None:
+        if (self._conn is None or self._conn.is_closed()) and asyncio.get_running_loop().time() >= self._retry_at:
+            await self.start()
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._event.clear()
+
+    async def close(self) -> None:
+        conn, self._conn = self._conn, None
+        if conn is not None and not conn.is_closed():
+            # своё закрытие - не обрыв, предупреждение из _on_terminate не нужно
+            conn.remove_termination_listener(self._on_terminate)
+            await conn.close()
@@ -1,5 +1,5 @@
 from pydantic import BaseModel, Field
-from typing import Optional
+from typing import List, Optional
 from uuid import UUID
 from datetime import datetime
 
@@ -10,9 +10,14 @@ class DepositRequest(BaseModel):
     amount: float = Field(..., gt=0, description="Сумма для пополнения (положительное число)")
 
 
+class StripeCountRequest(BaseModel):
+    stripe_count: int = Field(..., ge=1, le=64, description="Число полос баланса (1 - обычный счёт)")
+
+
 class AccountRead(BaseModel):
     user_id: UUID
     balance: float
+    stripe_count: int = 1
     created_at: Optional[datetime]
     updated_at: Optional[datetime]
 
@@ -37,3 +42,32 @@ class HoldRequest(BaseModel):
 
 class ReleaseRequest(BaseModel):
     order_id: UUID
+
+class HoldBatchRequest(BaseModel):
+    holds: List[HoldRequest] = Field(..., min_length=1, max_length=1000)
+
+class HoldResult(BaseModel):
+    order_id: UUID
+    status: str  # held | rejected
+    reason: Optional[str] = None
+
+class HoldBatchResponse(BaseModel):
+    results: List[HoldResult]
+
+class AccountHoldRequest(BaseModel):
+    order_id: UUID
+    user_id: UUID
+    amount: float
+
+class AccountHoldBatchRequest(BaseModel):
+    holds: List[AccountHoldRequest] = Field(..., min_length=1, max_length=1000)
+
+class ReleaseBatchRequest(BaseModel):
+    order_ids: List[UUID] = Field(..., min_length=1, max_length=1000)
+
+class ReleaseResult(BaseModel):
+    order_id: UUID
+    status: str  # released | not_found
+
+class ReleaseBatchResponse(BaseModel):
+    results: List[ReleaseResult]
@@ -1,76 +1,276 @@
 import asyncio
-import json
 import logging
+import time
+from datetime import timedelta
 
-from aio_pika import Message, ExchangeType
+# брокер читается через модуль, чтобы бенчмарки могли подменить messaging.broker
+from app import messaging
 from app.messaging import (
-    get_channel,
-    PAYMENT_EXCHANGE,
+    PublishRejected,
     QUEUE_PAYMENT_REQUESTS,
     QUEUE_PAYMENT_RESULTS
 )
 from app.schemas import PaymentRequestEvent
-from app.crud import process_payment_event
+from app.crud import (
+    process_payment_event,
+    claim_outbox_batch,
+    mark_outbox_published,
+    outbox_backlog,
+    prune_published_outbox,
+    prune_inbox,
+    prune_idempotency_keys,
+    take_ledger_snapshots
+)
 from app.db import get_session
-from app.models import PaymentsOutbox
-from sqlalchemy import select, func
 from app.config import settings
+from app.notify import OutboxNotifier
+from app.codec import UnsupportedContentType, codec, decode_model
+from app.logs import sampled
+from app.metrics import Counter, Gauge, Histogram, collector
+from app.tracing import TRACEPARENT_HEADER, extract, inject, parse_traceparent, span
 
 logger = logging.getLogger("payments.workers")
+# записи на каждое сообщение проходят с долей LOG_SAMPLE_RATE
+message_logger = sampled("payments.workers.messages")
+
+OUTBOX_PUBLISHED = Counter("outbox_published_total", "События outbox, подтверждённые брокером")
+OUTBOX_NACKED = Counter("outbox_publish_nacked_total", "Публикации outbox, отклонённые брокером")
+OUTBOX_BATCH_DURATION = Histogram("outbox_publish_batch_seconds", "Время одной пачки outbox_publisher")
+OUTBOX_BACKLOG = Gauge("outbox_backlog", "Неопубликованные события outbox")
+OUTBOX_OLDEST_AGE = Gauge("outbox_oldest_unpublished_age_seconds", "Возраст самого старого неопубликованного события")
+CONSUMER_MESSAGES = Counter("consumer_messages_total", "Сообщения, обработанные консьюмером", ("consumer", "outcome"))
+CONSUMER_DURATION = Histogram("consumer_processing_seconds", "Время обработки сообщения консьюмером", ("consumer",))
+
+@collector
+async def collect_outbox_backlog() -> None:
+    async for session in get_session():
+        count, age = await outbox_backlog(session)
+    OUTBOX_BACKLOG.set(count)
+    OUTBOX_OLDEST_AGE.set(age)
+
+def parse_payment_request(message) -> PaymentRequestEvent | None:
+    # UnsupportedContentType пробрасывается: такое сообщение не битое, его нельзя ack'ать
+    try:
+        return decode_model(PaymentRequestEvent, message.body, message.content_type)
+    except UnsupportedContentType:
+        raise
+    except Exception as e:
+        logger.error("[Payments] Invalid message format: %s", e)
+        CONSUMER_MESSAGES.labels("inbox_consumer", "invalid").inc()
+        return None
+
+async def handle_payment_request(event: PaymentRequestEvent) -> None:
+    message_logger.info("[Payments] Processing payment request",
+                        extra={"order_id": event.order_id, "user_id": event.user_id, "amount": event.amount})
+
+    start = time.perf_counter()
+    outcome = "processed"
+    async for session in get_session():
+        try:
+            with span("db.process_payment_event", order_id=str(event.order_id)):
+                await process_payment_event(event, session)
+            message_logger.info("[Payments] Payment request committed", extra={"order_id": event.order_id})
+        except Exception as e:
+            outcome = "failed"
+            logger.error("[Payments] process_payment_event failed: %s", e, extra={"order_id": event.order_id})
+    CONSUMER_MESSAGES.labels("inbox_consumer", outcome).inc()
+    CONSUMER_DURATION.labels("inbox_consumer").observe(time.perf_counter() - start)
+
+async def inbox_lane(lane: asyncio.Queue) -> None:
+    # внутри одной полосы события обрабатываются строго по очереди
+    while True:
+        message, event = await lane.get()
+        try:
+            with span("inbox_consumer.process", parent=extract(message.headers), order_id=str(event.order_id)):
+                await handle_payment_request(event)
+        except Exception:
+            await message.nack(requeue=False)
+            raise
+        await message.ack()
+
+async def requeue_later(message, delay: float) -> None:
+    await asyncio.sleep(delay)
+    await message.nack(requeue=True)
 
 async def inbox_consumer():
-    channel = await get_channel()
-    queue = await channel.declare_queue(QUEUE_PAYMENT_REQUESTS, durable=True)
-    await channel.set_qos(prefetch_count=settings.INBOX_PREFETCH_COUNT)
-
-    logger.info("[Payments] Starting inbox_consumer on queue '%s'", QUEUE_PAYMENT_REQUESTS)
-    async with queue.iterator() as it:
-        async for message in it:
-            async with message.process():
-                body = message.body.decode()
-                logger.info("[Payments] Received raw message: %s", body)
+    # события одного user_id всегда попадают в одну полосу (порядок по счёту сохраняется),
+    # разные счета обрабатываются параллельно
+    lanes = [asyncio.Queue() for _ in range(settings.INBOX_WORKER_LANES)]
+    lane_tasks = [asyncio.create_task(inbox_lane(lane)) for lane in lanes]
+    requeues: set[asyncio.Task] = set()
+
+    async def dispatch(message) -> None:
+        try:
+            event = parse_payment_request(message)
+        except UnsupportedContentType as e:
+            if message.redelivered:
+                # уже возвращали в очередь: отклоняем без requeue (уходит в DLX, если он настроен)
+                logger.error("[Payments] Cannot decode payment request, rejecting: %s", e)
+                CONSUMER_MESSAGES.labels("inbox_consumer", "invalid").inc()
+                await message.nack(requeue=False)
+                return
+            # один раз возвращаем в очередь - его может дочитать реплика с нужным кодеком.
+            # Пауза идёт в отдельной задаче, чтобы не держать доставку следующих сообщений
+            logger.error("[Payments] Cannot decode payment request, requeueing: %s", e)
+            CONSUMER_MESSAGES.labels("inbox_consumer", "requeued").inc()
+            task = asyncio.create_task(requeue_later(message, 1))
+            requeues.add(task)
+            task.add_done_callback(requeues.discard)
+            return
+        if event is None:
+            await message.ack()
+            return
+        lanes[event.user_id.int % len(lanes)].put_nowait((message, event))
+
+    consumer_tag = await messaging.broker.consume(QUEUE_PAYMENT_REQUESTS, settings.INBOX_PREFETCH_COUNT, dispatch)
+    logger.info("[Payments] Starting inbox_consumer on queue '%s' with %d lanes (%s broker)",
+                QUEUE_PAYMENT_REQUESTS, len(lanes), messaging.broker.backend)
+    try:
+        await asyncio.gather(*lane_tasks)
+    finally:
+        await messaging.broker.cancel(consumer_tag)
+        for task in lane_tasks + list(requeues):
+            task.cancel()
+
+async def publish_confirmed(events) -> list:
+    # до OUTBOX_PUBLISH_WINDOW неподтверждённых publish одновременно;
+    # в outbox помечаются только события, на которые брокер ответил ack
+    window = asyncio.Semaphore(settings.OUTBOX_PUBLISH_WINDOW)
+
+    async def publish(ev):
+        async with window:
+            message_logger.info("[Payments] Publishing payment result",
+                                extra={"event_id": ev.id, "order_id": ev.payload.get("order_id"),
+                                       "result": ev.payload.get("result")})
+            # контекст trace'а едет в заголовках сообщения, а не в теле
+            payload = dict(ev.payload)
+            parent = parse_traceparent(payload.pop(TRACEPARENT_HEADER, None))
+            with span("amqp.publish", parent=parent, queue=QUEUE_PAYMENT_RESULTS, order_id=payload.get("order_id")) as s:
+                if s is not None and ev.created_at is not None:
+                    s.set("outbox.wait_ms", round((s.start - ev.created_at.timestamp()) * 1000, 3))
                 try:
-                    data = json.loads(body)
-                    event = PaymentRequestEvent(**data)
-                except Exception as e:
-                    logger.error("[Payments] Invalid message format: %s", e)
-                    continue
-
-                logger.info("[Payments] Processing payment for order %s, user %s, amount %s",
-                            event.order_id, event.user_id, event.amount)
-
-                async for session in get_session():
-                    try:
-                        await process_payment_event(event, session)
-                        logger.info("[Payments] process_payment_event committed for order %s", event.order_id)
-                    except Exception as e:
-                        logger.error("[Payments] process_payment_event failed: %s", e)
+                    await messaging.broker.publish(
+                        QUEUE_PAYMENT_RESULTS, codec.dumps(payload), codec.content_type, inject({})
+                    )
+                except PublishRejected as e:
+                    logger.warning("[Payments] Broker nacked outbox event %s: %s", ev.id, e)
+                    OUTBOX_NACKED.inc()
+                    if s is not None:
+                        s.status = "error"
+                    return False
+            return True
+
+    confirmed = []
+    pending = list(events)
+    for _ in range(settings.OUTBOX_PUBLISH_RETRIES + 1):
+        results = await asyncio.gather(*(publish(ev) for ev in pending))
+        confirmed += [ev.id for ev, ok in zip(pending, results) if ok]
+        pending = [ev for ev, ok in zip(pending, results) if not ok]
+        if not pending:
+            break
+    return confirmed
+
+async def publish_outbox_batch() -> int:
+    async for session in get_session():
+        events = await claim_outbox_batch(settings.OUTBOX_BATCH_SIZE, session)
+        logger.debug("[Payments] Found %d pending outbox events", len(events))
+        if not events:
+            await session.rollback()
+            return 0
+
+        start = time.perf_counter()
+        confirmed = await publish_confirmed(events)
+
+        if confirmed:
+            await mark_outbox_published(confirmed, session)
+        await session.commit()
+        OUTBOX_PUBLISHED.inc(len(confirmed))
+        OUTBOX_BATCH_DURATION.observe(time.perf_counter() - start)
+        logger.info("[Payments] Outbox publish commit complete: %d/%d confirmed", len(confirmed), len(events))
+        return len(confirmed)
 
 async def outbox_publisher():
+    # OUTBOX_POLL_INTERVAL - только страховочный sweep, основной триггер - NOTIFY
     INTERVAL = settings.OUTBOX_POLL_INTERVAL
+    notifier = OutboxNotifier() if settings.OUTBOX_NOTIFY_ENABLED else None
+    if notifier:
+        await notifier.start()
+
+    try:
+        while True:
+            # выгребаем backlog полными пачками, потом ждём новых событий
+            while await publish_outbox_batch() == settings.OUTBOX_BATCH_SIZE:
+                pass
+
+            if notifier:
+                await notifier.wait(INTERVAL)
+            else:
+                await asyncio.sleep(INTERVAL)
+    finally:
+        # при отмене на shutdown LISTEN-соединение иначе остаётся открытым
+        if notifier:
+            await notifier.close()
+
+async def run_retention() -> dict[str, int]:
+    # пачками по RETENTION_BATCH_SIZE, каждая пачка - отдельная короткая транзакция
+    batch = settings.RETENTION_BATCH_SIZE
+    outbox_age = timedelta(hours=settings.OUTBOX_RETENTION_HOURS)
+    inbox_age = timedelta(hours=settings.INBOX_RETENTION_HOURS)
+    pruned = {"payments_outbox": 0, "payments_inbox": 0, "idempotency_keys": 0}
+
+    while True:
+        async for session in get_session():
+            n = await prune_published_outbox(outbox_age, batch, settings.OUTBOX_ARCHIVE_ENABLED, session)
+            await session.commit()
+        pruned["payments_outbox"] += n
+        if n < batch:
+            break
+
+    while True:
+        async for session in get_session():
+            n = await prune_inbox(inbox_age, batch, session)
+            await session.commit()
+        pruned["payments_inbox"] += n
+        if n < batch:
+            break
 
     while True:
         async for session in get_session():
-            stmt = select(PaymentsOutbox).where(PaymentsOutbox.published_at.is_(None))
-            result = await session.execute(stmt)
-            events = result.scalars().all()
-            logger.info("[Payments] Found %d pending outbox events", len(events))
-
-            if events:
-                channel = await get_channel()
-                exchange = await channel.declare_exchange(
-                    PAYMENT_EXCHANGE, ExchangeType.DIRECT, durable=True
-                )
-
-                for ev in events:
-                    payload = ev.payload
-                    logger.info("[Payments] Publishing to '%s': %s", QUEUE_PAYMENT_RESULTS, payload)
-                    message = Message(body=json.dumps(payload).encode())
-                    await exchange.publish(message, routing_key=QUEUE_PAYMENT_RESULTS)
-                    ev.published_at = func.now()
-                    session.add(ev)
-
-                await session.commit()
-                logger.info("[Payments] Outbox publish commit complete")
-
-        await asyncio.sleep(INTERVAL)
+            n = await prune_idempotency_keys(batch, session)
+            await session.commit()
+        pruned["idempotency_keys"] += n
+        if n < batch:
+            break
+
+    return pruned
+
+async def retention_worker():
+    while True:
+        try:
+            pruned = await run_retention()
+            logger.info("[Payments] Retention run complete, pruned rows: %s (archive=%s)",
+                        pruned, settings.OUTBOX_ARCHIVE_ENABLED)
+        except Exception as e:
+            logger.error("[Payments] Retention run failed: %s", e)
+        await asyncio.sleep(settings.RETENTION_INTERVAL)
+
+async def run_ledger_snapshots() -> int:
+    # сворачивает записи ledger в accounts.balance пачками по LEDGER_SNAPSHOT_BATCH счетов
+    total = 0
+    while True:
+        async for session in get_session():
+            n = await take_ledger_snapshots(settings.LEDGER_SNAPSHOT_BATCH, session)
+            await session.commit()
+        total += n
+        if n < settings.LEDGER_SNAPSHOT_BATCH:
+            return total
+
+async def ledger_snapshotter():
+    while True:
+        try:
+            accounts = await run_ledger_snapshots()
+            if accounts:
+                logger.info("[Payments] Ledger snapshot: %d accounts updated", accounts)
+        except Exception as e:
+            logger.error("[Payments] Ledger snapshot failed: %s", e)
+        await asyncio.sleep(settings.LEDGER_SNAPSHOT_INTERVAL)
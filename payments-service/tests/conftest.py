@@ -0,0 +1,36 @@
+import asyncio
+import os
+import sys
+import uuid
+from decimal import Decimal
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from app.db import AsyncSessionLocal, Base, engine, ensure_columns  # noqa: E402
+from app.models import Account  # noqa: E402
+
+
+async def _create_account(user_id: uuid.UUID, balance: Decimal) -> None:
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(ensure_columns)
+    async with AsyncSessionLocal() as session:
+        session.add(Account(user_id=user_id, balance=balance))
+        await session.commit()
+    # пул привязан к event loop, а каждый asyncio.run создаёт новый
+    await engine.dispose()
+
+
+@pytest.fixture
+def account():
+    """Заводит счёт с заданным балансом в базе из настроек и возвращает его user_id."""
+    def create(balance: Decimal) -> uuid.UUID:
+        user_id = uuid.uuid4()
+        try:
+            asyncio.run(_create_account(user_id, balance))
+        except OSError as e:
+            pytest.skip(f"payments database is not reachable: {e}")
+        return user_id
+    return create
@@ -0,0 +1,37 @@
+import asyncio
+import uuid
+from decimal import Decimal
+
+from sqlalchemy import select
+from app import crud
+from app.db import AsyncSessionLocal, engine
+from app.models import Account, Hold
+
+
+async def _batch_with_concurrent_duplicate(user_id: uuid.UUID, taken: uuid.UUID, free: uuid.UUID):
+    async with AsyncSessionLocal() as first, AsyncSessionLocal() as second:
+        # резерв taken ещё не закоммичен, поэтому проверка в hold_batch его не видит
+        first.add(Hold(order_id=taken, user_id=user_id, amount=Decimal("10")))
+        await first.flush()
+        batch = asyncio.create_task(crud.hold_batch(
+            [(taken, user_id, Decimal("10")), (free, user_id, Decimal("20"))], second
+        ))
+        await asyncio.sleep(0.3)
+        await first.commit()
+        results = await batch
+
+    async with AsyncSessionLocal() as session:
+        balance = (await session.execute(select(Account.balance).where(Account.user_id == user_id))).scalar_one()
+        held = set((await session.execute(select(Hold.order_id).where(Hold.user_id == user_id))).scalars().all())
+    await engine.dispose()
+    return results, balance, held
+
+
+def test_hold_batch_reports_concurrent_duplicate_per_item(account):
+    user_id = account(Decimal("100"))
+    taken, free = uuid.uuid4(), uuid.uuid4()
+
+    results, balance, held = asyncio.run(_batch_with_concurrent_duplicate(user_id, taken, free))
+    assert results == ["duplicate", None]
+    assert balance == Decimal("80")
+    assert held == {taken, free}
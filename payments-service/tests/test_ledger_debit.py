@@ -0,0 +1,37 @@
+import asyncio
+import uuid
+from decimal import Decimal
+
+from sqlalchemy import func, select
+from app import crud
+from app.config import settings
+from app.db import AsyncSessionLocal, engine
+from app.models import Account, LedgerEntry
+
+
+async def _concurrent_debits(user_id: uuid.UUID, amount: Decimal):
+    async with AsyncSessionLocal() as first, AsyncSessionLocal() as second:
+        # первое списание держит лок счёта, пока второе не встанет в ожидание
+        assert await crud._ledger_debit(user_id, amount, "hold", uuid.uuid4(), first) is None
+        waiting = asyncio.create_task(crud._ledger_debit(user_id, amount, "hold", uuid.uuid4(), second))
+        await asyncio.sleep(0.3)
+        assert not waiting.done()
+        await first.commit()
+        reason = await waiting
+        await second.commit()
+
+    async with AsyncSessionLocal() as session:
+        debited = (await session.execute(
+            select(func.coalesce(func.sum(LedgerEntry.amount), 0)).where(LedgerEntry.user_id == user_id)
+        )).scalar_one()
+    await engine.dispose()
+    return reason, debited
+
+
+def test_concurrent_ledger_debits_do_not_overdraw(monkeypatch, account):
+    monkeypatch.setattr(settings, "BALANCE_MODE", "ledger")
+    user_id = account(Decimal("100"))
+
+    reason, debited = asyncio.run(_concurrent_debits(user_id, Decimal("80")))
+    assert reason == "insufficient_funds"
+    assert debited == Decimal("-80")